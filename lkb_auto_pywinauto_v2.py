@@ -7,7 +7,58 @@ Replaces pyautogui with pywinauto.keyboard.send_keys (Windows-only).
 - Enter key delay (seconds) between key actions. Default: 0.25
 - Choose data file (CSV or Excel).
 - Option: Wait while mouse cursor is hourglass (Windows only).
+- Retry: a failing row is retried after a reset macro (Esc, F4), then written to
+  <data>_failed.csv and the run continues; "Chạy lại lỗi" re-runs those rows.
 - Press OK to start, Exit to quit.
+- Column formats: <data>.schema.json next to the data file (see load_column_schema)
+  controls number/date formatting, applied once to the selected range before keying.
+- Option: "Gõ phím nhanh (SendInput)" sends each run of consecutive plan keys (and each
+  hotkey/text) as one native SendInput batch (ctypes, KEYEVENTF_UNICODE for Vietnamese
+  text) instead of send_keys, with one cursor wait and one delay per run.
+- Option: "Gom chứng từ" keys the header (columns 1-10) once for consecutive rows
+  sharing it and enters all their detail lines under that voucher.
+- Option: "Bỏ qua ô trùng dòng trước" skips pasting fields that Tabmis retains
+  (FIELD_CARRY_FORWARD) when the value equals the previous row's.
+- Row filter: e.g. "3=DV01; 5>=1000000; !done" keeps only matching rows of the range
+  (see parse_row_filter); "done" rows come from the result file/columns.
+- Watchdog: a step over 120 s escalates warn -> recovery macro -> skip row; a row over
+  15 min is skipped; 3 skipped rows in a row abort the run (--step-timeout/--row-timeout).
+- Readers: data files are read by stdlib csv, pandas, openpyxl read-only streaming or calamine
+  (if installed), chosen by file type, size and range (--reader); --bench data.csv compares them.
+- CSV index: large CSVs get a row-offset index (<data>.csv.rowidx, rebuilt when the file
+  changes); rows are then read straight from a memory map, so a small range starts at once.
+- Catalogs: code columns are checked against reference catalogs exported from Tabmis
+  (<data>.catalogs.json or --catalogs); rows with unknown codes go to <data>_failed.csv
+  before keying. Catalogs are hashed once and reloaded only when their file changes.
+- Shared queue: --queue shared.db --publish data.xlsx loads a job into SQLite on a shared
+  folder; each workstation running --queue shared.db leases batches of rows (BEGIN IMMEDIATE),
+  heartbeats them and marks them done/failed; expired leases are taken over by others.
+- Pause: "Tạm dừng" (or the Pause key) stops at the next step boundary and keeps the row and
+  step position; "Tiếp tục" refocuses the cached Tabmis window and continues from that step.
+- Loading: rows are read, formatted and filtered in chunks of 500 on a background thread
+  (two chunks buffered) while earlier rows are keyed, so keying starts after the first chunk.
+  With --results source the file is loaded up front so it is closed before it is rewritten.
+- Run log: --log run.jsonl writes one JSON line per step (row, column/key, value hash,
+  duration, outcome), per row and per status message from a background thread;
+  segments rotate by size and old ones are gzipped.
+- Results: each row's status (done/failed/stopped), times and voucher number are appended in
+  batches to <data>_result.csv by a background writer; with --results source they are merged
+  once into LKB_* columns of the source file at the end of the run (XLSX files with charts,
+  images or pivots that openpyxl would drop keep their results in <data>_result.csv). The
+  voucher number is read from the Tabmis title with --voucher-pattern (a regex with one group).
+- Trace: --trace run.json records every paste/press/hotkey/busy-wait/sleep with its
+  row and column as Chrome trace events (open in chrome://tracing or Perfetto).
+- Delay sweep: --sweep data.csv searches Delay_k/Delay_r and per-step delays on a latency
+  model (simulator or --latency-from a trace) and writes data.delays.json for --delay-profile.
+- Simulator: --simulate data.csv runs the row plan against TabmisSimulator (a local
+  model of the voucher form with save/busy latency) and reports mis-keyed fields.
+  --virtual runs it on a virtual clock: no real sleeping, same timing statistics.
+- Job API: --serve 8765 accepts jobs on http://127.0.0.1:8765 (POST /jobs, GET /events NDJSON,
+  POST /jobs/<id>/pause|resume|stop); jobs share one queue with the GUI. Every request needs
+  "Authorization: Bearer <token>" (--api-token / LKB_API_TOKEN, or a per-session token printed
+  at start), a localhost Host header and no Origin; POSTs must be application/json.
+- Hot-folder mode (no GUI): python lkb_auto_pywinauto_v2.py --watch <dir>
+  processes new CSV/XLSX files one by one and moves them to <dir>/done or <dir>/failed.
 
 Requires (Windows):
     pip install pywinauto pyperclip pandas
@@ -16,16 +67,52 @@ and sends Ctrl+V through pywinauto.send_keys.
 
 Copyright (c) lanpv@vst.gov.vn
 """
+import argparse
+import array
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
 import csv
+import datetime
+import functools
+import gc
+import gzip
+import hashlib
+import heapq
+import hmac
+import importlib.util
+import io
+import ipaddress
+import itertools
+import json
+import logging
+import logging.handlers
 import math
+import mmap
+import multiprocessing
 import os
+import queue
+import random
+import re
+import secrets
+import shutil
+import signal
+import socket
+import sqlite3
+import struct
+import sys
 import threading
 import time
+import zipfile
 import tkinter as tk
 from tkinter import filedialog, messagebox
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
 import platform
 import ctypes
 
+import numpy as np
 import pandas as pd
 import pyperclip
 
@@ -37,528 +124,5498 @@ except Exception:
     keyboard = None  # handled at runtime
     Application = None  # handled at runtime
 
+# Macro mặc định để đưa form Tabmis về trạng thái đã biết khi một dòng bị lỗi.
+# Mỗi phần tử là một phím ("esc") hoặc tổ hợp phím nối bằng "+" ("shift+pageup").
+DEFAULT_RESET_KEYS = ("esc", "f4")
+
+FAILED_ROWS_HEADER = ["row", "reason", "time"]
+
+DATA_EXTENSIONS = (".csv", ".xlsx", ".xls")
+
+
+def default_failed_rows_path(data_path):
+    """File ghi các dòng lỗi, đặt cạnh file dữ liệu: data.xlsx -> data_failed.csv"""
+    base = os.path.splitext(data_path)[0]
+    return f"{base}_failed.csv"
+
+
+def load_failed_rows(path):
+    """
+    Đọc file dòng lỗi và trả về danh sách số dòng (1-based, đã sắp xếp, không trùng)
+    để chạy lại như một job bình thường.
+    """
+    rows = set()
+    with open(path, newline='', encoding='utf-8') as f:
+        for rec in csv.reader(f):
+            if not rec or rec[0] == FAILED_ROWS_HEADER[0]:
+                continue
+            try:
+                rows.add(int(rec[0]))
+            except ValueError:
+                continue
+    return sorted(rows)
+
+
+# ---------- Column schema ----------
+# process_row dùng cột 1..18 của file dữ liệu; chỉ các cột này được định dạng và giữ lại.
+USED_COLUMNS = 18
+
+# Kiểu cột:
+#   "auto"   - số -> không có ".0"/dạng 1.5e+06, ngày -> date_format, còn lại là text
+#   "text"   - giữ nguyên chuỗi
+#   "number" - ép sang số; "decimals" cố định số chữ số thập phân, "thousands" dấu phân cách nghìn
+#   "date"   - ép sang ngày, in theo "date_format"
+# "trim" bỏ khoảng trắng đầu/cuối. Giá trị không ép được kiểu giữ nguyên dạng text.
+DEFAULT_COLUMN_SPEC = {"type": "auto", "trim": True, "date_format": "%d/%m/%Y"}
+
+
+def load_column_schema(source=None):
+    """
+    Trả về dict {cột 1-based: spec} cho USED_COLUMNS cột.
+    source: None (mặc định), dict, hoặc đường dẫn file JSON dạng
+        {"default": {"type": "auto"}, "5": {"type": "number", "decimals": 0}, "3": {"type": "date"}}
+    """
+    if source is None:
+        raw = {}
+    elif isinstance(source, dict):
+        raw = source
+    else:
+        with open(source, encoding='utf-8') as f:
+            raw = json.load(f)
+    default = dict(DEFAULT_COLUMN_SPEC)
+    default.update(raw.get("default", {}))
+    schema = {}
+    for col in range(1, USED_COLUMNS + 1):
+        spec = dict(default)
+        spec.update(raw.get(str(col), raw.get(col, {})))
+        schema[col] = spec
+    return schema
+
+
+def find_schema_file(data_path):
+    """Schema đi kèm file dữ liệu (data.xlsx -> data.schema.json) nếu có, ngược lại None."""
+    path = os.path.splitext(data_path)[0] + ".schema.json"
+    return path if os.path.exists(path) else None
+
+
+def _format_text(series, spec):
+    out = series.astype(object).where(series.notna(), "").astype(str)
+    if spec.get("trim", True):
+        out = out.str.strip()
+    return out
+
+
+def _format_numbers(nums, spec):
+    """nums: Series float (NaN = không phải số). Trả về Series str (NaN giữ nguyên để ghép sau)."""
+    decimals = spec.get("decimals")
+    sep = "," if spec.get("thousands") else ""
+    valid = nums.notna()
+    out = pd.Series(index=nums.index, dtype=object)
+    if decimals is not None:
+        fmt = "{:%s.%df}" % (sep, int(decimals))
+        out[valid] = nums[valid].map(fmt.format)
+        return out
+    integral = valid & (nums % 1 == 0)
+    out[integral] = nums[integral].map(("{:%s.0f}" % sep).format)
+    frac = valid & ~integral
+    if frac.any():
+        out[frac] = nums[frac].map(lambda x: np.format_float_positional(x, trim='-'))
+    return out
+
+
+def _format_series(series, spec):
+    """Định dạng cả một cột một lần (vectorized), trả về Series str sẵn sàng để dán."""
+    kind = spec.get("type", "auto")
+    text = _format_text(series, spec)
+    if kind == "text":
+        return text
+    if kind == "auto":
+        if pd.api.types.is_datetime64_any_dtype(series):
+            kind = "date"
+        elif pd.api.types.is_bool_dtype(series):
+            return text
+        elif pd.api.types.is_numeric_dtype(series):
+            kind = "number"
+        elif series.dtype == object:
+            # Cột Excel lẫn kiểu: chỉ định dạng các ô thực sự là số/ngày, ô text giữ nguyên
+            types = series.map(type)
+            is_num = types.isin((int, float, np.int64, np.float64))
+            is_date = types.isin((pd.Timestamp, datetime.datetime, datetime.date))
+            if is_num.any():
+                nums = pd.to_numeric(series.where(is_num), errors="coerce")
+                text = _format_numbers(nums, spec).where(is_num, text)
+            if is_date.any():
+                dates = pd.to_datetime(series.where(is_date), errors="coerce")
+                text = dates.dt.strftime(spec.get("date_format", "%d/%m/%Y")).where(is_date, text)
+            return text.where(text.notna(), "")
+        else:
+            return text
+    if kind == "number":
+        nums = pd.to_numeric(series.where(series.notna()), errors="coerce")
+        return _format_numbers(nums, spec).where(nums.notna(), text)
+    if kind == "date":
+        if pd.api.types.is_datetime64_any_dtype(series):
+            dates = series
+        else:
+            dates = pd.to_datetime(text.where(text != ""), errors="coerce",
+                                   dayfirst=spec.get("dayfirst", True), format=spec.get("input_format"))
+        out = dates.dt.strftime(spec.get("date_format", "%d/%m/%Y"))
+        return out.where(dates.notna(), text)
+    raise ValueError(f"Unknown column type: {kind}")
+
+
+def format_table(df, schema):
+    """
+    Áp dụng schema cho toàn bộ vùng dữ liệu đã chọn (df có cột 1..USED_COLUMNS),
+    mỗi cột một phép toán vectorized. Trả về DataFrame toàn chuỗi.
+    """
+    return pd.DataFrame({col: _format_series(df[col], schema[col]) for col in df.columns}, index=df.index)
+
+
+# ---------- Reference catalogs ----------
+# Danh mục tham chiếu xuất từ Tabmis (đoạn mã tài khoản, đơn vị dự toán...). <data>.catalogs.json
+# cạnh file dữ liệu ánh xạ cột -> file danh mục (CSV/XLSX, dòng 1 là tiêu đề), vd.
+#   {"3": "danhmuc/noi_dung_kt.csv", "5": {"path": "dvsdns.xlsx", "column": "Ma", "allow_empty": false}}
+# "column": tên hoặc số thứ tự (1-based) cột mã trong file danh mục, mặc định cột đầu;
+# "allow_empty" (mặc định true): ô trống không bị coi là sai mã.
+_CATALOG_CACHE = {}
+
+
+def normalize_codes(values):
+    """Chuẩn hóa mã để tra danh mục: chuỗi, bỏ khoảng trắng đầu/cuối, chữ hoa."""
+    return pd.Series(values, dtype=object).fillna("").astype(str).str.strip().str.upper()
+
+
+class ReferenceCatalog:
+    """
+    Tập mã của một danh mục, băm sẵn một lần trong pd.Index: contains() tra cả một cột trong một
+    phép get_indexer dùng lại bảng băm đó (Series.isin dựng lại bảng băm mỗi lần gọi).
+    """
+
+    def __init__(self, codes, name=""):
+        self.name = name
+        codes = normalize_codes(codes)
+        self.index = pd.Index(codes[codes != ""].unique())
+
+    def __len__(self):
+        return len(self.index)
+
+    def contains(self, values):
+        """Mảng bool: từng giá trị (sau normalize_codes) có trong danh mục hay không."""
+        return self.index.get_indexer(normalize_codes(values)) >= 0
+
+
+def load_catalog(path, column=None):
+    """
+    ReferenceCatalog từ file CSV/XLSX. Giữ trong bộ nhớ theo (đường dẫn, cột) và chỉ đọc lại khi
+    file danh mục đổi kích thước/mtime (vd. vừa xuất lại từ Tabmis).
+    """
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    sig = (st.st_size, st.st_mtime_ns)
+    key = (path, column)
+    cached = _CATALOG_CACHE.get(key)
+    if cached is not None and cached[0] == sig:
+        return cached[1]
+    if path.lower().endswith(".csv"):
+        df = pd.read_csv(path, dtype=str, keep_default_na=False, encoding="utf-8-sig")
+    else:
+        df = pd.read_excel(path, dtype=str)
+    if column is None:
+        codes = df.iloc[:, 0]
+    elif isinstance(column, int):
+        codes = df.iloc[:, column - 1]
+    else:
+        codes = df[column]
+    catalog = ReferenceCatalog(codes, os.path.basename(path))
+    _CATALOG_CACHE[key] = (sig, catalog)
+    return catalog
+
+
+def find_catalog_file(data_path):
+    """Spec danh mục đi kèm file dữ liệu (data.xlsx -> data.catalogs.json) nếu có, ngược lại None."""
+    path = os.path.splitext(data_path)[0] + ".catalogs.json"
+    return path if os.path.exists(path) else None
+
+
+class CatalogValidator:
+    """
+    Kiểm tra các cột mã của một vùng dòng đã định dạng với danh mục tham chiếu.
+    source: dict hoặc đường dẫn file JSON (xem đầu mục); đường dẫn danh mục tương đối tính từ
+    thư mục chứa file spec.
+    """
+
+    def __init__(self, source):
+        if isinstance(source, dict):
+            raw, base = source, os.getcwd()
+        else:
+            with open(source, encoding="utf-8") as f:
+                raw = json.load(f)
+            base = os.path.dirname(os.path.abspath(source))
+        self.columns = {}
+        for col, spec in raw.items():
+            if isinstance(spec, str):
+                spec = {"path": spec}
+            col = int(col)
+            if not 1 <= col <= USED_COLUMNS:
+                raise ValueError(f"Catalog column out of range: {col}")
+            self.columns[col] = (os.path.join(base, spec["path"]), spec.get("column"),
+                                 bool(spec.get("allow_empty", True)))
+
+    def invalid(self, table):
+        """{vị trí dòng: lý do} các dòng của table có mã ngoài danh mục."""
+        reasons = {}
+        for col, (path, column, allow_empty) in self.columns.items():
+            catalog = load_catalog(path, column)
+            values = table[col]
+            ok = catalog.contains(values)
+            if allow_empty:
+                ok |= (values.str.strip() == "").to_numpy()
+            for pos in np.flatnonzero(~ok):
+                reasons.setdefault(int(pos), []).append(
+                    f"cột {col} = {values.iloc[pos]!r} không có trong danh mục {catalog.name}")
+        return {pos: "; ".join(r) for pos, r in sorted(reasons.items())}
+
+
+def process_memory():
+    """
+    (bộ nhớ hiện tại, bộ nhớ đỉnh) của tiến trình tính bằng byte; (0, 0) nếu không đo được.
+    Windows dùng GetProcessMemoryInfo (working set), Linux dùng /proc (VmHWM, đặt lại được bằng
+    reset_peak_memory), hệ khác getrusage.
+    """
+    try:
+        if platform.system() == "Windows":
+            class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+                _fields_ = [
+                    ("cb", ctypes.c_ulong),
+                    ("PageFaultCount", ctypes.c_ulong),
+                    ("PeakWorkingSetSize", ctypes.c_size_t),
+                    ("WorkingSetSize", ctypes.c_size_t),
+                    ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                    ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                    ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                    ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                    ("PagefileUsage", ctypes.c_size_t),
+                    ("PeakPagefileUsage", ctypes.c_size_t),
+                ]
+            counters = PROCESS_MEMORY_COUNTERS()
+            counters.cb = ctypes.sizeof(PROCESS_MEMORY_COUNTERS)
+            handle = ctypes.windll.kernel32.GetCurrentProcess()
+            if not ctypes.windll.psapi.GetProcessMemoryInfo(handle, ctypes.byref(counters), counters.cb):
+                return 0, 0
+            return counters.WorkingSetSize, counters.PeakWorkingSetSize
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # KB trên Linux
+        current = 0
+        with open("/proc/self/statm") as f:
+            current = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        with contextlib.suppress(OSError, AttributeError):
+            with open("/proc/self/status") as f:
+                hwm = re.search(r"^VmHWM:\s+(\d+)\s+kB", f.read(), re.M)
+            if hwm:
+                peak = int(hwm.group(1)) * 1024
+        return current, peak
+    except Exception:
+        return 0, 0
+
+
+def reset_peak_memory():
+    """
+    Đặt bộ nhớ đỉnh (VmHWM) về mức hiện tại, Linux qua /proc/self/clear_refs. False nếu hệ không
+    hỗ trợ (Windows: PeakWorkingSetSize không đặt lại được, ru_maxrss tính cả đời tiến trình).
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def format_bytes(n):
+    n = float(n or 0)
+    for unit in ("B", "KB", "MB"):
+        if n < 1024:
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024
+    return f"{n:.1f} GB"
+
+
+# ---------- Result ledger ----------
+RESULT_COLUMNS = ["LKB_status", "LKB_started", "LKB_finished", "LKB_voucher", "LKB_error"]
+RESULT_SUFFIX = "_result.csv"
+
+
+def default_result_path(data_path):
+    """File kết quả đi kèm file dữ liệu: data.xlsx -> data_result.csv"""
+    return os.path.splitext(data_path)[0] + RESULT_SUFFIX
+
+
+# Phần của file XLSX mà openpyxl không đọc được nên mất khi mở rồi lưu lại file
+_XLSX_UNPRESERVED_PARTS = (
+    ("xl/charts/", "biểu đồ"), ("xl/media/", "hình ảnh"), ("xl/drawings/drawing", "hình vẽ"),
+    ("xl/pivotTables/", "pivot table"), ("xl/slicers/", "slicer"), ("xl/vbaProject.bin", "macro VBA"),
+    ("xl/activeX/", "ActiveX"), ("xl/ctrlProps/", "form control"),
+)
+
+
+def xlsx_unpreserved_parts(path):
+    """Các loại nội dung trong file XLSX sẽ mất nếu ghi lại file qua openpyxl (rỗng nếu không có)."""
+    with zipfile.ZipFile(path) as z:
+        names = z.namelist()
+    return [label for prefix, label in _XLSX_UNPRESERVED_PARTS if any(n.startswith(prefix) for n in names)]
+
+
+class ResultLedger:
+    """
+    Sổ kết quả từng dòng (trạng thái, thời điểm bắt đầu/kết thúc, số chứng từ, lỗi).
+    Giữ trong bộ nhớ, mỗi flush_every dòng giao một lô cho luồng ghi nền nối vào
+    <data>_result.csv (chỉ nối thêm, không ghi lại file): vòng nhập liệu không bị chặn bởi việc ghi file.
+
+    mode="sidecar": kết quả ở <data>_result.csv.
+    mode="source": trong lúc chạy sidecar là nhật ký; close() gộp một lần vào các cột LKB_*
+    của chính file nguồn (CSV ghi lại qua file tạm rồi thay thế; XLSX qua openpyxl để giữ định
+    dạng) rồi cắt nhật ký về như trước lần chạy. Không ghi được file nguồn (vd. đang mở trong
+    Excel) thì kết quả ở lại sidecar. Từ chối ngay từ đầu (dùng sidecar, last_error ghi lý do)
+    với file không phải CSV/XLSX và XLSX có nội dung openpyxl làm mất (xem xlsx_unpreserved_parts).
+    """
+
+    def __init__(self, data_path, mode="sidecar", flush_every=50):
+        if mode not in ("sidecar", "source"):
+            raise ValueError("mode must be 'sidecar' or 'source'")
+        self.data_path = data_path
+        self.mode = mode
+        self.flush_every = max(1, int(flush_every))
+        self.sidecar_path = default_result_path(data_path)
+        self._pending = []
+        self._written = {}   # row -> record, cho chế độ source (gộp vào file nguồn khi close)
+        self._queue = None
+        self._writer = None
+        self._journal_size = None   # kích thước sidecar trước lần ghi đầu (-1: chưa có file)
+        self._append_error = None
+        self.flushes = 0
+        self.last_error = None
+        self.fell_back = False   # gộp vào file nguồn lỗi khi close: kết quả ở lại sidecar
+        if mode == "source":
+            self.last_error = self._source_refusal()
+            if self.last_error is not None:
+                self.mode = "sidecar"
+
+    def _source_refusal(self):
+        ext = os.path.splitext(self.data_path)[1].lower()
+        if ext == ".csv":
+            return None
+        if ext != ".xlsx":
+            return ValueError(f"Không ghi ngược được vào file {ext}")
+        try:
+            lost = xlsx_unpreserved_parts(self.data_path)
+        except (OSError, zipfile.BadZipFile) as e:
+            return e
+        if lost:
+            return ValueError(f"file có {', '.join(lost)} sẽ bị mất khi ghi lại qua openpyxl")
+        return None
+
+    def record(self, row_number, status, started, finished, voucher="", error=""):
+        self._pending.append([
+            row_number, status,
+            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(started)),
+            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(finished)),
+            voucher or "", str(error) if error else "",
+        ])
+        if len(self._pending) >= self.flush_every:
+            self._submit()
+
+    def _submit(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        if self.mode == "source":
+            for rec in batch:
+                self._written[rec[0]] = rec
+        if self._writer is None:
+            self._queue = queue.Queue()
+            self._writer = threading.Thread(target=self._write_loop, name="lkb-ledger", daemon=True)
+            self._writer.start()
+        self._queue.put(batch)
+
+    def _write_loop(self):
+        unwritten = []
+        while True:
+            batch = self._queue.get()
+            try:
+                if batch is None:
+                    return
+                unwritten.extend(batch)
+                try:
+                    if self._journal_size is None:
+                        exists = os.path.exists(self.sidecar_path)
+                        self._journal_size = os.path.getsize(self.sidecar_path) if exists else -1
+                    self._append_sidecar(unwritten)
+                    unwritten = []
+                    self.flushes += 1
+                    self._append_error = None
+                except OSError as e:
+                    # Giữ lại, ghi cùng lô sau (vd. sidecar đang mở trong Excel)
+                    self._append_error = e
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """Giao các bản ghi đang chờ cho luồng ghi và chờ ghi xong. Trả về False nếu chưa ghi được."""
+        self._submit()
+        if self._queue is not None:
+            self._queue.join()
+        return self._append_error is None
+
+    def close(self):
+        """
+        Kết thúc lần chạy: ghi nốt, dừng luồng ghi; mode="source" thì gộp kết quả vào file nguồn.
+        Trả về False nếu có kết quả không ghi được vào nơi đã chọn (last_error ghi lý do).
+        """
+        ok = self.flush()
+        if self._writer is not None:
+            self._queue.put(None)
+            self._writer.join()
+            self._writer = self._queue = None
+        if self.mode != "source" or not self._written:
+            if not ok:
+                self.last_error = self._append_error
+            return ok
+        try:
+            if os.path.splitext(self.data_path)[1].lower() == ".csv":
+                self._write_csv_source()
+            else:
+                self._write_xlsx_source()
+        except Exception as e:
+            self.last_error = e
+            self.mode = "sidecar"
+            self.fell_back = True
+            return False
+        self._truncate_journal()
+        return True
+
+    def _truncate_journal(self):
+        """Đã gộp vào file nguồn: bỏ phần nhật ký lần chạy này đã nối vào sidecar."""
+        try:
+            if self._journal_size == -1:
+                os.remove(self.sidecar_path)
+            elif self._journal_size is not None:
+                with open(self.sidecar_path, "r+b") as f:
+                    f.truncate(self._journal_size)
+        except OSError:
+            pass
+        self._journal_size = None
+
+    def _append_sidecar(self, records):
+        new_file = not os.path.exists(self.sidecar_path)
+        with open(self.sidecar_path, "a", newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            if new_file:
+                writer.writerow(["row"] + RESULT_COLUMNS)
+            writer.writerows(records)
+
+    @staticmethod
+    def _result_col(header, width):
+        """
+        Cột (0-based) bắt đầu các cột LKB_*: dùng lại nếu header đã có, ngược lại thêm sau cùng
+        (không bao giờ nằm trong USED_COLUMNS cột dữ liệu được nhập vào Tabmis).
+        """
+        for idx, name in enumerate(header):
+            if name == RESULT_COLUMNS[0]:
+                return idx
+        return max(width, USED_COLUMNS)
+
+    def _write_csv_source(self):
+        with open(self.data_path, newline='', encoding='utf-8') as f:
+            rows = list(csv.reader(f))
+        width = max((len(r) for r in rows), default=0)
+        col = self._result_col(rows[0] if rows else [], width)
+        end = col + len(RESULT_COLUMNS)
+        for n, rec in self._written.items():
+            if 1 <= n <= len(rows):
+                r = rows[n - 1]
+                if len(r) < end:
+                    r.extend([""] * (end - len(r)))
+                r[col:end] = rec[1:]
+        if rows and 1 not in self._written:
+            r = rows[0]
+            if len(r) < end:
+                r.extend([""] * (end - len(r)))
+            r[col:end] = RESULT_COLUMNS
+        tmp = self.data_path + ".tmp"
+        with open(tmp, "w", newline='', encoding='utf-8') as f:
+            csv.writer(f).writerows(rows)
+        os.replace(tmp, self.data_path)
+
+    def _write_xlsx_source(self):
+        import openpyxl
+        wb = openpyxl.load_workbook(self.data_path)
+        ws = wb.worksheets[0]
+        header = [c.value for c in ws[1]] if ws.max_row >= 1 else []
+        col = self._result_col(header, ws.max_column) + 1  # openpyxl 1-based
+        if 1 not in self._written:
+            for k, name in enumerate(RESULT_COLUMNS):
+                ws.cell(row=1, column=col + k, value=name)
+        for n, rec in self._written.items():
+            for k, value in enumerate(rec[1:]):
+                ws.cell(row=n, column=col + k, value=value)
+        wb.save(self.data_path)
+
+
+# ---------- Row filters ----------
+# Biểu thức lọc dòng: các mệnh đề cách nhau bởi ";" , tất cả phải đúng. Mỗi mệnh đề:
+#   <cột> = | != | < | <= | > | >= <giá trị>     vd. 3=DVQHNS01 ; 5>=1000000 ; 4<31/12/2024
+#   <cột> in (a, b, c)  /  <cột> not in (a, b)
+# <cột> là số cột (1-based, có thể viết c3/col3), tên cột ở dòng 1, hoặc "status": trạng thái
+# đã ghi của dòng (done/failed, từ <data>_result.csv hoặc cột LKB_status của file nguồn).
+# "done" / "!done" là viết tắt của status=done / status!=done.
+_FILTER_CLAUSE_RE = re.compile(
+    r"^\s*(?P<col>.+?)\s*(?P<op>\s+not\s+in\s+|\s+in\s+|==|!=|<=|>=|=|<|>)\s*(?P<value>.*?)\s*$", re.I)
+
+
+def _filter_values(text):
+    text = text.strip()
+    if text.startswith("(") and text.endswith(")"):
+        text = text[1:-1]
+    return [v.strip().strip("'\"") for v in text.split(",") if v.strip()]
+
+
+def parse_row_filter(text, header=None):
+    """
+    Biểu thức lọc -> list (cột, phép so sánh, giá trị). cột là số 1-based hoặc "status";
+    giá trị là chuỗi, hoặc list chuỗi với in/not in. header: tên các cột ở dòng 1 (tùy chọn).
+    """
+    names = {str(h).strip().lower(): k for k, h in enumerate(header or [], 1) if str(h).strip()}
+    predicates = []
+    for clause in (text or "").split(";"):
+        clause = clause.strip()
+        if not clause:
+            continue
+        if clause.lower() in ("done", "!done", "not done"):
+            predicates.append(("status", "=" if clause.lower() == "done" else "!=", "done"))
+            continue
+        m = _FILTER_CLAUSE_RE.match(clause)
+        if not m:
+            raise ValueError(f"Bad filter clause: {clause!r}")
+        col, op = m.group("col").strip(), " ".join(m.group("op").lower().split())
+        key = col.lower()
+        if key == "status":
+            col = "status"
+        elif re.fullmatch(r"(?:c|col)?\d+", key):
+            col = int(re.sub(r"\D", "", key))
+        elif key in names:
+            col = names[key]
+        else:
+            raise ValueError(f"Unknown filter column: {col!r}")
+        if col != "status" and not 1 <= col <= USED_COLUMNS:
+            raise ValueError(f"Filter column out of range 1..{USED_COLUMNS}: {col}")
+        op = "=" if op == "==" else op
+        value = _filter_values(m.group("value")) if op in ("in", "not in") else m.group("value").strip("'\"")
+        predicates.append((col, op, value))
+    return predicates
+
+
+def _compare(series, op, value):
+    """
+    So sánh vectorized một cột với giá trị: bằng/in trên chuỗi đã định dạng, khoảng theo số,
+    ngày (dd/mm/yyyy) hoặc chuỗi.
+    """
+    if op == "=":
+        return series.eq(value)
+    if op == "!=":
+        return series.ne(value)
+    if op == "in":
+        return series.isin(value)
+    if op == "not in":
+        return ~series.isin(value)
+    number = pd.to_numeric(pd.Series([value]), errors="coerce")[0]
+    if not pd.isna(number):
+        left, right = pd.to_numeric(series, errors="coerce"), number
+    else:
+        right = pd.to_datetime(value, dayfirst=True, errors="coerce")
+        if not pd.isna(right):
+            left = series if pd.api.types.is_datetime64_any_dtype(series) else \
+                pd.to_datetime(series, dayfirst=True, errors="coerce")
+        else:
+            left, right = series.astype(str), value
+    result = {"<": left < right, "<=": left <= right, ">": left > right, ">=": left >= right}[op]
+    # Ô không đọc được thành số/ngày thì không thỏa điều kiện khoảng
+    return result.fillna(False) if hasattr(result, "fillna") else result
+
+
+def filter_positions(raw, table, numbers, predicates, statuses=None):
+    """
+    Vị trí (mảng int tăng dần) các dòng thỏa mọi mệnh đề. raw: giá trị gốc (so khoảng số/ngày),
+    table: giá trị đã định dạng như sẽ nhập (so bằng/in), numbers: số dòng, statuses: {dòng: trạng thái}.
+    """
+    mask = np.ones(len(table), dtype=bool)
+    numbers = np.asarray(numbers)
+    for col, op, value in predicates:
+        if col == "status":
+            wanted = set(value) if op in ("in", "not in") else {value}
+            if op not in ("=", "!=", "in", "not in"):
+                raise ValueError(f"Unsupported operator for status: {op}")
+            hits = np.isin(numbers, [n for n, st in (statuses or {}).items() if st in wanted])
+            mask &= ~hits if op in ("!=", "not in") else hits
+            continue
+        if op in ("=", "!=", "in", "not in"):
+            series = table[col]
+        else:
+            series = raw[col]
+        mask &= np.asarray(_compare(series, op, value), dtype=bool)
+    return np.flatnonzero(mask)
+
+
+def read_header(data_path):
+    """Dòng 1 của file dữ liệu (tên cột), chuỗi."""
+    ext = os.path.splitext(data_path)[1].lower()
+    if ext == ".csv":
+        with open(data_path, newline='', encoding='utf-8') as f:
+            return next(csv.reader(f), [])
+    df = pd.read_excel(data_path, header=None, nrows=1)
+    return ["" if pd.isna(v) else str(v) for v in df.iloc[0]] if len(df) else []
+
+
+def load_row_status(data_path):
+    """
+    Trạng thái đã ghi của từng dòng {số dòng: "done"/"failed"}: cột LKB_status của file nguồn
+    (nếu có) rồi <data>_result.csv (bản ghi sau cùng thắng).
+    """
+    statuses = {}
+    header = read_header(data_path)
+    if RESULT_COLUMNS[0] in header:
+        idx = header.index(RESULT_COLUMNS[0])
+        if os.path.splitext(data_path)[1].lower() == ".csv":
+            # csv.reader như reader "csv": dòng thiếu/thừa cột (file bị sửa tay) không làm hỏng cả lần đọc
+            with open(data_path, newline='', encoding='utf-8') as f:
+                col = [rec[idx] if len(rec) > idx else "" for rec in csv.reader(f)]
+        else:
+            col = pd.read_excel(data_path, header=None, usecols=[idx], dtype=str)[idx].fillna("")
+        statuses.update({n: v for n, v in zip(range(1, len(col) + 1), col) if n > 1 and v})
+    sidecar = default_result_path(data_path)
+    if os.path.exists(sidecar):
+        res = pd.read_csv(sidecar, usecols=["row", RESULT_COLUMNS[0]], dtype={"row": int}, keep_default_na=False)
+        statuses.update(zip(res["row"], res[RESULT_COLUMNS[0]]))
+    return statuses
+
+
+# ---------- Trace (Chrome trace-event JSON) ----------
+DEFAULT_TRACE_CAPACITY = 200_000
+
+
+class TraceRecorder:
+    """
+    Ghi các khoảng thời gian (paste, press, hotkey, chờ con trỏ, sleep, dòng) vào bộ đệm vòng
+    cấp phát sẵn capacity phần tử: chạy 10 tiếng bộ nhớ vẫn không đổi, chỉ giữ capacity
+    sự kiện gần nhất (số bị đè ghi ở "dropped").
+    write() xuất Chrome trace-event JSON (sự kiện "X" có ts/dur, args row/col/detail).
+    """
+
+    def __init__(self, capacity=DEFAULT_TRACE_CAPACITY, clock=time.perf_counter):
+        self.capacity = max(1, int(capacity))
+        self.clock = clock
+        self._names = [None] * self.capacity
+        self._rows = [None] * self.capacity
+        self._cols = [None] * self.capacity
+        self._details = [None] * self.capacity
+        self._starts = array.array("d", bytes(8 * self.capacity))
+        self._durs = array.array("d", bytes(8 * self.capacity))
+        self._tids = array.array("q", bytes(8 * self.capacity))
+        self._count = 0
+        self._lock = threading.Lock()
+        self._origin = clock()
+        # Ngữ cảnh hiện tại, do vòng chạy đặt: dòng đang nhập và cột đang dán
+        self.row = None
+        self.col = None
+
+    def now(self):
+        return self.clock()
+
+    @property
+    def dropped(self):
+        return max(0, self._count - self.capacity)
+
+    def __len__(self):
+        return min(self._count, self.capacity)
+
+    def add(self, name, start, end, detail=None, row=None, col=None):
+        with self._lock:
+            k = self._count % self.capacity
+            self._count += 1
+        self._names[k] = name
+        self._starts[k] = start
+        self._durs[k] = end - start
+        self._tids[k] = threading.get_ident()
+        self._rows[k] = self.row if row is None else row
+        self._cols[k] = self.col if col is None else col
+        self._details[k] = detail
+
+    @contextlib.contextmanager
+    def span(self, name, detail=None):
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.add(name, start, self.clock(), detail)
+
+    def clear(self):
+        with self._lock:
+            self._count = 0
+
+    def events(self):
+        """Các sự kiện còn trong bộ đệm, theo thứ tự ghi."""
+        n = len(self)
+        first = self._count - n
+        for j in range(first, self._count):
+            k = j % self.capacity
+            yield (self._names[k], self._starts[k], self._durs[k], self._tids[k],
+                   self._rows[k], self._cols[k], self._details[k])
+
+    def to_chrome(self):
+        pid = os.getpid()
+        out = [{"name": "process_name", "ph": "M", "pid": pid, "tid": 0, "args": {"name": "LKB Auto"}}]
+        for name, start, dur, tid, row, col, detail in self.events():
+            args = {}
+            if row is not None:
+                args["row"] = row
+            if col is not None:
+                args["col"] = col
+            if detail is not None:
+                args["detail"] = detail
+            out.append({"name": name, "cat": "lkb", "ph": "X", "pid": pid, "tid": tid,
+                        "ts": round((start - self._origin) * 1e6, 1),
+                        "dur": round(dur * 1e6, 1), "args": args})
+        return {"traceEvents": out, "displayTimeUnit": "ms",
+                "otherData": {"capacity": self.capacity, "dropped": self.dropped}}
+
+    def write(self, path):
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.to_chrome(), f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+
+def _traced(name, detail=None):
+    """
+    Bọc một method của TabmisAutomator: khi có self.tracer thì ghi một khoảng `name`
+    (detail(*args) làm thuộc tính phụ); không có tracer thì gọi thẳng.
+    """
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            tracer = self.tracer
+            if tracer is None:
+                return func(self, *args, **kwargs)
+            start = tracer.clock()
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                tracer.add(name, start, tracer.clock(), detail(*args) if detail else None)
+        return wrapper
+    return decorate
+
+
+# ---------- Run log (JSON lines) ----------
+DEFAULT_RUN_LOG_BYTES = 10 * 1024 * 1024
+DEFAULT_RUN_LOG_BACKUPS = 10
+
+
+def value_digest(value):
+    """Băm ngắn của giá trị ô: đối chiếu được giữa các lần chạy mà không ghi dữ liệu thật vào log."""
+    return hashlib.blake2b(str(value).encode("utf-8"), digest_size=8).hexdigest()
+
+
+class JsonLineFormatter(logging.Formatter):
+    """Mỗi bản ghi một dòng JSON: ts, level, event (thông điệp) và các trường trong record.fields."""
+
+    def format(self, record):
+        event = {"ts": round(record.created, 6), "level": record.levelname.lower(), "event": record.getMessage()}
+        event.update(getattr(record, "fields", None) or {})
+        return json.dumps(event, ensure_ascii=False, default=str)
+
+
+class GzipRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """RotatingFileHandler nén các đoạn cũ: run.jsonl -> run.jsonl.1.gz, run.jsonl.2.gz..."""
+
+    def __init__(self, path, max_bytes=DEFAULT_RUN_LOG_BYTES, backups=DEFAULT_RUN_LOG_BACKUPS):
+        super().__init__(path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8")
+        self.namer = lambda name: name + ".gz"
+        self.rotator = self._gzip_rotate
+
+    @staticmethod
+    def _gzip_rotate(source, dest):
+        with open(source, "rb") as src, gzip.open(dest, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(source)
+
+
+class RunLog:
+    """
+    Nhật ký chạy dạng JSON lines: bước (dòng, cột/phím, băm giá trị, thời gian, kết quả),
+    đơn vị (trạng thái, số chứng từ, lỗi), thông báo trạng thái, watchdog, bắt đầu/kết thúc chạy.
+    Vòng chạy chỉ đẩy bản ghi vào hàng đợi (QueueHandler); QueueListener trên luồng nền định dạng
+    và ghi đĩa, xoay vòng theo kích thước (max_bytes) và nén gzip các đoạn cũ (giữ backups đoạn).
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_RUN_LOG_BYTES, backups=DEFAULT_RUN_LOG_BACKUPS):
+        self.path = path
+        self.queue = queue.SimpleQueue()
+        self.handler = GzipRotatingFileHandler(path, max_bytes, backups)
+        self.handler.setFormatter(JsonLineFormatter())
+        self.logger = logging.getLogger(f"lkb.run.{id(self)}")
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self._queue_handler = logging.handlers.QueueHandler(self.queue)
+        self.logger.addHandler(self._queue_handler)
+        self.listener = logging.handlers.QueueListener(self.queue, self.handler)
+        self.listener.start()
+
+    def event(self, name, level=logging.INFO, **fields):
+        self.logger.log(level, name, extra={"fields": fields})
+
+    def step(self, row, step, seconds, outcome="ok"):
+        fields = {"row": row, "kind": step[0], "ms": round(seconds * 1000.0, 3), "outcome": outcome}
+        if step[0] == "paste":
+            fields["col"] = step[1]
+            fields["value"] = value_digest(step[2])
+        else:
+            fields["key"] = (step[1] if step[0] == "press"
+                             else " ".join(step[1]) if step[0] == "keys" else "+".join(step[1]))
+        self.logger.log(logging.INFO if outcome == "ok" else logging.WARNING, "step", extra={"fields": fields})
+
+    def status_callback(self, callback=None):
+        """Bọc status_callback: mỗi thông báo trạng thái cũng thành một sự kiện "status"."""
+        def logged(text):
+            self.event("status", text=text)
+            if callback:
+                callback(text)
+        return logged
+
+    def close(self):
+        """Ghi nốt các bản ghi còn trong hàng đợi rồi đóng file."""
+        self.listener.stop()
+        self.logger.removeHandler(self._queue_handler)
+        self.handler.close()
+
+
+# ---------- Row store ----------
+class RowStore:
+    """
+    Kho dòng dạng cột, gọn cho file lớn: chỉ giữ USED_COLUMNS cột, mỗi cột là một tuple
+    chuỗi đã sys.intern (các giá trị lặp lại như mã đơn vị, tài khoản chỉ tốn một bản).
+    store[k] trả về RowView truy cập O(1) tới ô, dùng được với get_cell như list cũ.
+    Duyệt store cho ra (số dòng 1-based, RowView).
+    """
+    __slots__ = ("columns", "row_numbers")
+
+    def __init__(self, columns, row_numbers):
+        self.columns = columns
+        self.row_numbers = row_numbers
+
+    @classmethod
+    def from_frame(cls, df, row_numbers):
+        """df: DataFrame chuỗi đã định dạng, cột 1..USED_COLUMNS, cùng thứ tự row_numbers."""
+        intern = sys.intern
+        columns = tuple(tuple(map(intern, df[c].tolist())) for c in df.columns)
+        return cls(columns, tuple(row_numbers))
+
+    def __len__(self):
+        return len(self.row_numbers)
+
+    def __getitem__(self, k):
+        return RowView(self, k)
+
+    def __iter__(self):
+        for k, n in enumerate(self.row_numbers):
+            yield n, RowView(self, k)
+
+    def memory_bytes(self):
+        """Ước lượng bộ nhớ thường trú: các tuple cột + mỗi chuỗi duy nhất tính một lần."""
+        total = sys.getsizeof(self.columns) + sys.getsizeof(self.row_numbers)
+        total += sum(map(sys.getsizeof, self.columns))
+        # Chuỗi đã intern: các giá trị bằng nhau là cùng một object nên set() đếm đúng một lần
+        total += sum(map(sys.getsizeof, set().union(*self.columns)))
+        return total
+
+
+class RowView:
+    """Một dòng của RowStore, không copy dữ liệu."""
+    __slots__ = ("_store", "_k")
+
+    def __init__(self, store, k):
+        self._store = store
+        self._k = k
+
+    def __len__(self):
+        return len(self._store.columns)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [col[self._k] for col in self._store.columns[idx]]
+        return self._store.columns[idx][self._k]
+
+    def __iter__(self):
+        k = self._k
+        for col in self._store.columns:
+            yield col[k]
+
+    def __repr__(self):
+        return f"RowView({list(self)!r})"
+
+
+# ---------- CSV row index ----------
+# Sidecar <data>.csv.rowidx: header (magic, kích thước, mtime_ns của file CSV, số phần tử) rồi
+# N+1 offset int64: bản ghi n (1-based) nằm ở byte [offset[n-1], offset[n]) của file.
+CSV_INDEX_SUFFIX = ".rowidx"
+CSV_INDEX_MAGIC = b"LKBROWS1"
+CSV_INDEX_MIN_BYTES = 32 * 1024 * 1024
+CSV_INDEX_BLOCK = 16 * 1024 * 1024
+_CSV_INDEX_HEADER = struct.Struct("<8sqqq")
+
+
+def csv_index_path(data_path):
+    return data_path + CSV_INDEX_SUFFIX
+
+
+def _scan_record_starts(f, block_size=CSV_INDEX_BLOCK):
+    """
+    Offset đầu mỗi bản ghi CSV (và offset cuối file), vectorized theo khối bằng numpy: dấu xuống
+    dòng có số dấu " phía trước chẵn (ngoài ngoặc kép) kết thúc một bản ghi; "" trong ô vẫn giữ
+    đúng tính chẵn lẻ. Dấu " mở hợp lệ ở đầu ô hoặc ngay sau dấu " đóng (cặp "" trong ô);
+    trả về None nếu có dấu " mở giữa ô (file không theo chuẩn Excel/csv).
+    """
+    parts = [np.zeros(1, dtype=np.int64)]
+    quotes = 0      # số dấu " đã gặp: chẵn = đang ngoài ngoặc kép
+    prev = 10       # byte ngay trước khối ("\n" = đầu file)
+    pos = 0
+    while True:
+        block = f.read(block_size)
+        if not block:
+            break
+        buf = np.frombuffer(block, dtype=np.uint8)
+        qpos = np.flatnonzero(buf == 34)
+        if len(qpos):
+            opening = qpos[(quotes + np.arange(len(qpos))) % 2 == 0]
+            before = np.where(opening > 0, buf[opening - 1], prev)
+            ok = np.isin(before, (44, 10, 13, 34))
+            if pos == 0 and block.startswith(b"\xef\xbb\xbf"):
+                ok |= opening == 3
+            if not ok.all():
+                return None
+        nl = np.flatnonzero(buf == 10)
+        if len(nl):
+            outside = (quotes + np.searchsorted(qpos, nl)) % 2 == 0
+            parts.append(nl[outside].astype(np.int64) + (pos + 1))
+        quotes += len(qpos)
+        prev = block[-1]
+        pos += len(block)
+    starts = np.concatenate(parts)
+    if starts[-1] != pos:
+        # Bản ghi cuối không có xuống dòng
+        starts = np.append(starts, pos)
+    return starts
+
+
+def _exact_record_starts(f):
+    """Như _scan_record_starts nhưng đi qua csv.reader (đúng cả với file không chuẩn), chậm hơn."""
+    offsets = array.array("q", [0])
+    pos = 0
+
+    def lines():
+        nonlocal pos
+        for line in f:
+            pos += len(line)
+            yield line.decode("utf-8")
+
+    for _ in csv.reader(lines()):
+        offsets.append(pos)
+    if offsets[-1] != pos:
+        offsets.append(pos)
+    return np.frombuffer(offsets, dtype=np.int64)
+
+
+def build_csv_index(data_path):
+    """Dựng mảng offset bản ghi của file CSV trong một lượt đọc streaming."""
+    with open(data_path, "rb") as f:
+        starts = _scan_record_starts(f)
+        if starts is None:
+            f.seek(0)
+            starts = _exact_record_starts(f)
+    return starts
+
+
+def load_csv_index(data_path, build=True):
+    """
+    (offset, (kích thước, mtime_ns)) của file CSV: sidecar <data>.csv.rowidx được memory-map nếu còn
+    khớp kích thước/mtime của file; ngược lại dựng lại và ghi sidecar (không ghi được thì dùng bản
+    trong bộ nhớ). build=False: None nếu chưa có index hợp lệ.
+    """
+    st = os.stat(data_path)
+    sig = (st.st_size, st.st_mtime_ns)
+    path = csv_index_path(data_path)
+    try:
+        with open(path, "rb") as f:
+            magic, size, mtime_ns, count = _CSV_INDEX_HEADER.unpack(f.read(_CSV_INDEX_HEADER.size))
+        if magic == CSV_INDEX_MAGIC and (size, mtime_ns) == sig:
+            offsets = np.memmap(path, dtype="<i8", mode="r", offset=_CSV_INDEX_HEADER.size, shape=(count,))
+            return offsets, sig
+    except (OSError, ValueError, struct.error):
+        pass
+    if not build:
+        return None
+    offsets = build_csv_index(data_path)
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(_CSV_INDEX_HEADER.pack(CSV_INDEX_MAGIC, sig[0], sig[1], len(offsets)))
+            offsets.astype("<i8").tofile(f)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+    return offsets, sig
+
+
+# ---------- Data readers ----------
+# Mỗi reader: available() và iter_chunks(file, dòng đầu, dòng cuối hoặc None, số dòng mỗi khối)
+# cho ra (list số dòng 1-based, DataFrame cột 1..USED_COLUMNS). select_reader chọn tự động.
+# Khối từ CSV_BULK_MIN_CHUNK dòng trở lên coi như nạp hết một lần: đọc tuần tự bằng csv.reader
+# (dựng index tốn thêm một lượt đọc). select_reader không tự chọn pandas: tốc độ parser C đổi
+# theo phiên bản pandas/máy (có máy chậm hơn csv.reader một nửa), csv.reader ổn định; pandas chỉ
+# dùng khi chọn rõ (--reader pandas, đo bằng --bench).
+CSV_BULK_MIN_CHUNK = 5_000
+BENCH_CHUNK_ROWS = 50_000
+
+
+def _module_available(name):
+    try:
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
+
+
+class CsvReader:
+    """
+    stdlib csv.reader, đọc streaming và dừng ngay sau dòng cuối. Đúng với mọi file hợp lệ:
+    ô nhiều dòng trong ngoặc kép, dòng thiếu hoặc thừa cột, dòng trống.
+    """
+    name = "csv"
+    extensions = (".csv",)
+
+    def available(self):
+        return True
+
+    def iter_chunks(self, data_path, first, last, chunk_rows):
+        cols = list(range(1, USED_COLUMNS + 1))
+        with open(data_path, newline='', encoding='utf-8') as f:
+            numbers, records = [], []
+            for n, rec in enumerate(csv.reader(f), 1):
+                if last is not None and n > last:
+                    break
+                if n < first:
+                    continue
+                if len(rec) < USED_COLUMNS:
+                    rec = rec + [""] * (USED_COLUMNS - len(rec))
+                numbers.append(n)
+                records.append(rec[:USED_COLUMNS])
+                if len(records) >= chunk_rows:
+                    yield numbers, pd.DataFrame(records, columns=cols, dtype=object)
+                    numbers, records = [], []
+            if records:
+                yield numbers, pd.DataFrame(records, columns=cols, dtype=object)
+
+
+class IndexedCsvReader:
+    """
+    CSV qua index offset bản ghi (load_csv_index): mmap file và cắt thẳng đoạn byte của các dòng
+    cần lấy, chỉ phân tích các dòng đó. Chạy lại một vùng nhỏ của file CSV lớn bắt đầu gần như
+    tức thì; lần đầu dựng index trong một lượt đọc rồi lưu cạnh file. File đổi sau khi dựng index
+    (vd. ghi kết quả vào file nguồn) thì đọc tiếp bằng CsvReader.
+    """
+    name = "csv-index"
+    extensions = (".csv",)
+
+    def available(self):
+        return True
+
+    @staticmethod
+    def _records(data_path, offsets, sig, a, b):
+        """Bản ghi a..b (1-based); None nếu file không còn khớp index."""
+        with open(data_path, "rb") as f:
+            st = os.fstat(f.fileno())
+            if (st.st_size, st.st_mtime_ns) != sig:
+                return None
+            start, end = int(offsets[a - 1]), int(offsets[b])
+            if end <= start:
+                return [[] for _ in range(b - a + 1)]
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                text = mm[start:end].decode("utf-8")
+        records = list(csv.reader(io.StringIO(text, newline="")))
+        return records if len(records) == b - a + 1 else None
+
+    @staticmethod
+    def _frame(records):
+        cols = list(range(1, USED_COLUMNS + 1))
+        rows = [rec[:USED_COLUMNS] if len(rec) >= USED_COLUMNS else rec + [""] * (USED_COLUMNS - len(rec))
+                for rec in records]
+        return pd.DataFrame(rows, columns=cols, dtype=object)
+
+    def iter_chunks(self, data_path, first, last, chunk_rows):
+        offsets, sig = load_csv_index(data_path)
+        total = len(offsets) - 1
+        end = total if last is None else min(last, total)
+        n = max(first, 1)
+        while n <= end:
+            b = min(end, n + chunk_rows - 1)
+            records = self._records(data_path, offsets, sig, n, b)
+            if records is None:
+                yield from CsvReader().iter_chunks(data_path, n, last, chunk_rows)
+                return
+            yield list(range(n, b + 1)), self._frame(records)
+            n = b + 1
+
+    def read_rows(self, data_path, numbers):
+        """(số dòng có trong file, DataFrame) cho các dòng rời rạc numbers: mỗi đoạn liền nhau một lần cắt."""
+        offsets, sig = load_csv_index(data_path)
+        total = len(offsets) - 1
+        wanted = sorted({n for n in numbers if 1 <= n <= total})
+        found, records = [], []
+        for _, run in itertools.groupby(enumerate(wanted), key=lambda it: it[1] - it[0]):
+            run = [n for _, n in run]
+            part = self._records(data_path, offsets, sig, run[0], run[-1])
+            if part is None:
+                raise ValueError(f"{data_path} changed while reading")
+            found.extend(run)
+            records.extend(part)
+        return found, self._frame(records)
+
+
+class PandasCsvReader:
+    """
+    pandas.read_csv (parser C) theo khối chunksize: nhanh hơn csv.reader khi đọc khối lớn.
+    Số cột lấy theo dòng 1; gặp dòng dài hơn (parser C báo lỗi) thì đọc tiếp từ khối đó bằng CsvReader.
+    """
+    name = "pandas"
+    extensions = (".csv",)
+
+    def available(self):
+        return True
+
+    def iter_chunks(self, data_path, first, last, chunk_rows):
+        cols = list(range(1, USED_COLUMNS + 1))
+        width = max(USED_COLUMNS, len(read_header(data_path)))
+        # skiprows/nrows tính theo bản ghi CSV (ô nhiều dòng vẫn là một dòng), giữ dòng trống
+        # để số dòng khớp csv.reader
+        reader = pd.read_csv(
+            data_path, header=None, names=range(width), dtype=str, keep_default_na=False,
+            skip_blank_lines=False, encoding="utf-8", skiprows=max(first - 1, 0),
+            nrows=(last - first + 1) if last is not None else None, chunksize=chunk_rows,
+        )
+        n = first
+        with reader:
+            try:
+                for part in reader:
+                    part = part.iloc[:, :USED_COLUMNS].fillna("")
+                    part.columns = cols
+                    numbers = list(range(n, n + len(part)))
+                    n += len(part)
+                    yield numbers, part.reset_index(drop=True)
+                return
+            except pd.errors.ParserError:
+                pass
+        yield from CsvReader().iter_chunks(data_path, n, last, chunk_rows)
+
+
+class PandasExcelReader:
+    """pandas.read_excel: đọc cả vùng dòng một lần (usecols/skiprows/nrows) rồi chia khối."""
+    name = "pandas-excel"
+    extensions = (".xlsx", ".xls")
+    engine = None
+
+    def available(self):
+        return True
+
+    def read_range(self, data_path, first, last):
+        cols = list(range(1, USED_COLUMNS + 1))
+        # Read only used columns (no header); NaN được format_table đổi thành chuỗi rỗng.
+        # dtype=object: giữ nguyên giá trị ô như openpyxl (ô text "0012" không bị đổi thành số 12)
+        df = pd.read_excel(
+            data_path, header=None, usecols=lambda c: c < USED_COLUMNS, dtype=object,
+            skiprows=max(first - 1, 0),
+            nrows=(last - first + 1) if last is not None else None,
+            engine=self.engine,
+        )
+        df.index = range(first, first + len(df))
+        df.columns = cols[:df.shape[1]]
+        return df.reindex(columns=cols)
+
+    def iter_chunks(self, data_path, first, last, chunk_rows):
+        df = self.read_range(data_path, first, last)
+        for k in range(0, len(df), chunk_rows):
+            part = df.iloc[k:k + chunk_rows]
+            yield list(part.index), part
+
+
+class CalamineReader(PandasExcelReader):
+    """pandas.read_excel engine="calamine" (python-calamine, Rust): nhanh hơn openpyxl nhiều lần."""
+    name = "calamine"
+    extensions = (".xlsx", ".xls")
+    engine = "calamine"
+
+    def available(self):
+        return _module_available("python_calamine")
+
+
+class OpenpyxlReader:
+    """
+    openpyxl read-only, values_only: duyệt sheet theo dòng, không dựng cả sheet trong bộ nhớ;
+    khối đầu có ngay, bộ nhớ chỉ cỡ một khối.
+    """
+    name = "openpyxl"
+    extensions = (".xlsx",)
+
+    def available(self):
+        return _module_available("openpyxl")
+
+    def iter_chunks(self, data_path, first, last, chunk_rows):
+        import openpyxl
+        cols = list(range(1, USED_COLUMNS + 1))
+        wb = openpyxl.load_workbook(data_path, read_only=True, data_only=True)
+        try:
+            ws = wb.worksheets[0]
+            numbers, records = [], []
+            rows = ws.iter_rows(min_row=first, max_row=last, max_col=USED_COLUMNS, values_only=True)
+            for n, rec in enumerate(rows, first):
+                rec = list(rec)
+                if len(rec) < USED_COLUMNS:
+                    rec.extend([None] * (USED_COLUMNS - len(rec)))
+                numbers.append(n)
+                records.append(rec)
+                if len(records) >= chunk_rows:
+                    # infer_objects: cột toàn số/ngày thành dtype số/ngày như read_excel
+                    yield numbers, pd.DataFrame(records, columns=cols, dtype=object).infer_objects()
+                    numbers, records = [], []
+            # read_excel bỏ các dòng trống ở cuối sheet
+            while records and all(v is None for v in records[-1]):
+                records.pop()
+                numbers.pop()
+            if records:
+                yield numbers, pd.DataFrame(records, columns=cols, dtype=object).infer_objects()
+        finally:
+            wb.close()
+
+
+DATA_READERS = {
+    "csv": CsvReader,
+    "csv-index": IndexedCsvReader,
+    "pandas": PandasCsvReader,
+    "openpyxl": OpenpyxlReader,
+    "pandas-excel": PandasExcelReader,
+    "calamine": CalamineReader,
+}
+
+
+def readers_for(data_path):
+    """Tên các reader có sẵn trên máy đọc được file này."""
+    ext = os.path.splitext(data_path)[1].lower()
+    return [name for name, cls in DATA_READERS.items() if ext in cls.extensions and cls().available()]
+
+
+def select_reader(data_path, first=2, last=None, chunk_rows=BENCH_CHUNK_ROWS):
+    """
+    Chọn reader theo đuôi file, kích thước, vùng dòng và cỡ khối:
+    CSV rất lớn hoặc đã có index -> csv-index (trừ khi nạp hết cả file một lần), còn lại csv
+    (đọc tuần tự, vùng ngắn dừng đọc sớm);
+    .xlsx -> calamine nếu có, ngược lại openpyxl streaming (khối đầu có ngay thay vì chờ cả sheet);
+    .xls -> calamine hoặc pandas-excel.
+    """
+    ext = os.path.splitext(data_path)[1].lower()
+    if ext == ".csv":
+        try:
+            size = os.path.getsize(data_path)
+        except OSError:
+            size = 0
+        whole = first <= 2 and last is None and chunk_rows >= CSV_BULK_MIN_CHUNK
+        if not whole and size and (size >= CSV_INDEX_MIN_BYTES or load_csv_index(data_path, build=False)):
+            return "csv-index"
+        return "csv"
+    if ext == ".xlsx":
+        return "calamine" if CalamineReader().available() else "openpyxl"
+    if ext == ".xls":
+        return "calamine" if CalamineReader().available() else "pandas-excel"
+    raise ValueError(f"Unsupported file type: {ext}. Please use CSV or Excel.")
+
+
+def make_reader(reader, data_path, first=2, last=None, chunk_rows=BENCH_CHUNK_ROWS):
+    """"auto"/None -> select_reader; tên -> reader trong DATA_READERS; object reader được dùng nguyên."""
+    if reader in (None, "auto"):
+        reader = select_reader(data_path, first, last, chunk_rows)
+    if isinstance(reader, str):
+        try:
+            reader = DATA_READERS[reader]()
+        except KeyError:
+            raise ValueError(f"Unknown data reader: {reader}") from None
+        if not reader.available():
+            raise ValueError(f"Data reader not available: {reader.name}")
+    return reader
+
+
+def iter_data_chunks(data_path, first, last, chunk_rows, reader="auto"):
+    """
+    (số dòng, DataFrame cột 1..USED_COLUMNS) từng khối tối đa chunk_rows dòng của vùng first..last
+    (last=None: hết file), đọc bằng reader ("auto" = select_reader).
+    """
+    ext = os.path.splitext(data_path)[1].lower()
+    if ext not in DATA_EXTENSIONS:
+        raise ValueError(f"Unsupported file type: {ext}. Please use CSV or Excel.")
+    yield from make_reader(reader, data_path, first, last, chunk_rows).iter_chunks(data_path, first, last, chunk_rows)
+
+
+BENCH_ENGINE_MODULES = ("openpyxl", "python_calamine", "xlrd")
+
+
+def bench_reader(name, data_path, first=2, last=None, chunk_rows=BENCH_CHUNK_ROWS):
+    """
+    Đo một reader (nên chạy trong tiến trình riêng để bộ nhớ đỉnh không lẫn reader khác):
+    số dòng, giây, dòng/giây, thời gian tới khối đầu và bộ nhớ đỉnh tăng thêm.
+    Mức nền đo sau khi đã import các engine Excel và đặt lại bộ nhớ đỉnh (reset_peak_memory), để
+    đỉnh lúc import không tính vào reader; hệ không đặt lại được thì lấy mẫu bộ nhớ hiện tại
+    trong một thread phụ.
+    """
+    reader = make_reader(name, data_path, first, last, chunk_rows)
+    for module in BENCH_ENGINE_MODULES:
+        if _module_available(module):
+            importlib.import_module(module)
+    gc.collect()
+    exact = reset_peak_memory()
+    base, _ = process_memory()
+    sampled = [base]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(0.005):
+            sampled.append(max(sampled[-1], process_memory()[0]))
+
+    sampler = None
+    if not exact:
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+    started = time.perf_counter()
+    first_chunk = None
+    rows = 0
+    try:
+        for numbers, _ in reader.iter_chunks(data_path, first, last, chunk_rows):
+            if first_chunk is None:
+                first_chunk = time.perf_counter() - started
+            rows += len(numbers)
+        seconds = time.perf_counter() - started
+    finally:
+        done.set()
+        if sampler is not None:
+            sampler.join()
+    current, peak = process_memory()
+    if not exact:
+        peak = max(sampled[-1], current)
+    return {"reader": name, "rows": rows, "seconds": seconds,
+            "rows_per_sec": rows / seconds if seconds > 0 else None,
+            "first_chunk_seconds": first_chunk, "peak_bytes": max(0, peak - base)}
+
+
+def benchmark_readers(data_path, first=2, last=None, readers=None, repeat=1, chunk_rows=BENCH_CHUNK_ROWS):
+    """
+    Chạy bench_reader cho từng reader (mặc định mọi reader có sẵn cho file), mỗi lần một tiến trình
+    mới; lặp repeat lần và giữ lần nhanh nhất.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    results = []
+    for name in readers or readers_for(data_path):
+        best = None
+        for _ in range(max(1, repeat)):
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+                try:
+                    res = pool.submit(bench_reader, name, data_path, first, last, chunk_rows).result()
+                except Exception as e:
+                    res = {"reader": name, "error": str(e)}
+            if best is None or "error" in best or ("error" not in res and res["seconds"] < best["seconds"]):
+                best = res
+        results.append(best)
+    return results
+
+
+# ---------- Chunk pipeline ----------
+DEFAULT_CHUNK_ROWS = 500
+DEFAULT_PREFETCH_DEPTH = 2
+
+
+class ChunkPipeline:
+    """
+    Nạp dữ liệu theo khối trên một luồng nền (producer-consumer): trong lúc khối hiện tại được nhập
+    phím, luồng nền đọc, định dạng và lọc khối kế tiếp. Hàng đợi giữ tối đa depth khối
+    (2 = double buffer) nên bộ nhớ không tăng theo kích thước file.
+    source(stats) là generator RowStore; duyệt pipeline cho ra (số dòng, RowView) như RowStore.
+    Lỗi đọc ở khối đầu được first() ném lại; lỗi ở khối sau kết thúc việc duyệt và nằm trong error.
+    Hai phía chặn hẳn trên hàng đợi (không dò định kỳ, rảnh thì không tốn CPU): token dừng đánh thức
+    phía nhập bằng một mục "cancel", close() rút cạn hàng đợi để luồng nền thoát.
+    """
+
+    def __init__(self, source, depth=DEFAULT_PREFETCH_DEPTH, cancel_token=None):
+        self.stats = {"rows_total": 0, "prefetch_chunks": 0, "prefetch_wait_seconds": 0.0}
+        self.error = None
+        # True nếu việc duyệt kết thúc vì token bị dừng (chưa hết dữ liệu)
+        self.interrupted = False
+        self.cancel_token = cancel_token
+        self._queue = queue.Queue(maxsize=max(1, int(depth)))
+        self._closed = threading.Event()
+        self._head = None
+        self._done = False
+        if cancel_token is not None:
+            cancel_token.on_cancel(self._wake)
+        self._thread = threading.Thread(target=self._produce, args=(source,), name="lkb-prefetch", daemon=True)
+        self._thread.start()
+
+    def _wake(self, reason=None):
+        # Hàng đợi đầy thì phía nhập không bị chặn, lần _get sau tự thấy token đã dừng
+        try:
+            self._queue.put_nowait(("cancel", None))
+        except queue.Full:
+            pass
+
+    def _put(self, item):
+        """Chặn tới khi có chỗ; False nếu pipeline đã đóng (close() rút hàng đợi nên put không kẹt)."""
+        if self._closed.is_set():
+            return False
+        self._queue.put(item)
+        return not self._closed.is_set()
+
+    def _produce(self, source):
+        try:
+            for store in source(self.stats):
+                if not self._put(("chunk", store)):
+                    return
+        except Exception as e:
+            self._put(("error", e))
+            return
+        self._put(("end", None))
+
+    def _get(self):
+        """Khối kế tiếp, hoặc None khi hết dữ liệu, lỗi đọc hay bị dừng."""
+        if self._done:
+            return None
+        started = time.perf_counter()
+        if self.cancel_token is not None and self.cancel_token.cancelled:
+            self.interrupted = True
+            return None
+        kind, item = self._queue.get()
+        self.stats["prefetch_wait_seconds"] += time.perf_counter() - started
+        if kind == "cancel":
+            self.interrupted = True
+            return None
+        if kind == "chunk":
+            self.stats["prefetch_chunks"] += 1
+            self.stats["rows_total"] += len(item)
+            return item
+        self._done = True
+        if kind == "error":
+            self.error = item
+        return None
+
+    def first(self):
+        """Chờ khối đầu (RowStore, None nếu không có dòng nào); ném lại lỗi đọc file nếu có."""
+        if self._head is None and not self._done:
+            started = time.perf_counter()
+            self._head = self._get()
+            self.stats["first_chunk_seconds"] = time.perf_counter() - started
+        if self.error is not None:
+            raise self.error
+        return self._head
+
+    def __iter__(self):
+        store, self._head = self._head, None
+        if store is None:
+            store = self._get()
+        while store is not None:
+            yield from store
+            store = self._get()
+
+    def close(self):
+        """Dừng luồng nền và bỏ các khối còn trong hàng đợi."""
+        self._closed.set()
+        self._done = True
+        if self.cancel_token is not None:
+            self.cancel_token.off_cancel(self._wake)
+        try:
+            while True:
+                self._queue.get_nowait()
+        except queue.Empty:
+            pass
+
+
+# ---------- Shared work queue ----------
+DEFAULT_QUEUE_BATCH_ROWS = 20
+DEFAULT_QUEUE_LEASE_SECONDS = 300.0
+DEFAULT_QUEUE_MAX_ATTEMPTS = 3
+
+
+class WorkQueue:
+    """
+    Hàng đợi dòng dùng chung cho nhiều máy nhập liệu: các dòng (đã định dạng, cells dạng JSON)
+    của một job nằm trong một file SQLite trên thư mục chia sẻ. Mỗi máy (worker) thuê từng lô
+    batch_rows dòng trong một giao dịch BEGIN IMMEDIATE (khóa ghi cả DB nên hai máy không thuê
+    trùng dòng), gia hạn thuê trên luồng nền (heartbeat) trong lúc nhập và đánh dấu done/failed
+    từng dòng. Lô của máy bị treo/tắt hết hạn sau lease_seconds và được máy khác thuê lại; dòng
+    hết hạn thuê max_attempts lần bị đánh dấu failed. Dòng đã bị máy khác thuê lại (mất hạn thuê)
+    nằm trong lost() để không nhập trùng.
+    Mỗi dòng mang mã nhóm grp (publish với group_key: dòng đầu của đoạn liền nhau cùng header):
+    lô thuê được kéo dài tới hết nhóm của dòng cuối, để một chứng từ không bị chia cho hai máy.
+    Hạn thuê tính theo đồng hồ từng máy: giờ các máy phải lệch ít hơn nhiều so với lease_seconds.
+    DB dùng journal rollback mặc định (WAL không an toàn trên ổ mạng).
+    """
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS jobs (job TEXT PRIMARY KEY, path TEXT, created REAL)",
+        "CREATE TABLE IF NOT EXISTS rows (job TEXT, row INTEGER, cells TEXT, state TEXT DEFAULT 'pending', "
+        "worker TEXT, lease_until REAL, attempts INTEGER DEFAULT 0, reason TEXT, voucher TEXT, "
+        "updated REAL, grp INTEGER, PRIMARY KEY (job, row))",
+        "CREATE INDEX IF NOT EXISTS rows_state ON rows (job, state, row)",
+    )
+    # DB tạo trước khi có cột grp: thêm cột (dòng cũ grp NULL = mỗi dòng một nhóm)
+    MIGRATIONS = (
+        ("grp", "ALTER TABLE rows ADD COLUMN grp INTEGER"),
+    )
+    INDEXES = (
+        "CREATE INDEX IF NOT EXISTS rows_group ON rows (job, grp, row)",
+    )
+
+    def __init__(self, path, job=None, worker=None, batch_rows=DEFAULT_QUEUE_BATCH_ROWS,
+                 lease_seconds=DEFAULT_QUEUE_LEASE_SECONDS, max_attempts=DEFAULT_QUEUE_MAX_ATTEMPTS,
+                 poll_seconds=5.0, timeout=30.0):
+        self.path = path
+        self.worker = worker or f"{socket.gethostname()}-{os.getpid()}"
+        self.batch_rows = max(1, int(batch_rows))
+        self.lease_seconds = float(lease_seconds)
+        self.max_attempts = max(1, int(max_attempts))
+        self.poll_seconds = float(poll_seconds)
+        self.timeout = float(timeout)
+        self._lock = threading.RLock()
+        self._held = set()      # dòng đang thuê, chưa báo xong
+        self._lost = set()      # dòng đã thuê nhưng bị máy khác thuê lại
+        self._unsaved = []      # kết quả chưa ghi được vào DB (DB bận quá timeout)
+        self._stop = None       # Event của lần duyệt iter_stores hiện tại
+        self._heartbeat = None
+        with self._transaction() as db:
+            for sql in self.SCHEMA:
+                db.execute(sql)
+            columns = {name for _, name, *_ in db.execute("PRAGMA table_info(rows)")}
+            for column, sql in self.MIGRATIONS:
+                if column not in columns:
+                    db.execute(sql)
+            for sql in self.INDEXES:
+                db.execute(sql)
+        self.job = job or self.latest_job()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Giao dịch ghi BEGIN IMMEDIATE trên kết nối riêng (mở/đóng mỗi lần, an toàn giữa các luồng)."""
+        db = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+        finally:
+            db.close()
+
+    def _query(self, sql, params=()):
+        db = sqlite3.connect(self.path, timeout=self.timeout)
+        try:
+            return db.execute(sql, params).fetchall()
+        finally:
+            db.close()
+
+    def latest_job(self):
+        found = self._query("SELECT job FROM jobs ORDER BY created DESC LIMIT 1")
+        return found[0][0] if found else None
+
+    def job_path(self):
+        """File dữ liệu gốc của job (đường dẫn lúc publish)."""
+        found = self._query("SELECT path FROM jobs WHERE job = ?", (self.job,))
+        return found[0][0] if found else None
+
+    def publish(self, store, path="", group_key=None):
+        """
+        Nạp các dòng của RowStore vào job; dòng đã có giữ nguyên trạng thái. Trả về số dòng mới.
+        group_key(row) (vd. TabmisAutomator.header_key): các dòng liền nhau cùng khóa là một nhóm,
+        luôn được thuê cùng một lô; None = mỗi dòng một nhóm.
+        """
+        def rows():
+            grp = key = None
+            for n, row in store:
+                k = group_key(row) if group_key is not None else None
+                if group_key is None or grp is None or k != key:
+                    grp, key = n, k
+                yield self.job, n, json.dumps(list(row), ensure_ascii=False), grp
+
+        with self._transaction() as db:
+            db.execute("INSERT OR IGNORE INTO jobs VALUES (?, ?, ?)", (self.job, path, time.time()))
+            before = db.total_changes
+            db.executemany("INSERT OR IGNORE INTO rows (job, row, cells, grp) VALUES (?, ?, ?, ?)", rows())
+            return db.total_changes - before
+
+    def requeue_failed(self):
+        """Đưa các dòng failed của job về pending để chạy lại. Trả về số dòng."""
+        with self._transaction() as db:
+            return db.execute("UPDATE rows SET state = 'pending', worker = NULL, lease_until = NULL, "
+                              "attempts = 0, reason = NULL WHERE job = ? AND state = 'failed'",
+                              (self.job,)).rowcount
+
+    def counts(self):
+        """{trạng thái: số dòng} của job."""
+        return dict(self._query("SELECT state, COUNT(*) FROM rows WHERE job = ? GROUP BY state", (self.job,)))
+
+    def lease(self, limit=None, stop=None):
+        """
+        Thuê limit dòng (pending hoặc hết hạn thuê) theo thứ tự dòng, cộng các dòng còn lại của nhóm
+        (grp) chứa dòng cuối. Trả về list (số dòng, cells); rỗng nếu không còn dòng để thuê hoặc stop đã set.
+        """
+        with self._lock:
+            if stop is not None and stop.is_set():
+                return []
+            now = time.time()
+            with self._transaction() as db:
+                db.execute("UPDATE rows SET state = 'failed', reason = 'lease expired', updated = ? "
+                           "WHERE job = ? AND state = 'leased' AND lease_until < ? AND attempts >= ?",
+                           (now, self.job, now, self.max_attempts))
+                found = db.execute(
+                    "SELECT row, cells, grp FROM rows WHERE job = ? AND (state = 'pending' OR "
+                    "(state = 'leased' AND lease_until < ?)) ORDER BY row LIMIT ?",
+                    (self.job, now, limit or self.batch_rows)).fetchall()
+                if found and found[-1][2] is not None:
+                    found += db.execute(
+                        "SELECT row, cells, grp FROM rows WHERE job = ? AND grp = ? AND row > ? AND "
+                        "(state = 'pending' OR (state = 'leased' AND lease_until < ?)) ORDER BY row",
+                        (self.job, found[-1][2], found[-1][0], now)).fetchall()
+                db.executemany("UPDATE rows SET state = 'leased', worker = ?, lease_until = ?, "
+                               "attempts = attempts + 1, updated = ? WHERE job = ? AND row = ?",
+                               [(self.worker, now + self.lease_seconds, now, self.job, r) for r, *_ in found])
+            self._held.update(r for r, *_ in found)
+            if found and self._heartbeat is None:
+                self._heartbeat = threading.Event()
+                threading.Thread(target=self._heartbeat_loop, args=(self._heartbeat,),
+                                 name="lkb-queue-heartbeat", daemon=True).start()
+        return [(r, json.loads(c)) for r, c, _ in found]
+
+    def _heartbeat_loop(self, stopped):
+        while not stopped.wait(self.lease_seconds / 3.0):
+            try:
+                self.heartbeat()
+            except sqlite3.Error:
+                pass
+
+    def heartbeat(self):
+        """Gia hạn thuê các dòng đang giữ; dòng đã bị máy khác thuê lại chuyển sang lost."""
+        with self._lock:
+            held = sorted(self._held)
+            if not held:
+                return
+            self._save_unsaved()
+            until = time.time() + self.lease_seconds
+            with self._transaction() as db:
+                db.executemany("UPDATE rows SET lease_until = ? WHERE job = ? AND row = ? "
+                               "AND state = 'leased' AND worker = ?",
+                               [(until, self.job, r, self.worker) for r in held])
+                kept = {r for (r,) in db.execute("SELECT row FROM rows WHERE job = ? AND state = 'leased' "
+                                                 "AND worker = ?", (self.job, self.worker))}
+            lost = self._held - kept - {r for r, *_ in self._unsaved}
+            self._held -= lost
+            self._lost |= lost
+
+    def lost(self, numbers):
+        """True nếu một trong các dòng đã bị máy khác thuê lại (không được nhập nữa)."""
+        with self._lock:
+            return not self._lost.isdisjoint(numbers)
+
+    def _save_unsaved(self):
+        if not self._unsaved:
+            return
+        with self._transaction() as db:
+            db.executemany("UPDATE rows SET state = ?, reason = ?, voucher = ?, lease_until = NULL, updated = ? "
+                           "WHERE job = ? AND row = ? AND worker = ?",
+                           [(state, reason, voucher, now, self.job, r, self.worker)
+                            for r, state, reason, voucher, now in self._unsaved])
+        self._held.difference_update(r for r, *_ in self._unsaved)
+        self._unsaved = []
+
+    def complete(self, numbers, state, reason="", voucher=""):
+        """
+        Báo các dòng đã xong (state "done"/"failed"). DB bận quá timeout thì giữ lại (vẫn gia hạn
+        thuê) để ghi ở lần sau; False nếu chưa ghi được.
+        """
+        now = time.time()
+        with self._lock:
+            self._unsaved.extend((r, state, str(reason or ""), voucher or "", now) for r in numbers)
+            try:
+                self._save_unsaved()
+            except sqlite3.Error:
+                return False
+        return True
+
+    def iter_stores(self, stats=None):
+        """
+        RowStore từng lô thuê được: nguồn cho ChunkPipeline. Hết dòng chờ mà máy khác còn giữ lô
+        thì chờ poll_seconds rồi thử lại (để thuê lại lô hết hạn); kết thúc khi job hết việc,
+        khi release(), hoặc khi chính máy này còn dòng chưa nhập (gom header đọc trước dòng kế
+        tiếp: chờ lúc đó sẽ khóa chéo giữa các máy).
+        """
+        stop = self._stop = threading.Event()
+        intern = sys.intern
+        while not stop.is_set():
+            batch = self.lease(stop=stop)
+            if batch:
+                columns = zip(*(cells for _, cells in batch))
+                yield RowStore(tuple(tuple(map(intern, col)) for col in columns), tuple(r for r, _ in batch))
+                continue
+            with self._lock:
+                busy = bool(self._held)
+            if busy or not self.counts().get("leased") or stop.wait(self.poll_seconds):
+                return
+
+    def release(self):
+        """Dừng thuê thêm và heartbeat, trả các dòng đã thuê mà chưa nhập về pending."""
+        with self._lock:
+            if self._stop is not None:
+                self._stop.set()
+            if self._heartbeat is not None:
+                self._heartbeat.set()
+                self._heartbeat = None
+            try:
+                self._save_unsaved()
+            except sqlite3.Error:
+                pass
+            unsaved = {r for r, *_ in self._unsaved}
+            held = sorted(self._held - unsaved)
+            if held:
+                with self._transaction() as db:
+                    db.executemany("UPDATE rows SET state = 'pending', worker = NULL, lease_until = NULL, "
+                                   "attempts = attempts - 1 WHERE job = ? AND row = ? AND state = 'leased' "
+                                   "AND worker = ?", [(self.job, r, self.worker) for r in held])
+            self._held &= unsaved
+            self._lost.clear()
+
+
+# ---------- Keystroke backends ----------
+MODIFIER_KEYS = ('shift', 'ctrl', 'alt', 'win', 'command')
+
+# Token cho pywinauto.keyboard.send_keys theo tên phím đã chuẩn hóa
+PYWINAUTO_TOKENS = {
+    'enter': '{ENTER}',
+    'esc': '{ESC}',
+    'tab': '{TAB}',
+    'down': '{DOWN}',
+    'up': '{UP}',
+    'left': '{LEFT}',
+    'right': '{RIGHT}',
+    'pagedown': '{PGDN}',
+    'pageup': '{PGUP}',
+    'f1': '{F1}',
+    'f2': '{F2}',
+    'f3': '{F3}',
+    'f4': '{F4}',
+    'f5': '{F5}',
+    'f6': '{F6}',
+    'f7': '{F7}',
+    'f8': '{F8}',
+    'f9': '{F9}',
+    'f10': '{F10}',
+    'f11': '{F11}',
+    'f12': '{F12}',
+    'space': ' ',
+}
+
+PYWINAUTO_PREFIXES = {
+    'ctrl': '^',
+    'shift': '+',
+    'alt': '%',
+    # 'win' is not supported as prefix in send_keys; use {LWIN} if needed
+}
+
+# Ký tự đặc biệt của mini-language send_keys, phải bọc {} khi gõ text thô
+_SEND_KEYS_SPECIAL_RE = re.compile(r"([+^%~{}()\[\]])")
+
+
+class PywinautoBackend:
+    """
+    Backend mặc định: pywinauto.keyboard.send_keys cho phím, pyperclip cho clipboard.
+    Mỗi action là một tuple: ("key", name), ("hotkey", (modifiers...), name) hoặc ("text", str).
+    batches_input: send_group gửi cả nhóm trong một lần (kế hoạch gộp các dãy press, xem batch_key_runs).
+    """
+    name = "pywinauto"
+    batches_input = False
+
+    def __init__(self):
+        self._tokens = {}
+
+    def available(self):
+        return keyboard is not None
+
+    def copy(self, text):
+        pyperclip.copy(text)
+
+    def _token(self, key):
+        token = self._tokens.get(key)
+        if token is None:
+            token = PYWINAUTO_TOKENS.get(key, key)
+            self._tokens[key] = token
+        return token
+
+    def key(self, key):
+        token = self._token(key)
+        try:
+            keyboard.send_keys(token)
+        except Exception:
+            # fallback: try raw
+            keyboard.send_keys(str(key))
+
+    def hotkey(self, modifiers, key):
+        prefix = ''.join(PYWINAUTO_PREFIXES.get(m, '') for m in modifiers)
+        if key is None:
+            # send a modifier press-release by sending prefix alone (may be ignored)
+            keyboard.send_keys(prefix)
+            return
+        try:
+            keyboard.send_keys(f"{prefix}{self._token(key)}")
+        except Exception:
+            # fallback: try without braces
+            keyboard.send_keys(f"{prefix}{key}")
+
+    def type_text(self, text):
+        # Escape +^%~{}()[] để send_keys gõ đúng ký tự thay vì hiểu là lệnh
+        escaped = _SEND_KEYS_SPECIAL_RE.sub(r"{\1}", text)
+        keyboard.send_keys(escaped, pause=0, with_spaces=True, with_tabs=True, with_newlines=True)
+
+    def send_group(self, actions):
+        for action in actions:
+            kind = action[0]
+            if kind == "key":
+                self.key(action[1])
+            elif kind == "hotkey":
+                self.hotkey(action[1], action[2])
+            elif kind == "text":
+                self.type_text(action[1])
+            else:
+                raise ValueError(f"Unknown action: {action!r}")
+
+
+# Cấu trúc INPUT của SendInput. Dùng kiểu có kích thước cố định (DWORD = uint32,
+# ULONG_PTR = size_t) nên khai báo được cả trên Linux để kiểm thử phần dựng sự kiện.
+INPUT_KEYBOARD = 1
+KEYEVENTF_EXTENDEDKEY = 0x0001
+KEYEVENTF_KEYUP = 0x0002
+KEYEVENTF_UNICODE = 0x0004
+
+
+class KEYBDINPUT(ctypes.Structure):
+    _fields_ = [
+        ("wVk", ctypes.c_uint16),
+        ("wScan", ctypes.c_uint16),
+        ("dwFlags", ctypes.c_uint32),
+        ("time", ctypes.c_uint32),
+        ("dwExtraInfo", ctypes.c_size_t),
+    ]
+
+
+class MOUSEINPUT(ctypes.Structure):
+    _fields_ = [
+        ("dx", ctypes.c_int32),
+        ("dy", ctypes.c_int32),
+        ("mouseData", ctypes.c_uint32),
+        ("dwFlags", ctypes.c_uint32),
+        ("time", ctypes.c_uint32),
+        ("dwExtraInfo", ctypes.c_size_t),
+    ]
+
+
+class HARDWAREINPUT(ctypes.Structure):
+    _fields_ = [
+        ("uMsg", ctypes.c_uint32),
+        ("wParamL", ctypes.c_uint16),
+        ("wParamH", ctypes.c_uint16),
+    ]
+
+
+class _INPUTUNION(ctypes.Union):
+    _fields_ = [("mi", MOUSEINPUT), ("ki", KEYBDINPUT), ("hi", HARDWAREINPUT)]
+
+
+class INPUT(ctypes.Structure):
+    _fields_ = [("type", ctypes.c_uint32), ("u", _INPUTUNION)]
+
+
+# Virtual-key codes theo tên phím đã chuẩn hóa
+VIRTUAL_KEYS = {
+    'backspace': 0x08, 'tab': 0x09, 'enter': 0x0D, 'shift': 0x10, 'ctrl': 0x11,
+    'alt': 0x12, 'esc': 0x1B, 'space': 0x20, 'pageup': 0x21, 'pagedown': 0x22,
+    'end': 0x23, 'home': 0x24, 'left': 0x25, 'up': 0x26, 'right': 0x27,
+    'down': 0x28, 'insert': 0x2D, 'delete': 0x2E, 'win': 0x5B, 'command': 0x5B,
+}
+VIRTUAL_KEYS.update({f"f{n}": 0x6F + n for n in range(1, 13)})
+
+# Các phím này phải gửi kèm KEYEVENTF_EXTENDEDKEY
+EXTENDED_KEYS = {'pageup', 'pagedown', 'end', 'home', 'left', 'up', 'right', 'down',
+                 'insert', 'delete', 'win', 'command'}
+
+
+def _win_send_input(count, inputs, size):
+    return ctypes.windll.user32.SendInput(count, inputs, size)
+
+
+class SendInputBackend(PywinautoBackend):
+    """
+    Backend gửi cả một nhóm action trong MỘT lệnh SendInput (ctypes), không qua
+    mini-language của send_keys. Text được gõ bằng KEYEVENTF_UNICODE theo từng
+    đơn vị UTF-16 nên gõ đúng tiếng Việt và các ký tự +^%~{}(). Clipboard vẫn dùng pyperclip.
+
+    send_func(count, inputs, size) mặc định gọi user32.SendInput; truyền hàm giả để
+    kiểm thử build_inputs/send_group trên Linux.
+    """
+    name = "sendinput"
+    batches_input = True
+
+    def __init__(self, send_func=None):
+        super().__init__()
+        self._send_func = send_func
+
+    def available(self):
+        return self._send_func is not None or platform.system() == "Windows"
+
+    @staticmethod
+    def _vk(key):
+        vk = VIRTUAL_KEYS.get(key)
+        if vk is not None:
+            return vk
+        if len(key) == 1 and key.isascii() and key.isalnum():
+            return ord(key.upper())
+        return None
+
+    @staticmethod
+    def _key_input(vk, up=False, extended=False):
+        flags = (KEYEVENTF_KEYUP if up else 0) | (KEYEVENTF_EXTENDEDKEY if extended else 0)
+        return INPUT(type=INPUT_KEYBOARD, u=_INPUTUNION(ki=KEYBDINPUT(wVk=vk, wScan=0, dwFlags=flags)))
+
+    @staticmethod
+    def _unicode_input(unit, up=False):
+        flags = KEYEVENTF_UNICODE | (KEYEVENTF_KEYUP if up else 0)
+        return INPUT(type=INPUT_KEYBOARD, u=_INPUTUNION(ki=KEYBDINPUT(wVk=0, wScan=unit, dwFlags=flags)))
+
+    def _tap(self, key, out):
+        vk = self._vk(key)
+        if vk is None:
+            # Phím không có VK (vd. ký tự có dấu): gõ như text Unicode
+            self._text(key, out)
+            return
+        ext = key in EXTENDED_KEYS
+        out.append(self._key_input(vk, extended=ext))
+        out.append(self._key_input(vk, up=True, extended=ext))
+
+    def _text(self, text, out):
+        for ch in text:
+            if ch == "\r":
+                continue
+            if ch == "\n":
+                self._tap('enter', out)
+                continue
+            if ch == "\t":
+                self._tap('tab', out)
+                continue
+            data = ch.encode("utf-16-le")
+            # Ký tự ngoài BMP thành cặp surrogate: gửi đủ 2 đơn vị
+            for i in range(0, len(data), 2):
+                unit = data[i] | (data[i + 1] << 8)
+                out.append(self._unicode_input(unit))
+                out.append(self._unicode_input(unit, up=True))
+
+    def build_inputs(self, actions):
+        """
+        Dựng danh sách INPUT cho cả nhóm action (thuần Python, không gọi OS).
+        Hotkey phải có VK cho mọi phím: phím chính gõ như text Unicode trong lúc giữ Ctrl/Alt
+        thì Tabmis không nhận là phím tắt, nên ValueError (trước khi gửi sự kiện nào).
+        """
+        out = []
+        for action in actions:
+            kind = action[0]
+            if kind == "key":
+                self._tap(action[1], out)
+            elif kind == "hotkey":
+                unknown = [m for m in action[1] if m not in VIRTUAL_KEYS]
+                if action[2] is not None and self._vk(action[2]) is None:
+                    unknown.append(action[2])
+                if unknown:
+                    raise ValueError(f"Hotkey {action!r}: no virtual key for {unknown}")
+                mods = [VIRTUAL_KEYS[m] for m in action[1]]
+                for vk in mods:
+                    out.append(self._key_input(vk))
+                if action[2] is not None:
+                    self._tap(action[2], out)
+                for vk in reversed(mods):
+                    out.append(self._key_input(vk, up=True))
+            elif kind == "text":
+                self._text(action[1], out)
+            else:
+                raise ValueError(f"Unknown action: {action!r}")
+        return out
+
+    def send_group(self, actions):
+        events = self.build_inputs(actions)
+        if not events:
+            return 0
+        inputs = (INPUT * len(events))(*events)
+        send = self._send_func or _win_send_input
+        sent = send(len(events), inputs, ctypes.sizeof(INPUT))
+        if sent != len(events):
+            raise OSError(f"SendInput sent {sent}/{len(events)} events")
+        return sent
+
+    def key(self, key):
+        self.send_group((("key", key),))
+
+    def hotkey(self, modifiers, key):
+        self.send_group((("hotkey", tuple(modifiers), key),))
+
+    def type_text(self, text):
+        self.send_group((("text", text),))
+
+
+KEY_BACKENDS = {
+    "pywinauto": PywinautoBackend,
+    "sendinput": SendInputBackend,
+}
+
+
+def make_key_backend(backend=None):
+    """None/"pywinauto"/"sendinput" -> backend mới; object backend được dùng nguyên."""
+    if backend is None:
+        backend = "pywinauto"
+    if isinstance(backend, str):
+        try:
+            return KEY_BACKENDS[backend]()
+        except KeyError:
+            raise ValueError(f"Unknown key backend: {backend}") from None
+    return backend
+
+
+# ---------- Cancellation ----------
+class CancelToken:
+    """
+    Token dừng dùng chung cho mọi lần chờ, dò và gọi backend của một lần chạy.
+    wait() chặn trên threading.Event nên không tốn CPU và trả về ngay khi cancel().
+    Các nguồn dừng (nút Dừng, phím ESC, tín hiệu Ctrl+C, hết giờ) gắn vào bằng add_source().
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._sources = []
+        self.reason = None
+        self.cancelled_at = None
+        self.observed_at = None
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self, reason="user"):
+        with self._lock:
+            if self._event.is_set():
+                return False
+            self.reason = reason
+            self.cancelled_at = time.monotonic()
+            self._event.set()
+            callbacks = list(self._callbacks)
+        for cb in callbacks:
+            try:
+                cb(reason)
+            except Exception:
+                pass
+        return True
+
+    def check(self):
+        """Như cancelled, đồng thời ghi lại lần đầu tiên lệnh dừng được nhận ra (đo độ trễ dừng)."""
+        if not self._event.is_set():
+            return False
+        if self.observed_at is None:
+            self.observed_at = time.monotonic()
+        return True
+
+    def wait(self, timeout=None):
+        """Chờ tối đa timeout giây; trả về True nếu bị dừng (ngắt ngay khi cancel)."""
+        if timeout is not None and timeout <= 0:
+            return self.check()
+        self._event.wait(timeout)
+        return self.check()
+
+    def latency(self):
+        """Thời gian (giây) từ lúc cancel() tới lúc vòng chạy nhận ra; None nếu chưa dừng."""
+        if self.cancelled_at is None or self.observed_at is None:
+            return None
+        return max(0.0, self.observed_at - self.cancelled_at)
+
+    def on_cancel(self, callback):
+        """Đăng ký callback(reason) gọi khi bị dừng (gọi ngay nếu đã dừng)."""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self.reason)
+
+    def off_cancel(self, callback):
+        """Gỡ callback đã đăng ký bằng on_cancel (token dùng lại qua nhiều lần chạy)."""
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def add_source(self, source):
+        source.attach(self)
+        self._sources.append(source)
+        return source
+
+    def close(self):
+        """Gỡ mọi nguồn dừng (dừng hook ESC, trả lại signal handler, hủy timer)."""
+        while self._sources:
+            try:
+                self._sources.pop().detach()
+            except Exception:
+                pass
+
+
+class ManualStopSource:
+    """Nguồn dừng gọi tay: nút Dừng trên GUI, hoặc nguồn giả khi kiểm thử độ trễ dừng."""
+
+    def __init__(self, reason="user"):
+        self.reason = reason
+        self._token = None
+
+    def attach(self, token):
+        self._token = token
+
+    def detach(self):
+        self._token = None
+
+    def fire(self):
+        if self._token is not None:
+            self._token.cancel(self.reason)
+
+
+class TimeoutStopSource:
+    """Dừng sau một khoảng thời gian (giây)."""
+
+    def __init__(self, seconds, reason="timeout"):
+        self.seconds = float(seconds)
+        self.reason = reason
+        self._timer = None
+
+    def attach(self, token):
+        self._timer = threading.Timer(self.seconds, token.cancel, args=(self.reason,))
+        self._timer.daemon = True
+        self._timer.start()
+
+    def detach(self):
+        if self._timer:
+            self._timer.cancel()
+        self._timer = None
+
+
+class SignalStopSource:
+    """Dừng khi nhận SIGINT/SIGTERM (Ctrl+C ở chế độ dòng lệnh). Chỉ gắn được từ main thread."""
+
+    def __init__(self, signals=(signal.SIGINT, signal.SIGTERM), reason="signal"):
+        self.signals = signals
+        self.reason = reason
+        self._previous = {}
+
+    def attach(self, token):
+        for sig in self.signals:
+            self._previous[sig] = signal.signal(sig, lambda signum, frame: token.cancel(self.reason))
+
+    def detach(self):
+        for sig, handler in self._previous.items():
+            try:
+                signal.signal(sig, handler)
+            except Exception:
+                pass
+        self._previous = {}
+
+
+class EscHotkeySource:
+    """
+    Windows-only global ESC: cài low-level keyboard hook (WH_KEYBOARD_LL) trên một thread
+    riêng chặn trong GetMessageW, nên không polling và không tốn CPU khi rảnh.
+    Bỏ qua phím ESC do chính chương trình gửi (LLKHF_INJECTED), vd. trong reset macro.
+    on_pause (tùy chọn): gọi khi nhấn phím Pause (tạm dừng/tiếp tục), trên thread của hook.
+    """
+    WH_KEYBOARD_LL = 13
+    WM_KEYDOWN = 0x0100
+    WM_SYSKEYDOWN = 0x0104
+    WM_QUIT = 0x0012
+    VK_ESCAPE = 0x1B
+    VK_PAUSE = 0x13
+    LLKHF_INJECTED = 0x10
+
+    def __init__(self, reason="esc", on_pause=None):
+        self.reason = reason
+        self.on_pause = on_pause
+        self._thread = None
+        self._thread_id = None
+        self._ready = threading.Event()
+
+    def attach(self, token):
+        if platform.system() != "Windows":
+            return
+        self._token = token
+        self._ready.clear()
+        self._thread = threading.Thread(target=self._hook_loop, daemon=True)
+        self._thread.start()
+        self._ready.wait(1.0)
+
+    def _hook_loop(self):
+        try:
+            from ctypes import wintypes
+            user32 = ctypes.WinDLL("user32", use_last_error=True)
+            kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+            self._thread_id = kernel32.GetCurrentThreadId()
+
+            class KBDLLHOOKSTRUCT(ctypes.Structure):
+                _fields_ = [
+                    ("vkCode", ctypes.c_uint32),
+                    ("scanCode", ctypes.c_uint32),
+                    ("flags", ctypes.c_uint32),
+                    ("time", ctypes.c_uint32),
+                    ("dwExtraInfo", ctypes.c_size_t),
+                ]
+
+            HOOKPROC = ctypes.WINFUNCTYPE(ctypes.c_ssize_t, ctypes.c_int, ctypes.c_size_t, ctypes.c_ssize_t)
+            user32.CallNextHookEx.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_size_t, ctypes.c_ssize_t]
+            user32.CallNextHookEx.restype = ctypes.c_ssize_t
+            user32.SetWindowsHookExW.argtypes = [ctypes.c_int, HOOKPROC, ctypes.c_void_p, ctypes.c_uint32]
+            user32.SetWindowsHookExW.restype = ctypes.c_void_p
+            kernel32.GetModuleHandleW.restype = ctypes.c_void_p
+
+            def proc(n_code, w_param, l_param):
+                if n_code == 0 and w_param in (self.WM_KEYDOWN, self.WM_SYSKEYDOWN):
+                    kb = ctypes.cast(l_param, ctypes.POINTER(KBDLLHOOKSTRUCT)).contents
+                    if kb.vkCode == self.VK_ESCAPE and not (kb.flags & self.LLKHF_INJECTED):
+                        self._token.cancel(self.reason)
+                    elif kb.vkCode == self.VK_PAUSE and self.on_pause is not None:
+                        self.on_pause()
+                return user32.CallNextHookEx(None, n_code, w_param, l_param)
+
+            self._proc = HOOKPROC(proc)  # giữ tham chiếu để callback không bị thu hồi
+            hook = user32.SetWindowsHookExW(self.WH_KEYBOARD_LL, self._proc, kernel32.GetModuleHandleW(None), 0)
+            self._ready.set()
+            if not hook:
+                return
+            msg = wintypes.MSG()
+            while user32.GetMessageW(ctypes.byref(msg), None, 0, 0) > 0:
+                pass
+            user32.UnhookWindowsHookEx(ctypes.c_void_p(hook))
+        except Exception:
+            # if any error, just exit the watcher silently
+            self._ready.set()
+            return
+
+    def detach(self):
+        if self._thread_id is not None:
+            try:
+                ctypes.windll.user32.PostThreadMessageW(self._thread_id, self.WM_QUIT, 0, 0)
+            except Exception:
+                pass
+        if self._thread:
+            self._thread.join(timeout=0.5)
+        self._thread = None
+        self._thread_id = None
+
+
+# ---------- Clock ----------
+class SystemClock:
+    """
+    Đồng hồ thật: time() (giờ hệ thống, dùng cho mốc thời gian/metrics), monotonic() (đo khoảng)
+    và wait(token, seconds) ngủ trên CancelToken nên ngắt ngay khi có lệnh dừng.
+    """
+    virtual = False
+
+    def time(self):
+        return time.time()
+
+    def monotonic(self):
+        return time.perf_counter()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def wait(self, token, seconds):
+        """Chờ seconds giây trên token; trả về True nếu bị dừng."""
+        return token.wait(seconds)
+
+
+class VirtualClock:
+    """
+    Đồng hồ ảo cho chạy giả lập: sleep()/wait() chỉ cộng vào giờ hiện tại, không ngủ thật, nên một lần
+    chạy 10 tiếng trên TabmisSimulator hoặc backend giả xong trong vài giây mà vẫn cho cùng số liệu
+    thời gian (elapsed, rows_per_hour, thời gian từng bước/dòng). Backend giả phải đọc giờ từ
+    monotonic() của chính đồng hồ này (vd. TabmisSimulator(clock=clock.monotonic)).
+    """
+    virtual = True
+
+    def __init__(self, start=None):
+        self._epoch = time.time() if start is None else float(start)
+        self._now = 0.0
+        self._lock = threading.Lock()
+
+    def time(self):
+        return self._epoch + self._now
+
+    def monotonic(self):
+        return self._now
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            with self._lock:
+                self._now += seconds
+
+    def wait(self, token, seconds):
+        if token.check():
+            return True
+        self.sleep(seconds or 0.0)
+        return token.check()
+
+
+SYSTEM_CLOCK = SystemClock()
+
+
+# ---------- Rate governor ----------
+def parse_run_windows(spec):
+    """
+    "18:00-07:00" hoặc "12:00-13:30,18:00-07:00" (hoặc list các chuỗi) ->
+    list (phút bắt đầu, phút kết thúc) trong ngày. Khung qua nửa đêm được hỗ trợ;
+    giờ 00-23, phút 00-59, riêng giờ kết thúc được là 24:00.
+    """
+    if not spec:
+        return []
+    parts = spec.split(",") if isinstance(spec, str) else list(spec)
+    windows = []
+    for part in parts:
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            start, end = part.split("-")
+            sh, sm = (int(x) for x in start.strip().split(":"))
+            eh, em = (int(x) for x in end.strip().split(":"))
+            if not (0 <= sh <= 23 and 0 <= sm <= 59 and (0 <= eh <= 23 and 0 <= em <= 59 or (eh, em) == (24, 0))):
+                raise ValueError
+        except ValueError:
+            raise ValueError(f"Khung giờ không hợp lệ: {part!r} (dạng HH:MM-HH:MM)") from None
+        windows.append((sh * 60 + sm, eh * 60 + em))
+    return windows
+
+
+class RateGovernor:
+    """
+    Điều tiết nhịp chạy quanh vòng lặp dòng để không làm chậm server Tabmis dùng chung:
+    - max_rows_per_minute: giới hạn số dòng/phút (giãn đều thời điểm bắt đầu mỗi dòng).
+    - save_latency_target: khi độ trễ lưu (Ctrl+S tới khi hết busy, trung bình trượt; chỉ đo
+      được khi automator dò được lúc hết busy, xem TabmisAutomator.readiness_probe) vượt ngưỡng
+      thì khoảng nghỉ thêm giữa các dòng được nhân backoff_factor (lùi nhanh), khi về dưới ngưỡng
+      thì trừ dần recovery_step mỗi lần lưu (hồi phục tuyến tính) - ưu tiên thông lượng bền vững
+      hơn tốc độ đỉnh. Chỉ dựa trên độ trễ lưu máy này đo được: không biết số máy khác đang nhập,
+      tải của các máy đó chỉ được cảm nhận gián tiếp qua độ trễ lưu chung.
+    - run_windows: chỉ chạy trong các khung giờ (vd. "18:00-07:00"), ngoài khung thì tự
+      tạm dừng và chạy tiếp khi tới giờ.
+    """
+
+    def __init__(self, max_rows_per_minute=None, save_latency_target=None, run_windows=None,
+                 backoff_factor=2.0, recovery_step=0.5, max_extra_delay=60.0, ewma_alpha=0.3,
+                 now_func=None):
+        self.min_interval = 60.0 / max_rows_per_minute if max_rows_per_minute else 0.0
+        self.save_latency_target = save_latency_target
+        self.windows = parse_run_windows(run_windows)
+        self.backoff_factor = float(backoff_factor)
+        self.recovery_step = float(recovery_step)
+        self.max_extra_delay = float(max_extra_delay)
+        self.ewma_alpha = float(ewma_alpha)
+        self._now = now_func or time.time
+        self.extra_delay = 0.0
+        self.save_latency = None   # trung bình trượt (EWMA)
+        self.backoffs = 0
+        self.paused_seconds = 0.0
+        self._last_row_start = None
+
+    def _minute_of_day(self, ts):
+        t = time.localtime(ts)
+        return t.tm_hour * 60 + t.tm_min
+
+    def in_window(self, ts=None):
+        if not self.windows:
+            return True
+        m = self._minute_of_day(self._now() if ts is None else ts)
+        for start, end in self.windows:
+            if start <= end:
+                if start <= m < end:
+                    return True
+            elif m >= start or m < end:
+                return True
+        return False
+
+    def seconds_until_window(self, ts=None):
+        """Số giây tới khi vào khung giờ chạy gần nhất (0 nếu đang trong khung)."""
+        ts = self._now() if ts is None else ts
+        if self.in_window(ts):
+            return 0.0
+        t = time.localtime(ts)
+        now_sec = t.tm_hour * 3600 + t.tm_min * 60 + t.tm_sec
+        waits = [((start * 60 - now_sec) % 86400) for start, _ in self.windows]
+        return float(min(waits))
+
+    def before_row(self, wait, status_callback=None):
+        """
+        Gọi trước mỗi dòng; chặn cho tới khi được phép chạy. wait(giây) -> True nếu bị dừng.
+        Trả về False nếu bị dừng trong lúc chờ.
+        """
+        while not self.in_window():
+            remaining = self.seconds_until_window()
+            if status_callback:
+                resume_at = time.strftime("%H:%M", time.localtime(self._now() + remaining))
+                status_callback(f"Ngoài khung giờ chạy, tạm dừng tới {resume_at}...")
+            step = min(max(remaining, 1.0), 60.0)
+            start = self._now()
+            if wait(step):
+                return False
+            self.paused_seconds += self._now() - start
+            # Sau khi nghỉ qua khung giờ, không cần giãn nhịp với dòng trước
+            self._last_row_start = None
+        interval = self.min_interval + self.extra_delay
+        if self._last_row_start is not None and interval > 0:
+            remaining = self._last_row_start + interval - self._now()
+            if remaining > 0:
+                if status_callback and self.extra_delay > 0:
+                    status_callback(f"Tabmis phản hồi chậm, giãn nhịp thêm {self.extra_delay:.1f}s...")
+                if wait(remaining):
+                    return False
+        self._last_row_start = self._now()
+        return True
+
+    def observe_save(self, latency):
+        """
+        Ghi nhận độ trễ của một lần lưu và điều chỉnh khoảng nghỉ thêm: vượt ngưỡng thì nhân
+        backoff_factor (ít nhất recovery_step, tối đa max_extra_delay), dưới ngưỡng thì trừ recovery_step.
+        """
+        if self.save_latency is None:
+            self.save_latency = latency
+        else:
+            self.save_latency += self.ewma_alpha * (latency - self.save_latency)
+        if not self.save_latency_target:
+            return
+        if self.save_latency > self.save_latency_target:
+            self.extra_delay = min(self.max_extra_delay,
+                                   max(self.recovery_step, self.extra_delay * self.backoff_factor))
+            self.backoffs += 1
+        else:
+            self.extra_delay = max(0.0, self.extra_delay - self.recovery_step)
+
+    def snapshot(self):
+        return {
+            "governor_extra_delay": self.extra_delay,
+            "governor_backoffs": self.backoffs,
+            "governor_paused_seconds": self.paused_seconds,
+            "save_latency_ewma": self.save_latency,
+        }
+
+
+# ---------- Watchdog ----------
+WATCHDOG_STAGES = ("warn", "reset", "skip", "abort")
+DEFAULT_STEP_TIMEOUT = 120.0
+DEFAULT_ROW_TIMEOUT = 900.0
+
+
+class WatchdogTimeout(Exception):
+    """Watchdog yêu cầu bỏ bước hiện tại: action="reset" (chạy macro khôi phục, thử lại) hoặc "skip"."""
+
+    def __init__(self, action, message):
+        super().__init__(message)
+        self.action = action
+
+
+class Watchdog:
+    """
+    Hạn giờ cho từng bước và từng dòng (đơn vị). Vòng chạy gọi row_started/step_started và
+    poll() trong lúc chờ (dò con trỏ busy) và giữa các bước. Mỗi lần một bước quá step_timeout
+    (hoặc hạn riêng step_timeouts[step_class]), mức leo thang tăng một bậc và đồng hồ bước đặt lại:
+    warn (cảnh báo) -> reset (macro khôi phục rồi thử lại) -> skip (bỏ dòng, ghi dòng lỗi)
+    -> abort (vẫn treo cả khi khôi phục sau bỏ dòng: dừng chạy).
+    Dòng quá row_timeout bị bỏ ngay; max_consecutive_skips dòng liên tiếp bị bỏ cũng dừng chạy.
+    Mọi lần kích hoạt nằm trong firings.
+    """
+
+    def __init__(self, step_timeout=DEFAULT_STEP_TIMEOUT, row_timeout=DEFAULT_ROW_TIMEOUT,
+                 step_timeouts=None, max_consecutive_skips=3, clock=time.monotonic):
+        self.step_timeout = step_timeout
+        self.row_timeout = row_timeout
+        self.step_timeouts = dict(step_timeouts or {})
+        self.max_consecutive_skips = max_consecutive_skips
+        self.clock = clock
+        self.firings = []
+        self.level = 0
+        self.consecutive_skips = 0
+        self._row = None
+        self._row_t0 = None
+        self._step = None
+        self._step_t0 = None
+
+    def row_started(self, label):
+        self._row = label
+        self._row_t0 = self._step_t0 = self.clock()
+        self._step = None
+        self.level = 0
+
+    def step_started(self, step):
+        self._step = step
+        self._step_t0 = self.clock()
+
+    def shift(self, seconds):
+        """Bỏ một khoảng thời gian (vd. lúc tạm dừng) khỏi đồng hồ của bước và dòng hiện tại."""
+        if self._row_t0 is not None:
+            self._row_t0 += seconds
+        if self._step_t0 is not None:
+            self._step_t0 += seconds
+
+    def _fire(self, stage, kind, elapsed):
+        record = {
+            "time": time.time(), "row": self._row, "stage": stage, "kind": kind,
+            "step": list(self._step[:2]) if self._step else None,
+            "class": step_class(self._step) if self._step else None,
+            "elapsed": round(elapsed, 3),
+        }
+        self.firings.append(record)
+        return record
+
+    def poll(self):
+        """Bản ghi kích hoạt mới (dict có "stage") hoặc None."""
+        if self._row_t0 is None:
+            return None
+        now = self.clock()
+        if self.row_timeout and now - self._row_t0 > self.row_timeout and not self.skipping:
+            self.level = WATCHDOG_STAGES.index("skip") + 1
+            self._step_t0 = now
+            return self._fire("skip", "row", now - self._row_t0)
+        limit = self.step_timeouts.get(step_class(self._step), self.step_timeout) if self._step else self.step_timeout
+        if limit and now - self._step_t0 > limit and self.level < len(WATCHDOG_STAGES):
+            elapsed = now - self._step_t0
+            self.level += 1
+            self._step_t0 = now
+            return self._fire(WATCHDOG_STAGES[self.level - 1], "step", elapsed)
+        return None
+
+    @property
+    def skipping(self):
+        """Đơn vị hiện tại đã bị yêu cầu bỏ (không thử lại nữa)."""
+        return self.level > WATCHDOG_STAGES.index("skip")
+
+    def row_finished(self, skipped=False):
+        """Kết thúc đơn vị. Trả về bản ghi "abort" nếu quá nhiều dòng liên tiếp bị bỏ, ngược lại None."""
+        self._row_t0 = None
+        if not skipped:
+            self.consecutive_skips = 0
+            return None
+        self.consecutive_skips += 1
+        if self.max_consecutive_skips and self.consecutive_skips >= self.max_consecutive_skips:
+            return self._fire("abort", "run", float(self.consecutive_skips))
+        return None
+
+
+# ---------- Row plan ----------
+# Trình tự phím cho một dòng, đúng như process_row cũ. Mỗi bước là một tuple:
+#   ("paste", cột 1-based)   dán giá trị của cột
+#   ("press", phím)          nhấn một phím
+#   ("hotkey", (phím, ...))  nhấn tổ hợp phím
+# Phần header (cột 1-10): nhập chứng từ, lưu, mở màn hình dòng (Alt+C).
+HEADER_PLAN = (
+    ("paste", 1), ("press", "down"),
+    ("paste", 2), ("press", "tab"), ("press", "tab"),
+    ("paste", 3), ("press", "tab"), ("press", "tab"), ("press", "tab"), ("press", "tab"), ("press", "tab"),
+    ("paste", 4), ("press", "tab"),
+    ("paste", 5), ("press", "enter"),
+    ("press", "tab"), ("press", "tab"),
+    ("paste", 6), ("press", "tab"),
+    ("paste", 7), ("press", "tab"),
+    ("paste", 8), ("press", "down"),
+    ("paste", 9), ("press", "tab"), ("press", "tab"),
+    ("paste", 10),
+    ("hotkey", ("ctrl", "s")), ("press", "enter"), ("hotkey", ("alt", "c")),
+    # Phần tử thứ 3 (nếu có) là nhóm delay riêng của bước, xem step_class
+    ("press", "down"), ("press", "down"), ("press", "down"), ("press", "down"), ("press", "enter", "lines"),
+)
+# Phần dòng chi tiết (cột 11-18)
+DETAIL_PLAN = (
+    ("paste", 11), ("press", "tab"), ("press", "tab"), ("press", "tab"),
+    ("paste", 12), ("press", "tab"), ("press", "tab"),
+    ("paste", 13), ("press", "tab"), ("press", "tab"),
+    # Paste col14 then col15 immediately (as specified)
+    ("paste", 14), ("paste", 15), ("press", "tab"),
+    ("paste", 16), ("hotkey", ("shift", "pagedown")), ("hotkey", ("shift", "pagedown")), ("press", "tab"),
+    ("paste", 17), ("press", "tab"), ("press", "tab"), ("press", "tab"),
+    ("paste", 18),
+)
+# Giữa hai dòng chi tiết của cùng một chứng từ (chế độ gom header): Down = Next Record,
+# Oracle Forms chuyển tới ô đầu tiên của bản ghi dòng kế tiếp
+LINE_ADVANCE_PLAN = (
+    ("press", "down"),
+)
+# Lưu dòng, đóng màn hình dòng, quay về chứng từ mới
+CLOSE_PLAN = (
+    ("hotkey", ("ctrl", "s")), ("press", "f4"), ("hotkey", ("shift", "pageup")), ("press", "down"),
+)
+ROW_PLAN = HEADER_PLAN + DETAIL_PLAN + CLOSE_PLAN
+
+# Các cột header: các dòng liên tiếp trùng các cột này có thể dùng chung một chứng từ
+HEADER_COLUMNS = tuple(range(1, 11))
+
+# Khai báo từng ô: True nếu Tabmis giữ lại giá trị của bản ghi trước cho ô này
+# (carry-forward-safe). Ở chế độ carry-forward, ô an toàn có giá trị trùng dòng trước
+# sẽ không dán lại; ô không an toàn luôn được dán.
+FIELD_CARRY_FORWARD = {
+    1: False, 2: False, 3: False, 4: False, 5: False,
+    6: True, 7: True, 8: True, 9: True, 10: False,
+    11: False, 12: True, 13: True, 14: False, 15: False,
+    16: False, 17: False, 18: False,
+}
+
+# Bước lưu (Ctrl+S): đo độ trễ tới khi Tabmis hết busy để RateGovernor điều tiết
+SAVE_STEP = ("hotkey", ("ctrl", "s"))
+# Ngưỡng độ trễ lưu (giây) mà GUI dùng khi bật điều tiết
+DEFAULT_SAVE_LATENCY_TARGET = 5.0
+# Mở menu (Alt+C)
+MENU_STEP = ("hotkey", ("alt", "c"))
+STEP_CLASSES = ("paste", "press", "hotkey", "save", "menu", "lines")
+
+
+def step_class(step):
+    """
+    Nhóm delay của một bước trong hồ sơ delay (delay_profile["step_delays"]): "save" (Ctrl+S),
+    "menu" (Alt+C), nhãn riêng của bước (vd. "lines": Enter mở màn hình dòng), còn lại theo loại.
+    """
+    if step == SAVE_STEP:
+        return "save"
+    if step == MENU_STEP:
+        return "menu"
+    # Bước paste đã ghép mang giá trị ở vị trí thứ 3, không phải nhãn
+    if step[0] != "paste" and len(step) > 2:
+        return step[2]
+    if step[0] == "keys":
+        return "press"
+    return step[0]
+
+
+def batch_key_runs(steps):
+    """
+    Gộp các bước press liền nhau (không nhãn) thành một bước ("keys", (phím, ...)): backend có
+    send_group gửi cả dãy trong một lô SendInput, chờ con trỏ và delay một lần cho cả dãy.
+    Bước có nhãn (vd. Enter mở màn hình dòng), paste và hotkey giữ nguyên.
+    """
+    out = []
+    for step in steps:
+        if step[0] == "press" and len(step) == 2 and out and out[-1][0] in ("press", "keys") \
+                and len(out[-1]) == 2:
+            prev = out.pop()
+            keys = prev[1] if prev[0] == "keys" else (prev[1],)
+            out.append(("keys", keys + (step[1],)))
+        else:
+            out.append(step)
+    return out
+
+
+def load_delay_profile(source):
+    """
+    Hồ sơ delay (do --sweep ghi ra): dict hoặc đường dẫn JSON
+    {"key_delay": ..., "between_rows_delay": ..., "step_delays": {"paste": ..., "save": ...},
+     "wait_cursor": ...}. Các khóa đều tùy chọn.
+    """
+    if source is None:
+        return {}
+    if isinstance(source, dict):
+        profile = dict(source)
+    else:
+        with open(source, encoding="utf-8") as f:
+            profile = json.load(f)
+    if not isinstance(profile, dict):
+        raise ValueError("Delay profile must be a JSON object")
+    unknown = set(profile.get("step_delays", {})) - set(STEP_CLASSES)
+    if unknown:
+        raise ValueError(f"Unknown step classes in delay profile: {sorted(unknown)}")
+    return profile
+
+
+def _unit_label(numbers):
+    """Nhãn hiển thị cho một đơn vị: "5" hoặc "5-9 (5 dòng)"."""
+    if len(numbers) == 1:
+        return str(numbers[0])
+    return f"{numbers[0]}-{numbers[-1]} ({len(numbers)} dòng)"
+
+
+# ---------- Tabmis simulator ----------
+# Mô hình form chứng từ như ROW_PLAN điều khiển: mỗi màn hình là dãy ô theo thứ tự Tab,
+# giá trị là số cột dữ liệu được nhập vào ô đó (None = ô không nhập, Tab đi qua).
+SIM_HEADER_SLOTS = (1, 2, None, 3, None, None, None, None, 4, 5, None, None, 6, 7, 8, 9, None, 10)
+SIM_DETAIL_SLOTS = (11, None, None, 12, None, 13, None, 14, 15, 16, 17, None, None, 18)
+# Ô đủ độ dài tự nhảy sang ô sau khi dán (cột 14 rồi dán tiếp cột 15)
+SIM_AUTOSKIP = {14}
+# Mục "Dòng" trong menu Alt+C (sau 4 lần Down)
+SIM_DETAIL_MENU_INDEX = 4
+DETAIL_COLUMNS = tuple(step[1] for step in DETAIL_PLAN if step[0] == "paste")
+# Phân bố độ trễ (giây): lưu (Ctrl+S), mở màn hình (menu, dòng), chuyển focus sau Tab/Enter/Down
+DEFAULT_SIM_LATENCY = {
+    "save": ("lognormal", 1.2, 0.4),
+    "screen": ("uniform", 0.3, 0.8),
+    "focus": ("uniform", 0.005, 0.03),
+}
+
+
+def make_latency(spec, rng=None):
+    """
+    Hàm lấy mẫu độ trễ (giây) từ spec: số (hằng), ("const", x), ("uniform", a, b),
+    ("normal", mean, sd), ("lognormal", median, sigma) hoặc ("empirical", [mẫu đo được]).
+    """
+    rng = rng or random.Random()
+    if isinstance(spec, (int, float)):
+        value = float(spec)
+        return lambda: value
+    kind, *params = spec
+    if kind == "const":
+        return lambda: float(params[0])
+    if kind == "uniform":
+        return lambda: rng.uniform(params[0], params[1])
+    if kind == "normal":
+        return lambda: max(0.0, rng.gauss(params[0], params[1]))
+    if kind == "lognormal":
+        mu = math.log(params[0])
+        return lambda: rng.lognormvariate(mu, params[1])
+    if kind == "empirical":
+        samples = [float(x) for x in params[0]]
+        return lambda: rng.choice(samples)
+    raise ValueError(f"Unknown latency distribution: {spec!r}")
+
+
+class TabmisSimulator(PywinautoBackend):
+    """
+    Form chứng từ Tabmis giả lập, dùng như một key backend để đo và kiểm tra trên máy không có
+    Tabmis (cả Linux). Mô hình:
+    - focus: Tab/Enter/Down chuyển ô trong header; Down trong màn hình dòng sang bản ghi dòng mới;
+      Ctrl+S lưu (busy theo phân bố "save") rồi hiện hộp thoại, Enter đóng hộp thoại;
+      Alt+C mở menu, Down chọn mục, Enter mở màn hình dòng (busy "screen");
+      F4 đóng màn hình dòng, Shift+PageUp/Down giữ focus, Down/F4 sau đó mở chứng từ mới.
+    - phím tới khi form đang busy bị mất (xác suất drop_while_busy);
+    - Ctrl+V tới trước khi focus chuyển xong (độ trễ "focus") rơi vào ô cũ.
+    - ô carry-forward (FIELD_CARRY_FORWARD) giữ giá trị của chứng từ/dòng trước.
+    Các chứng từ đã lưu nằm trong vouchers; verify() so với dữ liệu và trả về các ô nhập sai.
+    """
+    name = "simulator"
+
+    def __init__(self, latency=None, drop_while_busy=1.0, seed=None, clock=time.perf_counter):
+        super().__init__()
+        self.rng = random.Random(seed)
+        spec = dict(DEFAULT_SIM_LATENCY)
+        spec.update(latency or {})
+        self._latency = {k: make_latency(v, self.rng) for k, v in spec.items()}
+        self.drop_while_busy = float(drop_while_busy)
+        self.clock = clock
+        self.reset()
+
+    def reset(self):
+        self.clipboard = ""
+        self.vouchers = []
+        self.anomalies = []
+        self.stats = {"keys": 0, "pastes": 0, "dropped_keys": 0, "saves": 0}
+        self.busy_until = 0.0
+        self._header = {}
+        self._lines = [{}]
+        self._new_voucher()
+
+    # --- cửa sổ (focus_tabmis_window / capture_voucher dùng các method này) ---
+    def focus_window(self):
+        return self
+
+    def exists(self):
+        return True
+
+    def set_focus(self):
+        pass
+
+    def restore(self):
+        pass
+
+    def window_text(self):
+        if not self.vouchers:
+            return "Tabmis simulator"
+        return f"Tabmis simulator - {self.vouchers[-1]['no']:08d}"
+
+    def cursor_busy(self):
+        return self.clock() < self.busy_until
+
+    # --- trạng thái form ---
+    def _new_voucher(self):
+        """Chứng từ mới: ô carry-forward giữ giá trị của chứng từ/dòng trước."""
+        self._header = {c: v for c, v in self._header.items() if FIELD_CARRY_FORWARD.get(c)}
+        self._lines = [{c: v for c, v in self._lines[-1].items() if FIELD_CARRY_FORWARD.get(c)}]
+        self.screen = "header"
+        self.slot = self._focused = 0
+        self.settle_until = 0.0
+        self.menu_index = 0
+
+    def _note(self, kind, detail=""):
+        self.anomalies.append({"time": self.clock(), "screen": self.screen, "kind": kind, "detail": detail})
+
+    def _busy(self, kind):
+        now = self.clock()
+        self.busy_until = max(self.busy_until, now) + self._latency[kind]()
+
+    def _accept(self):
+        """Phím tới khi đang busy thì mất (theo drop_while_busy)."""
+        self.stats["keys"] += 1
+        if self.clock() < self.busy_until and self.rng.random() < self.drop_while_busy:
+            self.stats["dropped_keys"] += 1
+            return False
+        return True
+
+    def _slots(self):
+        return SIM_HEADER_SLOTS if self.screen == "header" else SIM_DETAIL_SLOTS
+
+    def _focus(self, slot):
+        now = self.clock()
+        if now >= self.settle_until:
+            self._focused = self.slot
+        self.slot = max(0, min(slot, len(self._slots()) - 1))
+        self.settle_until = now + self._latency["focus"]()
+
+    def _focused_slot(self):
+        return self.slot if self.clock() >= self.settle_until else self._focused
+
+    def _put(self, text):
+        self.stats["pastes"] += 1
+        if self.screen not in ("header", "detail"):
+            self._note("paste outside form", text)
+            return
+        col = self._slots()[self._focused_slot()]
+        if col is None:
+            self._note("paste into non-input item", text)
+            return
+        target = self._header if self.screen == "header" else self._lines[-1]
+        target[col] = text
+        if col in SIM_AUTOSKIP:
+            self._focus(self.slot + 1)
+
+    # --- key backend ---
+    def available(self):
+        return True
+
+    def copy(self, text):
+        self.clipboard = str(text)
+
+    def type_text(self, text):
+        if self._accept():
+            self._put(str(text))
+
+    def key(self, key):
+        if not self._accept():
+            return
+        screen = self.screen
+        if screen == "header":
+            if key in ("tab", "enter", "down"):
+                self._focus(self.slot + 1)
+            elif key == "up":
+                self._focus(self.slot - 1)
+            elif key == "f4":
+                self._new_voucher()
+        elif screen == "detail":
+            if key in ("tab", "enter"):
+                self._focus(self.slot + 1)
+            elif key == "down":
+                # Bản ghi dòng mới; ô carry-forward giữ giá trị dòng trước
+                self._lines.append({c: v for c, v in self._lines[-1].items() if FIELD_CARRY_FORWARD.get(c)})
+                self.slot = self._focused = 0
+            elif key in ("f4", "esc"):
+                self.screen = "closed"
+        elif screen == "dialog":
+            if key in ("enter", "esc"):
+                self.screen = "header"
+        elif screen == "menu":
+            if key == "down":
+                self.menu_index += 1
+            elif key == "up":
+                self.menu_index = max(0, self.menu_index - 1)
+            elif key == "enter":
+                if self.menu_index == SIM_DETAIL_MENU_INDEX:
+                    self.screen = "detail"
+                    self.slot = self._focused = 0
+                    self._busy("screen")
+                else:
+                    self._note("wrong menu item", self.menu_index)
+                    self.screen = "other"
+            elif key == "esc":
+                self.screen = "header"
+        elif screen == "other":
+            if key in ("esc", "f4"):
+                self.screen = "closed"
+        elif screen == "closed":
+            if key in ("down", "f4"):
+                self._new_voucher()
+
+    def hotkey(self, modifiers, key):
+        if not self._accept():
+            return
+        combo = (tuple(modifiers), key)
+        if combo == (("ctrl",), "v"):
+            self._put(self.clipboard)
+        elif combo == (("ctrl",), "s"):
+            if self.screen == "header":
+                self.stats["saves"] += 1
+                self._busy("save")
+                self.screen = "dialog"
+            elif self.screen == "detail":
+                self.stats["saves"] += 1
+                self._busy("save")
+                self.vouchers.append({
+                    "no": len(self.vouchers) + 1,
+                    "header": dict(self._header),
+                    "lines": [dict(line) for line in self._lines],
+                })
+            else:
+                self._note("save outside form")
+        elif combo == (("alt",), "c"):
+            if self.screen == "header":
+                self.screen = "menu"
+                self.menu_index = 0
+                self._busy("screen")
+            else:
+                self._note("menu outside header")
+        # Shift+PageUp/PageDown: cuộn danh sách giá trị, focus không đổi
+
+    # --- kết quả ---
+    def verify(self, units):
+        """
+        So các chứng từ đã lưu với các đơn vị dữ liệu (list các dòng, theo thứ tự chạy).
+        Trả về list ô nhập sai: {"voucher", "line", "col", "expected", "actual"}.
+        """
+        def cell(row, col):
+            return str(row[col - 1]) if col - 1 < len(row) else ""
+
+        mis = []
+        units = list(units)
+        for k, rows in enumerate(units):
+            if k >= len(self.vouchers):
+                mis.append({"voucher": k + 1, "line": None, "col": None, "expected": "saved", "actual": None})
+                continue
+            voucher = self.vouchers[k]
+            for col in HEADER_COLUMNS:
+                actual = voucher["header"].get(col, "")
+                if actual != cell(rows[0], col):
+                    mis.append({"voucher": k + 1, "line": None, "col": col,
+                                "expected": cell(rows[0], col), "actual": actual})
+            for j, row in enumerate(rows):
+                line = voucher["lines"][j] if j < len(voucher["lines"]) else {}
+                for col in DETAIL_COLUMNS:
+                    actual = line.get(col, "")
+                    if actual != cell(row, col):
+                        mis.append({"voucher": k + 1, "line": j + 1, "col": col,
+                                    "expected": cell(row, col), "actual": actual})
+        for voucher in self.vouchers[len(units):]:
+            mis.append({"voucher": voucher["no"], "line": None, "col": None, "expected": None, "actual": "saved"})
+        return mis
+
+    def report(self):
+        return dict(self.stats, vouchers=len(self.vouchers), anomalies=len(self.anomalies))
+
+
+KEY_BACKENDS["simulator"] = TabmisSimulator
+
+
+def simulate_file(data_path, start_row=2, end_row=None, key_delay=0.25, between_rows_delay=0.6,
+                  simulator=None, status_callback=None, **options):
+    """
+    Chạy file dữ liệu trên TabmisSimulator và trả về báo cáo:
+    tốc độ, phím bị mất, và danh sách ô nhập sai ("mis_keyed").
+    options được chuyển cho TabmisAutomator (wait_cursor, group_mode, carry_forward...);
+    clock=VirtualClock() chạy trên đồng hồ ảo (simulator đọc giờ từ chính đồng hồ đó).
+    """
+    sim = simulator or TabmisSimulator()
+    clock = options.get("clock")
+    if clock is not None and clock.virtual:
+        sim.clock = clock.monotonic
+    automator = TabmisAutomator(data_path, start_row, end_row, key_delay,
+                                between_rows_delay=between_rows_delay, start_delay=0,
+                                key_backend=sim, **options)
+    store = automator.load_rows(preview=True)
+    units = list(automator.iter_units(store)) if store is not None else []
+    automator.run(status_callback, preview=True)
+    m = automator.metrics
+    # Chỉ đối chiếu các đơn vị đã chạy xong (bỏ đơn vị lỗi và phần chưa chạy khi bị dừng)
+    failed = {n for n, _ in automator.failed_rows}
+    expected, done = [], m.get("rows_done", 0)
+    for numbers, rows in units:
+        if done <= 0:
+            break
+        if failed.intersection(numbers):
+            continue
+        expected.append(rows)
+        done -= len(numbers)
+    mis = sim.verify(expected)
+    report = sim.report()
+    report.update(
+        rows_done=m.get("rows_done", 0),
+        rows_failed=m.get("rows_failed", 0),
+        elapsed=m.get("elapsed"),
+        rows_per_hour=(m.get("rows_done", 0) * 3600.0 / m["elapsed"]) if m.get("elapsed") else None,
+        mis_keyed_fields=len(mis),
+        watchdog_firings=m.get("watchdog_firings", 0),
+        virtual_clock=bool(automator.clock.virtual),
+        mis_keyed=mis,
+    )
+    return report
+
+
+# ---------- Delay sweep ----------
+def fit_latency_model(trace_path, base=None):
+    """
+    Mô hình độ trễ (dạng DEFAULT_SIM_LATENCY, phân bố "empirical") từ file trace của một lần chạy
+    thật (--trace, nên bật chờ con trỏ). Độ trễ lưu/mở menu = từ lúc gửi Ctrl+S/Alt+C tới khi
+    lần chờ con trỏ kế tiếp kết thúc. Nhóm không có mẫu giữ giá trị của base.
+    """
+    with open(trace_path, encoding="utf-8") as f:
+        events = json.load(f).get("traceEvents", [])
+    events = sorted((e for e in events if e.get("ph") == "X"), key=lambda e: (e["tid"], e["ts"]))
+    samples = {"save": [], "screen": []}
+    pending = None   # (nhóm, thời điểm gửi, thời điểm xong bước, tid)
+    for e in events:
+        if pending is not None and e["tid"] == pending[3] and e["name"] == "busy-wait" and e["ts"] >= pending[2]:
+            samples[pending[0]].append((e["ts"] + e["dur"] - pending[1]) / 1e6)
+            pending = None
+        if e["name"] == "hotkey":
+            detail = e.get("args", {}).get("detail")
+            kind = {"ctrl+s": "save", "alt+c": "screen"}.get(detail)
+            if kind:
+                pending = (kind, e["ts"], e["ts"] + e["dur"], e["tid"])
+    model = dict(base or DEFAULT_SIM_LATENCY)
+    for kind, values in samples.items():
+        if values:
+            model[kind] = ("empirical", values)
+    return model
+
+
+def _virtual_run(units, profile, latency, wait_cursor, seed, carry_forward=False, group_mode=None):
+    """
+    Chạy các đơn vị bằng chính TabmisAutomator trên TabmisSimulator với VirtualClock (không ngủ thật).
+    Trả về (giây/dòng, tỉ lệ dòng có ô nhập sai).
+    """
+    clock = VirtualClock(start=0.0)
+    sim = TabmisSimulator(latency=latency, seed=seed, clock=clock.monotonic)
+    automator = TabmisAutomator(None, 2, None, profile.get("key_delay", 0.25), wait_cursor=wait_cursor,
+                                key_backend=sim, carry_forward=carry_forward, group_mode=group_mode,
+                                delay_profile=profile, clock=clock)
+    for rows in units:
+        automator.process_group(rows)
+        automator._commit_carry()
+        automator._sleep_with_cancel(automator.between_rows_delay)
+    rows_total = sum(len(rows) for rows in units)
+    bad = {(m["voucher"], m["line"]) for m in sim.verify(units)}
+    return clock.monotonic() / max(1, rows_total), len(bad) / max(1, rows_total)
+
+
+def pareto_frontier(points):
+    """Các điểm không bị trội (giây/dòng nhỏ hơn và tỉ lệ lỗi nhỏ hơn), sắp theo giây/dòng."""
+    frontier, best_error = [], float("inf")
+    for p in sorted(points, key=lambda p: (p["sec_per_row"], p["error_rate"])):
+        if p["error_rate"] < best_error:
+            frontier.append(p)
+            best_error = p["error_rate"]
+    return frontier
+
+
+def sweep_delays(units, latency=None, base_profile=None, wait_cursor=True, trials=10,
+                 max_error=0.0, margin=0.2, grid=None, bisect_steps=6, max_doublings=6, seed=1,
+                 carry_forward=False, group_mode=None, status_callback=None):
+    """
+    Tìm hồ sơ delay nhanh nhất có tỉ lệ dòng lỗi <= max_error trên mô hình độ trễ.
+    grid=None: tìm thích nghi (nếu hồ sơ ban đầu còn lỗi thì nhân đôi mọi delay trước), chia đôi delay từng nhóm bước (STEP_CLASSES), key_delay (còn dùng
+    làm thời gian chờ clipboard trước Ctrl+V) và between_rows_delay, trong khi giữ các nhóm khác; grid=[...]: thử từng key_delay đồng nhất trong danh sách.
+    Mỗi điểm chạy trials lần với cùng các seed (so sánh công bằng giữa các điểm).
+    Trả về (hồ sơ đề xuất, mọi điểm đã thử, frontier).
+    """
+    units = list(units)
+    base = load_delay_profile(base_profile) or {"key_delay": 0.25, "between_rows_delay": 0.6}
+    base.setdefault("key_delay", 0.25)
+    base.setdefault("between_rows_delay", 0.6)
+    points = []
+
+    def evaluate(profile):
+        results = [_virtual_run(units, profile, latency, wait_cursor, seed + t, carry_forward, group_mode)
+                   for t in range(trials)]
+        point = {
+            "sec_per_row": sum(r[0] for r in results) / trials,
+            "error_rate": sum(r[1] for r in results) / trials,
+            "profile": json.loads(json.dumps(profile)),
+        }
+        points.append(point)
+        if status_callback:
+            status_callback(f"{point['sec_per_row']:.3f}s/dòng, lỗi {point['error_rate']:.1%}: {profile}")
+        return point
+
+    if grid:
+        for kd in grid:
+            evaluate({"key_delay": kd, "between_rows_delay": base["between_rows_delay"], "step_delays": {}})
+    else:
+        current = {"key_delay": base["key_delay"], "between_rows_delay": base["between_rows_delay"],
+                   "step_delays": {c: base.get("step_delays", {}).get(c, base["key_delay"]) for c in STEP_CLASSES}}
+        # Hồ sơ ban đầu còn lỗi: nhân đôi mọi delay tới khi đạt (tối đa max_doublings lần)
+        doublings = 0
+        while evaluate(current)["error_rate"] > max_error and doublings < max_doublings:
+            current["key_delay"] *= 2
+            current["between_rows_delay"] *= 2
+            current["step_delays"] = {k: v * 2 for k, v in current["step_delays"].items()}
+            doublings += 1
+        if points[-1]["error_rate"] > max_error:
+            if status_callback:
+                status_callback("Không tìm được hồ sơ đạt max_error; kiểm tra mô hình độ trễ.")
+        else:
+            for name in STEP_CLASSES + ("key_delay", "between_rows_delay"):
+                holder = current if name in current else current["step_delays"]
+                lo, hi = 0.0, holder[name]
+                for _ in range(bisect_steps):
+                    mid = (lo + hi) / 2
+                    trial = json.loads(json.dumps(current))
+                    (trial if name in trial else trial["step_delays"])[name] = mid
+                    if evaluate(trial)["error_rate"] <= max_error:
+                        hi = mid
+                    else:
+                        lo = mid
+                holder[name] = hi
+
+    ok = [p for p in points if p["error_rate"] <= max_error]
+    best = min(ok, key=lambda p: p["sec_per_row"]) if ok else min(points, key=lambda p: p["error_rate"])
+    recommended = json.loads(json.dumps(best["profile"]))
+    # Biên an toàn cho sai khác giữa mô hình và Tabmis thật
+    scale = 1.0 + margin
+    recommended["key_delay"] = round(recommended["key_delay"] * scale, 4)
+    recommended["between_rows_delay"] = round(recommended["between_rows_delay"] * scale, 4)
+    recommended["step_delays"] = {k: round(v * scale, 4) for k, v in recommended.get("step_delays", {}).items()}
+    recommended["wait_cursor"] = bool(wait_cursor)
+    final = evaluate(dict(recommended))
+    recommended["expected"] = {"sec_per_row": round(final["sec_per_row"], 4),
+                               "rows_per_hour": round(3600.0 / final["sec_per_row"], 1) if final["sec_per_row"] else None,
+                               "error_rate": final["error_rate"], "margin": margin, "trials": trials}
+    return recommended, points, pareto_frontier(points)
+
+
 # ---------- Automation functions ----------
 class TabmisAutomator:
     def __init__(self, csv_path, start_row, end_row, key_delay,
-                 between_rows_delay=0.6, start_delay=3.0, wait_cursor=False):
+                 between_rows_delay=0.6, start_delay=3.0, wait_cursor=False,
+                 max_retries=1, reset_keys=DEFAULT_RESET_KEYS,
+                 failed_rows_path=None, rows=None, column_schema=None, key_backend=None,
+                 cancel_token=None, engine="thread", governor=None,
+                 group_mode=None, max_group_size=None, carry_forward=False, carry_fields=None,
+                 result_mode=None, result_flush_every=50, voucher_pattern=None,
+                 voucher_reader=None, tracer=None, trace_path=None, delay_profile=None,
+                 row_filter=None, watchdog=None, run_log=None,
+                 chunk_rows=DEFAULT_CHUNK_ROWS, prefetch_depth=DEFAULT_PREFETCH_DEPTH, reader="auto",
+                 catalogs=None, work_queue=None, clock=None):
         self.csv_path = csv_path
+        # Đồng hồ cho mọi lần ngủ/chờ/dò và metrics (SystemClock; VirtualClock khi chạy giả lập)
+        self.clock = clock or SYSTEM_CLOCK
         self.start_row = start_row
         self.end_row = end_row
         self.key_delay = float(key_delay)
         self.between_rows_delay = float(between_rows_delay)
         self.start_delay = float(start_delay)
         self.wait_cursor = bool(wait_cursor)
-        self._stop_requested = False
+        # Chính sách khôi phục: chạy reset macro rồi thử lại tối đa max_retries lần,
+        # sau đó ghi dòng vào failed_rows_path và chạy tiếp dòng sau.
+        self.max_retries = max(0, int(max_retries))
+        self.reset_keys = tuple(reset_keys or ())
+        self.failed_rows_path = failed_rows_path or (default_failed_rows_path(csv_path) if csv_path else None)
+        # Danh sách số dòng cụ thể (vd. chạy lại các dòng lỗi); None = start_row..end_row
+        self.rows = list(rows) if rows is not None else None
+        # Biểu thức lọc (parse_row_filter) áp trên vùng dòng đã chọn khi nạp dữ liệu
+        self.row_filter = row_filter or None
+        # Watchdog (tùy chọn, object hoặc dict tham số): hạn giờ bước/dòng,
+        # leo thang cảnh báo -> khôi phục -> bỏ dòng -> dừng
+        self.watchdog = (Watchdog(**dict({"clock": self.clock.monotonic}, **watchdog))
+                         if isinstance(watchdog, dict) else watchdog)
+        # Nạp theo khối chunk_rows dòng trên luồng nền, chồng lên lúc nhập phím (0/None = nạp hết trước)
+        self.chunk_rows = chunk_rows
+        self.prefetch_depth = prefetch_depth
+        self._pipeline = None
+        self._prefetched = None     # ((file, dòng đầu, dòng cuối), ChunkPipeline) của job kế tiếp
+        # Reader dữ liệu: "auto" (select_reader) hoặc tên trong DATA_READERS
+        self.reader = reader
+        # Hàng đợi dùng chung (tùy chọn, WorkQueue hoặc dict tham số): dòng lấy theo lô thuê từ DB
+        # thay vì đọc file, kết quả từng dòng báo lại DB
+        self.work_queue = WorkQueue(**work_queue) if isinstance(work_queue, dict) else work_queue
+        self._status_callback = None
+        self.column_schema = load_column_schema(column_schema)
+        # Danh mục tham chiếu (CatalogValidator): spec dict/JSON, None = <data>.catalogs.json nếu có
+        self.catalogs = catalogs
+        self.failed_rows = []
+        self._failed_lock = threading.Lock()
+        # Số liệu của lần chạy gần nhất (số dòng, thời gian, bộ nhớ...)
+        self.metrics = {}
+        # Mọi lần chờ/dò đều đi qua token này; stop() hoặc nguồn dừng gắn vào token sẽ ngắt ngay
+        self.cancel_token = cancel_token or CancelToken()
+        # "thread": vòng lặp đồng bộ như cũ; "asyncio": AsyncRunEngine
+        if engine not in ("thread", "asyncio"):
+            raise ValueError("engine must be 'thread' or 'asyncio'")
+        self.engine = engine
+        # RateGovernor (tùy chọn): giới hạn dòng/phút, giãn nhịp khi lưu chậm, khung giờ chạy
+        self.governor = governor
+        if self.clock.virtual:
+            # Watchdog/governor dựng sẵn với giờ hệ thống: chuyển sang đồng hồ ảo của lần chạy
+            if self.watchdog is not None and self.watchdog.clock is time.monotonic:
+                self.watchdog.clock = self.clock.monotonic
+            if governor is not None and governor._now is time.time:
+                governor._now = self.clock.time
+        # Gom header: None (mỗi dòng một chứng từ), "consecutive" hoặc "sort"
+        if group_mode not in (None, "consecutive", "sort"):
+            raise ValueError("group_mode must be None, 'consecutive' or 'sort'")
+        if group_mode == "sort" and self.work_queue is not None:
+            raise ValueError("group_mode 'sort' cannot be used with a work queue")
+        self.group_mode = group_mode
+        self.max_group_size = max_group_size
+        # Carry-forward: so kế hoạch đã ghép với dòng trước, bỏ các ô an toàn không đổi
+        self.carry_forward = bool(carry_forward)
+        self.carry_fields = dict(FIELD_CARRY_FORWARD)
+        if carry_fields:
+            self.carry_fields.update(carry_fields)
+        self._carry_prev = {}
+        # Giá trị/số ô bỏ qua của kế hoạch vừa ghép; chỉ thành _carry_prev khi đơn vị xong (_commit_carry)
+        self._carry_pending = None
+        # Sổ kết quả: None (không ghi), "sidecar" hoặc "source"; tạo mới cho mỗi job
+        self.result_mode = result_mode
+        self.result_flush_every = result_flush_every
+        self.ledger = None
+        # Số chứng từ đọc sau khi lưu: voucher_reader() nếu có, ngược lại tìm voucher_pattern (nhóm 1)
+        # trong tiêu đề cửa sổ Tabmis. Không có mặc định: tiêu đề có cả "TABMIS 2018" nên mẫu số chung
+        # chung sẽ đọc nhầm; mẫu phải neo vào phần số chứng từ, vd. r"Số CT:\s*(\d+)"
+        self.voucher_re = re.compile(voucher_pattern) if voucher_pattern else None
+        self.voucher_reader = voucher_reader
+        self._voucher = ""
+        # Đơn vị hiện tại đã gửi Ctrl+S: lỗi sau đó không được chạy lại từ đầu (sẽ lưu chứng từ thứ hai)
+        self._unit_saved = False
+        self._unit_started = None
+        # run(preview=True) (simulate_file): dòng lỗi chỉ giữ trong failed_rows, không ghi file dòng lỗi
+        self._preview = False
+        # Trace (tùy chọn): TraceRecorder ghi từng thao tác; trace_path thì ghi ra file khi xong/dừng
+        if tracer is None and trace_path:
+            tracer = TraceRecorder(clock=self.clock.monotonic)
+        elif tracer is not None and self.clock.virtual and tracer.clock is time.perf_counter:
+            tracer.clock = self.clock.monotonic
+            tracer._origin = tracer.clock()
+        self.tracer = tracer
+        self.trace_path = trace_path
+        self._unit_trace_start = None
+        # Nhật ký chạy (tùy chọn): RunLog dùng chung, hoặc dict tham số RunLog để mở/đóng theo từng lần chạy
+        self.run_log = run_log if isinstance(run_log, RunLog) else None
+        self._run_log_options = run_log if isinstance(run_log, dict) else None
+        self._current_unit = None
+        # Con trỏ kế hoạch: các bước của đơn vị đang nhập và vị trí bước kế tiếp
+        self._plan = ()
+        self._step_index = 0
+        # Tạm dừng ở ranh giới bước: clear() = tạm dừng, set() = chạy tiếp; dừng hẳn cũng đánh thức
+        self._resume = threading.Event()
+        self._resume.set()
+        self.cancel_token.on_cancel(lambda reason: self._resume.set())
+        # callback() khi tiếp tục mà không focus lại được Tabmis nên tự tạm dừng lại
+        # (JobRunner đưa job về "paused" để API/GUI không báo nhầm là đang chạy)
+        self.on_repause = None
+        # Trạng thái "ấm" dùng lại giữa nhiều file (chế độ hot-folder):
+        # cửa sổ Tabmis đã tìm thấy và bảng token phím đã dịch.
+        self._window = None
+        self._key_cache = {}
+        self._warm = False
+        # Backend phát phím: "pywinauto" (mặc định), "sendinput" hoặc một object backend
+        self.backend = make_key_backend(key_backend)
+        # Delay sau từng nhóm bước (step_class); nhóm không có trong đây dùng key_delay
+        self.step_delays = {}
+        if delay_profile:
+            self.apply_delay_profile(delay_profile)
+
+    def apply_delay_profile(self, profile):
+        """Nạp hồ sơ delay (xem load_delay_profile): ghi đè key_delay, between_rows_delay, step_delays."""
+        profile = load_delay_profile(profile)
+        if "key_delay" in profile:
+            self.key_delay = float(profile["key_delay"])
+        if "between_rows_delay" in profile:
+            self.between_rows_delay = float(profile["between_rows_delay"])
+        if "wait_cursor" in profile:
+            self.wait_cursor = bool(profile["wait_cursor"])
+        self.step_delays = {k: float(v) for k, v in profile.get("step_delays", {}).items()}
+        return profile
+
+    def step_delay(self, step):
+        return self.step_delays.get(step_class(step), self.key_delay)
+
+    def load_job(self, csv_path, start_row=2, end_row=None, rows=None, failed_rows_path=None):
+        """
+        Nạp job mới cho automator đang "ấm" (giữ cửa sổ, cache) thay vì tạo automator mới.
+        end_row=None nghĩa là chạy tới dòng cuối của file.
+        """
+        self.csv_path = csv_path
+        self.start_row = start_row
+        self.end_row = end_row
+        self.rows = list(rows) if rows is not None else None
+        self.failed_rows_path = failed_rows_path or default_failed_rows_path(csv_path)
+        self.failed_rows = []
+
+    @property
+    def _stop_requested(self):
+        return self.cancel_token.check()
+
+    def stop(self, reason="user"):
+        self.cancel_token.cancel(reason)
+
+    @property
+    def paused(self):
+        return not self._resume.is_set()
+
+    def pause(self):
+        self._resume.clear()
+
+    def resume(self):
+        self._resume.set()
+
+    def watchdog_check(self, status_callback=None):
+        """
+        Hỏi watchdog (nếu có). warn: báo trạng thái; abort: dừng chạy; reset/skip: ném
+        WatchdogTimeout để vòng chạy khôi phục form hoặc bỏ đơn vị hiện tại.
+        """
+        wd = self.watchdog
+        if wd is None:
+            return
+        firing = wd.poll()
+        if firing is not None:
+            self._handle_watchdog(firing, status_callback)
+
+    def _handle_watchdog(self, firing, status_callback=None):
+        stage = firing["stage"]
+        self.metrics["watchdog_firings"] = self.metrics.get("watchdog_firings", 0) + 1
+        self.metrics[f"watchdog_{stage}"] = self.metrics.get(f"watchdog_{stage}", 0) + 1
+        by_step = self.metrics.setdefault("watchdog_by_step", {})
+        key = firing["class"] or firing["kind"]
+        by_step[key] = by_step.get(key, 0) + 1
+        log = self.metrics.setdefault("watchdog_log", [])
+        log.append(firing)
+        del log[:-100]
+        if self.run_log is not None:
+            self.run_log.event("watchdog", logging.WARNING, **firing)
+        if firing["kind"] == "run":
+            message = f"Watchdog ({stage}): {int(firing['elapsed'])} dòng liên tiếp bị bỏ, dừng chạy"
+        else:
+            message = (f"Watchdog ({stage}): dòng {firing['row']}, bước {firing['step']} "
+                       f"quá hạn {firing['elapsed']}s")
+        cb = status_callback or self._status_callback
+        if cb:
+            cb(message)
+        if stage == "abort":
+            self.stop("watchdog")
+        elif stage in ("reset", "skip"):
+            raise WatchdogTimeout(stage, message)
+
+    def step_cursor(self):
+        """Vị trí trong kế hoạch: {"row", "step" (1-based, bước sắp chạy), "steps", "action"}; None nếu chưa chạy."""
+        if not self._plan:
+            return None
+        step = self._plan[self._step_index]
+        if step[0] == "paste":
+            action = f"dán cột {step[1]}"
+        elif step[0] == "press":
+            action = step[1]
+        elif step[0] == "keys":
+            action = " ".join(step[1])
+        else:
+            action = "+".join(step[1])
+        return {"row": self._current_unit, "step": self._step_index + 1, "steps": len(self._plan), "action": action}
+
+    def wait_if_paused(self, status_callback=None):
+        """
+        Chặn ở ranh giới bước khi đang tạm dừng, giữ nguyên con trỏ dòng/bước (step_cursor).
+        Khi tiếp tục: focus lại cửa sổ Tabmis đã lưu (không đếm ngược, không dò lại nếu cửa sổ
+        còn) rồi chạy tiếp đúng bước đó; không focus được thì vẫn tạm dừng. Thời gian tạm dừng
+        không tính vào watchdog và thời gian của dòng. Trả về True nếu bị dừng trong lúc chờ.
+        """
+        if self._resume.is_set():
+            return self._stop_requested
+        status_callback = status_callback or self._status_callback
+        cursor = self.step_cursor() or {}
+        where = (f" ở dòng {cursor['row']}, bước {cursor['step']}/{cursor['steps']} ({cursor['action']})"
+                 if cursor else "")
+        if status_callback:
+            status_callback(f"Tạm dừng{where}.")
+        if self.run_log is not None:
+            self.run_log.event("paused", **cursor)
+        self.metrics["pauses"] = self.metrics.get("pauses", 0) + 1
+        while True:
+            started = self.clock.time()
+            self._resume.wait()
+            paused = self.clock.time() - started
+            self.metrics["paused_seconds"] = self.metrics.get("paused_seconds", 0.0) + paused
+            if self.watchdog is not None:
+                self.watchdog.shift(paused)
+            if self._unit_started is not None:
+                self._unit_started += paused
+            if self._stop_requested:
+                return True
+            if self.focus_tabmis_window(status_callback):
+                break
+            if status_callback:
+                status_callback("Không focus lại được cửa sổ Tabmis: vẫn tạm dừng, mở Tabmis rồi bấm Tiếp tục.")
+            self.pause()
+            if self.on_repause is not None:
+                self.on_repause()
+        if self.run_log is not None:
+            self.run_log.event("resumed", **cursor)
+        if status_callback:
+            status_callback(f"Tiếp tục{where}.")
+        return False
+
+    def focus_tabmis_window(self, status_callback=None):
+        """
+        Tìm và focus vào cửa sổ Tabmis có title "Các ứng dụng Oracle - Môi trường sản xuất TABMIS 2018".
+        Trả về True nếu thành công, False nếu không tìm thấy.
+        """
+        if Application is None and not hasattr(self.backend, "focus_window"):
+            if status_callback:
+                status_callback("pywinauto.Application not available. Cannot focus window.")
+            return False
+
+        # Backend tự quản lý cửa sổ (vd. TabmisSimulator)
+        focus = getattr(self.backend, "focus_window", None)
+        if focus is not None:
+            self._window = focus()
+            return self._window is not None
+
+        window_title = "Các ứng dụng Oracle - Môi trường sản xuất TABMIS 2018"
+
+        # Dùng lại cửa sổ đã tìm thấy lần trước (nếu còn tồn tại) để khỏi dò lại
+        if self._window is not None:
+            try:
+                if self._window.exists():
+                    self._window.set_focus()
+                    self._window.restore()
+                    self._sleep_with_cancel(0.2)
+                    return True
+            except Exception:
+                pass
+            self._window = None
+
+        try:
+            # Cách 1: Thử connect theo title chính xác
+            try:
+                app = Application(backend="win32").connect(title=window_title, timeout=2)
+                window = app.window(title=window_title)
+                if window.exists():
+                    window.set_focus()
+                    window.restore()  # Đảm bảo cửa sổ không bị minimize
+                    self._window = window
+                    if status_callback:
+                        status_callback(f"Đã focus vào cửa sổ Tabmis")
+                    self._sleep_with_cancel(0.5)  # Đợi một chút để cửa sổ focus xong
+                    return True
+            except Exception:
+                pass
+            
+            # Cách 2: Thử tìm bằng Desktop (tìm tất cả cửa sổ)
+            try:
+                from pywinauto import Desktop
+                desktop = Desktop(backend="win32")
+                windows = desktop.windows()
+                for w in windows:
+                    if w.is_visible() and window_title in w.window_text():
+                        w.set_focus()
+                        w.restore()
+                        self._window = w
+                        if status_callback:
+                            status_callback(f"Đã focus vào cửa sổ Tabmis")
+                        self._sleep_with_cancel(0.5)
+                        return True
+            except Exception:
+                pass
+            
+            # Cách 3: Tìm bằng từ khóa TABMIS và Oracle (fuzzy match)
+            try:
+                from pywinauto import Desktop
+                desktop = Desktop(backend="win32")
+                windows = desktop.windows()
+                for w in windows:
+                    text = w.window_text()
+                    if w.is_visible() and "TABMIS" in text and ("Oracle" in text or "Môi trường" in text):
+                        w.set_focus()
+                        w.restore()
+                        self._window = w
+                        if status_callback:
+                            status_callback(f"Đã focus vào cửa sổ Tabmis (tìm kiếm mờ)")
+                        self._sleep_with_cancel(0.5)
+                        return True
+            except Exception:
+                pass
+            
+            if status_callback:
+                status_callback(f"Không tìm thấy cửa sổ Tabmis. Vui lòng mở cửa sổ trước.")
+            return False
+            
+        except Exception as e:
+            if status_callback:
+                status_callback(f"Lỗi khi tìm cửa sổ Tabmis: {e}")
+            return False
+
+    @_traced("sleep", detail=lambda seconds: seconds)
+    def _sleep_with_cancel(self, total_seconds):
+        """Ngủ trên cancel token (qua self.clock): trả về ngay khi có lệnh dừng. Trả về True nếu bị dừng."""
+        return self.clock.wait(self.cancel_token, float(total_seconds))
+
+    def is_cursor_busy(self):
+        """
+        Kiểm tra con trỏ chuột có đang là Hourglass / AppStarting hay không.
+        Hiện thực Windows-only (sử dụng Win32 API). Trả về True nếu đang là cursor 'wait' hoặc 'appstarting'.
+        Trên hệ khác trả về False.
+        """
+        if not self.wait_cursor:
+            return False
+        # Backend có trạng thái busy riêng (vd. TabmisSimulator)
+        probe = getattr(self.backend, "cursor_busy", None)
+        if probe is not None:
+            return probe()
+        if platform.system() != "Windows":
+            # Không hỗ trợ trên non-Windows trong phiên bản này
+            return False
+        try:
+            user32 = ctypes.windll.user32
+
+            class POINT(ctypes.Structure):
+                _fields_ = [("x", ctypes.c_long), ("y", ctypes.c_long)]
+
+            class CURSORINFO(ctypes.Structure):
+                _fields_ = [
+                    ("cbSize", ctypes.c_uint),
+                    ("flags", ctypes.c_uint),
+                    ("hCursor", ctypes.c_void_p),
+                    ("ptScreenPos", POINT),
+                ]
+
+            ci = CURSORINFO()
+            ci.cbSize = ctypes.sizeof(CURSORINFO)
+            res = user32.GetCursorInfo(ctypes.byref(ci))
+            if not res:
+                return False
+            cur = ci.hCursor
+
+            # IDC_WAIT = 32514, IDC_APPSTARTING = 32650
+            IDC_WAIT = 32514
+            IDC_APPSTARTING = 32650
+            try:
+                wait_h = user32.LoadCursorW(0, IDC_WAIT)
+                appstart_h = user32.LoadCursorW(0, IDC_APPSTARTING)
+            except Exception:
+                # Nếu LoadCursorW không nhận integer (hiếm), fallback False
+                wait_h = None
+                appstart_h = None
+
+            # So sánh handle; nếu trùng với một trong các handle hệ thống, coi là busy
+            if cur and (cur == wait_h or cur == appstart_h):
+                return True
+            return False
+        except Exception:
+            # Nếu có lỗi, không block (tránh treo)
+            return False
+
+    def readiness_probe(self):
+        """Dò được lúc Tabmis hết bận không: bật chờ con trỏ, trên Windows hoặc backend có cursor_busy."""
+        return self.wait_cursor and (platform.system() == "Windows" or hasattr(self.backend, "cursor_busy"))
+
+    @_traced("busy-wait")
+    def wait_while_cursor_busy(self, status_callback=None):
+        """
+        Nếu tùy chọn chờ được bật thì lặp kiểm tra con trỏ cho tới khi không còn busy.
+        Gọi status_callback(text) để cập nhật UI khi cần.
+        """
+        if not self.wait_cursor:
+            return
+        # Nếu không phải Windows, thông báo 1 lần (không spam)
+        if platform.system() != "Windows" and not hasattr(self.backend, "cursor_busy"):
+            if status_callback:
+                status_callback("Wait-cursor tính năng chỉ hỗ trợ Windows — bỏ qua.")
+            return
+        # Lặp cho đến khi cursor không busy hoặc người dùng dừng
+        waited = 0.0
+        while not self._stop_requested and self.is_cursor_busy():
+            if status_callback:
+                status_callback("Đang chờ con trỏ chuột hết busy...")
+            self.watchdog_check(status_callback)
+            self._sleep_with_cancel(0.1)
+            waited += 0.1
+            # Sau một khoảng thời gian dài, cập nhật status để người dùng biết
+            if status_callback and (int(waited) % 5 == 0):
+                status_callback(f"Đang chờ con trỏ... {int(waited)}s")
+        if status_callback and not self._stop_requested:
+            status_callback("Con trỏ đã sẵn sàng, tiếp tục...")
+
+    @_traced("paste")
+    def paste_text(self, text, status_callback=None, delay=None):
+        if self._stop_requested:
+            return
+        if not self.backend.available():
+            if status_callback:
+                status_callback(f"Backend '{self.backend.name}' not available. Install via: pip install pywinauto")
+            return
+
+        # Nếu bật tùy chọn chờ con trỏ, đợi trước khi thao tác clipboard/dán
+        self.wait_while_cursor_busy(status_callback=status_callback)
+
+        if text is None:
+            text = ""
+        text = str(text)
+        try:
+            self.backend.copy(text)
+            self._sleep_with_cancel(min(0.1, self.key_delay / 4))
+            if self._stop_requested:
+                return
+            # Ctrl+V
+            self.backend.hotkey(("ctrl",), "v")
+        except Exception:
+            # fallback: gõ thẳng cả chuỗi trong một lần gửi (không qua clipboard)
+            try:
+                if not self._stop_requested:
+                    self.backend.type_text(text)
+            except Exception:
+                pass
+        self._sleep_with_cancel(self.key_delay if delay is None else delay)
+
+    def _normalize_key_name(self, key):
+        """Chuẩn hóa tên phím đầu vào"""
+        key = str(key).lower().strip()
+        key_map = {
+            'pagedown': 'pagedown',
+            'page down': 'pagedown',
+            'pgdn': 'pagedown',
+            'pageup': 'pageup',
+            'page up': 'pageup',
+            'pgup': 'pageup',
+            'ctrl': 'ctrl',
+            'control': 'ctrl',
+            'alt': 'alt',
+            'shift': 'shift',
+            'win': 'win',
+            'command': 'win',
+            'cmd': 'win',
+            'enter': 'enter',
+            'esc': 'esc',
+            'tab': 'tab',
+            'down': 'down',
+            'up': 'up',
+            'left': 'left',
+            'right': 'right',
+            'space': 'space',
+            'f4': 'f4',
+        }
+        return key_map.get(key, key)
+
+    @_traced("press", detail=lambda key, count=1: key)
+    def press(self, key, count=1, delay=None):
+        if not self.backend.available():
+            return
+        name = self._key_cache.get(key)
+        if name is None:
+            name = self._normalize_key_name(key)
+            self._key_cache[key] = name
+        for _ in range(count):
+            if self._stop_requested:
+                return
+            if self.wait_cursor:
+                self.wait_while_cursor_busy()
+            try:
+                self.backend.key(name)
+            except Exception:
+                pass
+            self._sleep_with_cancel(self.key_delay if delay is None else delay)
+
+    @_traced("keys", detail=lambda keys: " ".join(keys))
+    def press_keys(self, keys, delay=None):
+        """Một dãy phím (bước "keys" của batch_key_runs) trong một lần send_group, rồi delay một lần."""
+        if not self.backend.available() or self._stop_requested:
+            return
+        self.wait_while_cursor_busy()
+        actions = []
+        for key in keys:
+            name = self._key_cache.get(key)
+            if name is None:
+                name = self._key_cache[key] = self._normalize_key_name(key)
+            actions.append(("key", name))
+        try:
+            self.backend.send_group(actions)
+        except Exception:
+            pass
+        self._sleep_with_cancel(self.key_delay if delay is None else delay)
+
+    @_traced("hotkey", detail=lambda *keys: "+".join(keys))
+    def hotkey(self, *keys, delay=None):
+        """
+        Nhấn tổ hợp phím qua backend. Với backend pywinauto:
+        - Ctrl -> '^', Shift -> '+', Alt -> '%' prefix.
+        Ví dụ:
+            hotkey('ctrl','s') -> '^s'
+            hotkey('shift','pagedown') -> '+{PGDN}'
+            hotkey('alt','c') -> '%c'
+        Backend sendinput gửi cả tổ hợp (modifier down, phím, modifier up) trong một lô SendInput.
+        """
+        if not self.backend.available():
+            return
+        if self._stop_requested:
+            return
+        if delay is None:
+            delay = self.key_delay
+
+        self.wait_while_cursor_busy()
+
+        normalized = [self._normalize_key_name(k) for k in keys]
+
+        modifiers = tuple(k for k in normalized if k in MODIFIER_KEYS)
+        main_keys = [k for k in normalized if k not in MODIFIER_KEYS]
+
+        if not main_keys:
+            # No main key — try to send modifiers alone (rare)
+            try:
+                self.backend.hotkey(modifiers, None)
+            except Exception:
+                pass
+            self._sleep_with_cancel(delay)
+            return
+
+        for mk in main_keys:
+            if self._stop_requested:
+                return
+            try:
+                self.backend.hotkey(modifiers, mk)
+            except Exception:
+                pass
+            self._sleep_with_cancel(0.02)
+
+        self._sleep_with_cancel(delay)
+
+    def run_reset_macro(self, status_callback=None):
+        """Chạy macro reset (mặc định Esc, F4) để đưa form về trạng thái đã biết."""
+        # Sau reset không biết form còn giữ giá trị nào: lần sau dán lại đủ mọi ô
+        self._carry_prev.clear()
+        for item in self.reset_keys:
+            if self._stop_requested:
+                return
+            keys = [k for k in str(item).split('+') if k]
+            if len(keys) > 1:
+                self.hotkey(*keys)
+            elif keys:
+                self.press(keys[0])
+        self.wait_while_cursor_busy(status_callback=status_callback)
+
+    def record_failed_row(self, row_number, row, reason):
+        """Ghi thêm một dòng lỗi (số dòng, lý do, thời điểm, dữ liệu gốc) vào file dòng lỗi."""
+        self.record_failed_rows([(row_number, row, reason)])
+
+    def record_failed_rows(self, items):
+        """
+        Ghi nhiều dòng lỗi (số dòng, dữ liệu, lý do) trong một lần mở file; gọi được từ luồng nạp.
+        Chạy xem trước (run(preview=True)) chỉ giữ trong self.failed_rows.
+        """
+        stamp = time.strftime("%Y-%m-%d %H:%M:%S")
+        with self._failed_lock:
+            if self._preview:
+                self.failed_rows.extend((row_number, str(reason)) for row_number, _, reason in items)
+                return
+            new_file = not os.path.exists(self.failed_rows_path)
+            with open(self.failed_rows_path, "a", newline='', encoding='utf-8') as f:
+                writer = csv.writer(f)
+                if new_file:
+                    writer.writerow(FAILED_ROWS_HEADER)
+                for row_number, row, reason in items:
+                    self.failed_rows.append((row_number, str(reason)))
+                    writer.writerow([row_number, str(reason), stamp] + list(row))
+
+    def row_numbers(self, total_rows=None):
+        """Các số dòng (1-based) sẽ chạy, theo thứ tự."""
+        if self.rows is not None:
+            return list(self.rows)
+        end_row = self.end_row if self.end_row is not None else (total_rows or 0)
+        return list(range(self.start_row, end_row + 1))
+
+    def get_cell(self, row, col_1based):
+        idx = col_1based - 1
+        if idx < 0:
+            return ""
+        if idx < len(row):
+            return row[idx]
+        return ""
+
+    def _fill_plan(self, plan, row, steps, carry=None):
+        """carry: [giá trị theo cột trên form, số ô bỏ qua] khi bật carry-forward (cập nhật tại chỗ)."""
+        for step in plan:
+            if step[0] == "paste":
+                col = step[1]
+                value = self.get_cell(row, col)
+                if carry is not None:
+                    # Ô an toàn và trùng giá trị đã có trên form: giữ nguyên, chỉ điều hướng
+                    if self.carry_fields.get(col) and carry[0].get(col) == value:
+                        carry[1] += 1
+                        continue
+                    carry[0][col] = value
+                steps.append(("paste", col, value))
+            else:
+                steps.append(step)
+
+    def _commit_carry(self):
+        """Đơn vị đã nhập xong: form giữ đúng các giá trị của kế hoạch vừa chạy."""
+        pending, self._carry_pending = self._carry_pending, None
+        if pending is not None:
+            self._carry_prev = pending[0]
+            self.metrics["pastes_skipped"] = self.metrics.get("pastes_skipped", 0) + pending[1]
+
+    def compile_group(self, rows):
+        """
+        Kế hoạch cho một nhóm dòng cùng header: header một lần (giá trị của dòng đầu),
+        rồi lần lượt các dòng chi tiết cách nhau bởi LINE_ADVANCE_PLAN, cuối cùng CLOSE_PLAN.
+        Nhóm một dòng cho ra đúng ROW_PLAN. Backend gửi theo lô (batches_input, vd. SendInput)
+        nhận các dãy press liền nhau đã gộp thành bước "keys" (batch_key_runs).
+        """
+        steps = []
+        # Carry-forward so với bản sao: _carry_prev chỉ đổi khi đơn vị xong (lỗi/dừng giữa chừng thì
+        # form không chắc đã nhận các giá trị này)
+        carry = [dict(self._carry_prev), 0] if self.carry_forward else None
+        self._fill_plan(HEADER_PLAN, rows[0], steps, carry)
+        for k, row in enumerate(rows):
+            if k:
+                self._fill_plan(LINE_ADVANCE_PLAN, row, steps, carry)
+            self._fill_plan(DETAIL_PLAN, row, steps, carry)
+        self._fill_plan(CLOSE_PLAN, rows[-1], steps, carry)
+        self._carry_pending = carry
+        if getattr(self.backend, "batches_input", False):
+            return batch_key_runs(steps)
+        return steps
+
+    def compile_row(self, row):
+        """Ghép ROW_PLAN với dữ liệu của dòng: mỗi bước paste mang sẵn chuỗi cần dán."""
+        return self.compile_group([row])
+
+    def header_key(self, row):
+        return tuple(self.get_cell(row, c) for c in HEADER_COLUMNS)
+
+    def iter_units(self, store):
+        """
+        Các đơn vị công việc theo thứ tự chạy: (list số dòng, list dòng).
+        Không gom: mỗi dòng một đơn vị. group_mode="consecutive": gom các dòng liền nhau
+        trùng header; "sort": sắp xếp ổn định theo header trước rồi gom.
+        Với work_queue, đơn vị có dòng đã bị máy khác thuê lại bị bỏ ngay trước khi nhập.
+        """
+        units = self._group_units(store)
+        if self.work_queue is None:
+            return units
+        return self._held_units(units)
+
+    def _held_units(self, units):
+        for numbers, rows in units:
+            if self.work_queue.lost(numbers):
+                self.metrics["rows_lost"] = self.metrics.get("rows_lost", 0) + len(numbers)
+                continue
+            yield numbers, rows
+
+    def _group_units(self, store):
+        if not self.group_mode:
+            for i, row in store:
+                yield [i], [row]
+            return
+        # "consecutive" gom lười nên chạy được trên ChunkPipeline (nhóm có thể vắt qua hai khối)
+        items = store
+        if self.group_mode == "sort":
+            items = sorted(store, key=lambda it: self.header_key(it[1]))
+        for _, grp in itertools.groupby(items, key=lambda it: self.header_key(it[1])):
+            grp = list(grp)
+            limit = self.max_group_size or len(grp)
+            for k in range(0, len(grp), limit):
+                chunk = grp[k:k + limit]
+                yield [n for n, _ in chunk], [r for _, r in chunk]
+
+    def capture_voucher(self):
+        """Đọc số chứng từ Tabmis vừa tạo (sau Ctrl+S). Trả về chuỗi rỗng nếu không đọc được."""
+        try:
+            if self.voucher_reader is not None:
+                return str(self.voucher_reader() or "")
+            if self._window is None or self.voucher_re is None:
+                return ""
+            m = self.voucher_re.search(self._window.window_text() or "")
+            return m.group(1) if m else ""
+        except Exception:
+            return ""
+
+    def _after_save(self):
+        if self.ledger is not None and not self._voucher:
+            self._voucher = self.capture_voucher()
+
+    def execute_step(self, step):
+        log = self.run_log
+        if log is None:
+            return self._execute_step(step)
+        started = self.clock.monotonic()
+        outcome = "ok"
+        try:
+            self._execute_step(step)
+        except BaseException as e:
+            outcome = type(e).__name__
+            raise
+        finally:
+            log.step(self._current_unit, step, self.clock.monotonic() - started, outcome)
+
+    def _execute_step(self, step):
+        kind = step[0]
+        if self.tracer is not None:
+            self.tracer.col = step[1] if kind == "paste" else None
+        delay = self.step_delays.get(step_class(step)) if self.step_delays else None
+        if kind == "paste":
+            self.paste_text(step[2], delay=delay)
+        elif kind == "press":
+            self.press(step[1], delay=delay)
+        elif kind == "keys":
+            self.press_keys(step[1], delay=delay)
+        elif kind == "hotkey":
+            if step == SAVE_STEP:
+                self._unit_saved = True
+            # Không dò được lúc hết busy thì "độ trễ lưu" chỉ là key delay: không đo
+            if step == SAVE_STEP and self.governor is not None and self.readiness_probe():
+                started = self.clock.time()
+                self.hotkey(*step[1], delay=delay)
+                self.wait_while_cursor_busy()
+                self.governor.observe_save(self.clock.time() - started)
+            else:
+                self.hotkey(*step[1], delay=delay)
+            if step == SAVE_STEP:
+                self._after_save()
+        else:
+            raise ValueError(f"Unknown step: {step!r}")
+
+    def process_group(self, rows):
+        if self._stop_requested:
+            return
+        wd = self.watchdog
+        self._plan = plan = self.compile_group(rows)
+        for k, step in enumerate(plan):
+            self._step_index = k
+            if self._stop_requested or self.wait_if_paused():
+                return
+            if wd is not None:
+                self.watchdog_check()
+                wd.step_started(step)
+            self.execute_step(step)
+
+    def process_row(self, row):
+        # Follow the user's specified sequence exactly (ROW_PLAN)
+        self.process_group([row])
+
+    def _row_window(self):
+        """(dòng đầu, dòng cuối hoặc None, set các dòng cần lấy hoặc None) của job hiện tại."""
+        if self.rows is not None:
+            wanted = set(self.rows)
+            if not wanted:
+                return 1, 0, wanted
+            return min(wanted), max(wanted), wanted
+        return self.start_row, self.end_row, None
+
+    def read_selected(self):
+        """
+        Chỉ đọc các dòng được chọn và cột 1..USED_COLUMNS của file dữ liệu (qua reader, xem select_reader).
+        Trả về (số dòng thực có trong file theo thứ tự chạy, DataFrame cột 1..USED_COLUMNS).
+        Đọc theo khối và chỉ giữ các dòng cần lấy nên danh sách dòng thưa trên file lớn vẫn gọn.
+        """
+        first, last, wanted = self._row_window()
+        reader = make_reader(self.reader, self.csv_path, first, last, BENCH_CHUNK_ROWS)
+        if wanted is not None and hasattr(reader, "read_rows"):
+            chunks = [reader.read_rows(self.csv_path, wanted)]
+        else:
+            chunks = iter_data_chunks(self.csv_path, first, last, BENCH_CHUNK_ROWS, reader)
+        numbers, parts = [], []
+        for nums, part in chunks:
+            if wanted is not None:
+                keep = [k for k, n in enumerate(nums) if n in wanted]
+                nums, part = [nums[k] for k in keep], part.iloc[keep]
+            numbers.extend(nums)
+            parts.append(part)
+        if not parts:
+            return [], pd.DataFrame(columns=list(range(1, USED_COLUMNS + 1)), dtype=object)
+        sub = pd.concat(parts, ignore_index=True) if len(parts) > 1 else parts[0].reset_index(drop=True)
+        if self.rows is not None:
+            position = {n: k for k, n in enumerate(numbers)}
+            order = [position[r] for r in self.rows if r in position]
+            numbers, sub = [numbers[k] for k in order], sub.iloc[order].reset_index(drop=True)
+        return numbers, sub
+
+    def _filter_context(self, data_path):
+        """(mệnh đề row_filter đã phân tích, trạng thái dòng hoặc None); trạng thái "done" chỉ đọc khi cần."""
+        predicates = self.row_filter
+        if isinstance(predicates, str):
+            try:
+                predicates = parse_row_filter(predicates)
+            except ValueError:
+                # Có thể là tên cột: đọc dòng 1 rồi phân tích lại
+                predicates = parse_row_filter(predicates, read_header(data_path))
+        statuses = load_row_status(data_path) if any(p[0] == "status" for p in predicates) else None
+        return predicates, statuses
+
+    def _catalog_validator(self, data_path):
+        source = self.catalogs if self.catalogs is not None else find_catalog_file(data_path)
+        return CatalogValidator(source) if source else None
+
+    def _header_groups(self, table):
+        """
+        Mã đơn vị (chứng từ) của từng dòng table theo group_mode: "sort" = cùng header,
+        "consecutive" = đoạn liền nhau cùng header; max_group_size cắt mỗi nhóm thành nhiều
+        chứng từ theo thứ tự dòng, đúng như _group_units. Mã tăng dần theo lần xuất hiện.
+        """
+        codes = table.groupby(list(HEADER_COLUMNS), sort=False, dropna=False).ngroup().to_numpy()
+        if self.group_mode == "consecutive" and len(codes):
+            codes = np.concatenate(([0], np.cumsum(codes[1:] != codes[:-1])))
+        if self.max_group_size and len(codes):
+            part = pd.Series(codes).groupby(codes).cumcount().to_numpy() // self.max_group_size
+            codes = pd.factorize(codes * (int(part.max()) + 1) + part)[0]
+        return codes
+
+    def _validate_catalogs(self, table, numbers, validator, stats, record=True):
+        """
+        Bỏ khỏi vùng dòng các dòng có mã ngoài danh mục, ghi chúng vào file dòng lỗi nếu record
+        (không nhập vào Tabmis). Khi gom header, một dòng sai bỏ cả chứng từ của nó (đơn vị
+        _group_units, kể cả khi max_group_size cắt nhóm header): nhập phần còn lại sẽ lưu một
+        chứng từ thiếu dòng. Trả về (table, numbers) còn lại.
+        """
+        started = time.perf_counter()
+        invalid = validator.invalid(table)
+        if invalid and self.group_mode:
+            groups = self._header_groups(table)
+            first_bad = {}
+            for pos in invalid:
+                first_bad.setdefault(groups[pos], pos)
+            for pos in np.flatnonzero(np.isin(groups, list(first_bad))):
+                pos = int(pos)
+                if pos not in invalid:
+                    invalid[pos] = f"cùng chứng từ với dòng {numbers[first_bad[groups[pos]]]} (sai mã danh mục)"
+            invalid = dict(sorted(invalid.items()))
+        if invalid and record:
+            self.record_failed_rows([(numbers[pos], table.iloc[pos].tolist(), reason)
+                                     for pos, reason in invalid.items()])
+            if self.run_log is not None:
+                self.run_log.event("rows_invalid", logging.WARNING, rows=[numbers[pos] for pos in invalid])
+        if invalid:
+            keep = np.setdiff1d(np.arange(len(numbers)), list(invalid))
+            table = table.iloc[keep]
+            numbers = np.asarray(numbers)[keep].tolist()
+        stats["rows_invalid"] = stats.get("rows_invalid", 0) + len(invalid)
+        stats["validate_seconds"] = stats.get("validate_seconds", 0.0) + time.perf_counter() - started
+        return table, numbers
+
+    def _build_store(self, numbers, sub, filter_context=None, stats=None, validator=None, record_invalid=True):
+        """
+        Định dạng, lọc và kiểm tra danh mục một vùng dòng đã đọc thành RowStore;
+        số liệu lọc/kiểm tra cộng dồn vào stats.
+        """
+        stats = self.metrics if stats is None else stats
+        table, numbers = self._format_rows(numbers, sub, filter_context, stats)
+        if validator is not None:
+            table, numbers = self._validate_catalogs(table, numbers, validator, stats, record_invalid)
+        return RowStore.from_frame(table, numbers)
+
+    def _format_rows(self, numbers, sub, filter_context, stats):
+        """Định dạng và lọc một vùng dòng đã đọc. Trả về (table, numbers)."""
+        table = format_table(sub, self.column_schema)
+        if filter_context is not None:
+            started = time.perf_counter()
+            positions = filter_positions(sub, table, numbers, *filter_context)
+            table = table.iloc[positions]
+            stats["rows_filtered_out"] = stats.get("rows_filtered_out", 0) + len(numbers) - len(positions)
+            numbers = np.asarray(numbers)[positions].tolist()
+            stats["filter_seconds"] = stats.get("filter_seconds", 0.0) + time.perf_counter() - started
+        return table, list(numbers)
+
+    def iter_chunk_stores(self, data_path, first, last, stats=None):
+        """
+        RowStore từng khối chunk_rows dòng (đã định dạng, đã lọc) của vùng first..last: nguồn cho ChunkPipeline.
+        Có danh mục và gom "consecutive": chứng từ cuối khối có thể còn tiếp ở khối sau nên được giữ lại
+        và kiểm tra cùng khối sau (một dòng sai bỏ cả chứng từ).
+        """
+        stats = {} if stats is None else stats
+        context = self._filter_context(data_path) if self.row_filter else None
+        validator = self._catalog_validator(data_path)
+        hold = validator is not None and self.group_mode == "consecutive"
+        held = None
+        for numbers, sub in iter_data_chunks(data_path, first, last, self.chunk_rows, self.reader):
+            table, numbers = self._format_rows(numbers, sub, context, stats)
+            if hold:
+                if held is not None:
+                    table, numbers = pd.concat([held[0], table]), held[1] + numbers
+                groups = self._header_groups(table)
+                cut = int(np.searchsorted(groups, groups[-1])) if len(groups) else 0
+                held = (table.iloc[cut:], numbers[cut:])
+                table, numbers = table.iloc[:cut], numbers[:cut]
+            store = self._validated_store(table, numbers, validator, stats)
+            if len(store):
+                yield store
+        if held is not None and held[1]:
+            store = self._validated_store(*held, validator, stats)
+            if len(store):
+                yield store
+
+    def _validated_store(self, table, numbers, validator, stats):
+        if validator is not None:
+            table, numbers = self._validate_catalogs(table, numbers, validator, stats, not self._preview)
+        store = RowStore.from_frame(table, numbers)
+        if len(store):
+            stats["mem_store_bytes"] = max(stats.get("mem_store_bytes", 0), store.memory_bytes())
+        return store
+
+    def _make_pipeline(self, data_path, first, last):
+        return ChunkPipeline(lambda stats: self.iter_chunk_stores(data_path, first, last, stats),
+                             self.prefetch_depth, self.cancel_token)
+
+    def prefetch(self, data_path, start_row=2, end_row=None):
+        """
+        Bắt đầu nạp trước các khối đầu của job kế tiếp (vd. file kế trong hot-folder) trong lúc
+        job hiện tại đang chạy; lần chạy sau với cùng file/vùng dòng dùng lại pipeline này.
+        """
+        if not self._streams():
+            return
+        key = (data_path, start_row, end_row)
+        if self._prefetched is not None and self._prefetched[0] == key:
+            return
+        self._discard_prefetch()
+        self._prefetched = (key, self._make_pipeline(data_path, start_row, end_row))
+
+    def _discard_prefetch(self):
+        if self._prefetched is not None:
+            self._prefetched[1].close()
+            self._prefetched = None
+
+    def _open_pipeline(self):
+        """ChunkPipeline cho job hiện tại (dùng lại bản nạp trước nếu khớp), None nếu phải nạp hết trước."""
+        if self.work_queue is not None:
+            # Thuê trước tối đa một lô ngoài lô đang nhập
+            return ChunkPipeline(self.work_queue.iter_stores, 1, self.cancel_token)
+        if self.rows is not None or not self._streams():
+            self._discard_prefetch()
+            return None
+        key = (self.csv_path, self.start_row, self.end_row)
+        if self._prefetched is not None and self._prefetched[0] == key:
+            pipeline = self._prefetched[1]
+            self._prefetched = None
+            return pipeline
+        self._discard_prefetch()
+        return self._make_pipeline(self.csv_path, self.start_row, self.end_row)
+
+    def _streams(self):
+        """
+        Nạp theo khối trên luồng nền được không. Không với group_mode="sort" (cần cả file) và với
+        result_mode="source": reader giữ file nguồn mở suốt lần chạy nên ghi lại file (os.replace)
+        bị Windows từ chối và kết quả rơi sang sidecar; nạp hết trước thì file đã đóng khi ghi.
+        """
+        return bool(self.chunk_rows) and self.group_mode != "sort" and self.result_mode != "source"
+
+    def _close_pipeline(self):
+        if self._pipeline is not None:
+            self._pipeline.close()
+            self._pipeline = None
+        if self.work_queue is not None:
+            self.work_queue.release()
+
+    def _complete_queued(self, numbers, state, error=None, status_callback=None):
+        if self.work_queue is None:
+            return
+        try:
+            saved = self.work_queue.complete(numbers, state, error, self._voucher)
+        except sqlite3.Error as e:
+            saved, error = False, e
+        if not saved and status_callback:
+            status_callback(f"Chưa ghi được kết quả dòng {_unit_label(numbers)} vào hàng đợi (sẽ ghi lại sau).")
+
+    def load_rows(self, status_callback=None, preview=False):
+        """
+        Đọc và định dạng các dòng được chọn thành RowStore (chỉ USED_COLUMNS cột, chuỗi đã
+        intern). Ghi bộ nhớ đỉnh và bộ nhớ ổn định sau khi nạp vào self.metrics. Trả về None nếu lỗi.
+        preview=True (xem trước, không chạy): dòng sai mã danh mục vẫn bị bỏ nhưng không ghi file dòng lỗi.
+        """
+        try:
+            numbers, sub = self.read_selected()
+            if self.row_filter:
+                self.metrics["rows_filtered_out"] = 0
+                self.metrics["filter_seconds"] = 0.0
+            store = self._build_store(numbers, sub, self._filter_context(self.csv_path) if self.row_filter else None,
+                                      validator=self._catalog_validator(self.csv_path), record_invalid=not preview)
+            del sub
+        except FileNotFoundError:
+            if status_callback:
+                status_callback(f"File not found: {self.csv_path}")
+            return None
+        except Exception as e:
+            if status_callback:
+                status_callback(f"Error reading file: {e}")
+            return None
+        current, peak = process_memory()
+        self.metrics["mem_peak_bytes"] = peak
+        self.metrics["mem_steady_bytes"] = current
+        self.metrics["mem_store_bytes"] = store.memory_bytes()
+        return store
+
+    def _record_stop(self):
+        """Ghi nguồn dừng và độ trễ từ lúc yêu cầu dừng tới lúc vòng chạy nhận ra."""
+        self.metrics["stop_reason"] = self.cancel_token.reason
+        self.metrics["stop_latency"] = self.cancel_token.latency()
+        self._flush_ledger()
+        self._write_trace()
+
+    def _write_trace(self, status_callback=None):
+        if self.tracer is None or not self.trace_path:
+            return
+        try:
+            self.tracer.write(self.trace_path)
+            self.metrics["trace_events"] = len(self.tracer)
+            self.metrics["trace_dropped"] = self.tracer.dropped
+        except Exception as e:
+            if status_callback:
+                status_callback(f"Không ghi được file trace: {e}")
+
+    def _flush_ledger(self, status_callback=None):
+        if self.ledger is None:
+            return
+        try:
+            ok = self.ledger.close()
+        except Exception as e:
+            ok = False
+            self.ledger.last_error = e
+        self.metrics["result_flushes"] = self.ledger.flushes
+        if not ok and status_callback:
+            if self.ledger.fell_back:
+                status_callback(f"Không ghi được kết quả vào file nguồn ({self.ledger.last_error}), "
+                                f"đã ghi sang {self.ledger.sidecar_path}")
+            else:
+                status_callback(f"Không ghi được file kết quả {self.ledger.sidecar_path}: {self.ledger.last_error}")
+
+    def _begin_unit(self, numbers):
+        self._unit_started = self.clock.time()
+        self._voucher = ""
+        self._unit_saved = False
+        self._current_unit = _unit_label(numbers)
+        if self.watchdog is not None:
+            self.watchdog.row_started(_unit_label(numbers))
+        if self.tracer is not None:
+            self.tracer.row = _unit_label(numbers)
+            self.tracer.col = None
+            self._unit_trace_start = self.tracer.now()
+
+    def _log_unit(self, status, numbers, error=None):
+        if self.run_log is None:
+            return
+        fields = {"row": _unit_label(numbers), "rows": len(numbers), "status": status,
+                  "seconds": round(self.clock.time() - (self._unit_started or self.clock.time()), 3),
+                  "voucher": self._voucher}
+        if error is not None:
+            fields["error"] = str(error)
+        self.run_log.event("unit", logging.INFO if status == "done" else logging.WARNING, **fields)
+
+    def _trace_unit(self, status):
+        """Khoảng "row" bao trọn một đơn vị (gồm cả các lần thử lại)."""
+        if self.tracer is not None and self._unit_trace_start is not None:
+            self.tracer.add("row", self._unit_trace_start, self.tracer.now(), status, col=None)
+            self.tracer.col = None
+
+    def _prepare_run(self, status_callback=None):
+        """Khởi tạo metrics và nạp dữ liệu cho lần chạy. Trả về RowStore hoặc None."""
+        if not self.backend.available():
+            if status_callback:
+                status_callback("pywinauto not installed. Please run: pip install pywinauto")
+            return None
+        self.metrics = {"started": self.clock.time(), "rows_done": 0, "rows_failed": 0}
+        self._status_callback = status_callback
+        self._carry_prev.clear()
+        if status_callback and self.governor is not None and self.governor.save_latency_target \
+                and not self.readiness_probe():
+            status_callback("Không dò được lúc Tabmis hết bận (chưa bật chờ con trỏ): bỏ giãn nhịp theo độ trễ lưu.")
+        self.ledger = (ResultLedger(self.csv_path, self.result_mode, self.result_flush_every)
+                       if self.result_mode else None)
+        if status_callback and self.ledger is not None and self.ledger.last_error is not None:
+            status_callback(f"Không ghi kết quả vào file nguồn ({self.ledger.last_error}), "
+                            f"ghi sang {self.ledger.sidecar_path}")
+        self._pipeline = self._open_pipeline()
+        if self._pipeline is not None:
+            return self._prepare_pipeline(status_callback)
+        store = self.load_rows(status_callback, preview=self._preview)
+        if store is None:
+            return None
+
+        total_rows = len(store)
+        self.metrics["rows_total"] = total_rows
+        if self.row_filter:
+            if status_callback:
+                status_callback(f"Filter: {total_rows} rows kept, {self.metrics['rows_filtered_out']} skipped")
+        elif self.end_row is not None or self.rows is not None:
+            requested = len(self.row_numbers())
+            missing = requested - total_rows - self.metrics.get("rows_invalid", 0)
+            if status_callback and missing > 0:
+                status_callback(f"Skipping {missing} rows: not in file")
+        if status_callback and self.metrics.get("rows_invalid"):
+            target = "" if self._preview else f" -> {self.failed_rows_path}"
+            status_callback(f"Sai mã danh mục: {self.metrics['rows_invalid']} dòng{target}")
+
+        if status_callback:
+            status_callback(f"Loaded {total_rows} rows ({format_bytes(self.metrics['mem_store_bytes'])}). "
+                            f"Đang tìm cửa sổ Tabmis...")
+        return store
+
+    def _prepare_pipeline(self, status_callback=None):
+        """Chỉ chờ khối đầu: các khối sau được nạp trên luồng nền trong lúc nhập phím."""
+        try:
+            head = self._pipeline.first()
+        except FileNotFoundError:
+            if status_callback:
+                status_callback(f"File not found: {self.csv_path}")
+            return None
+        except Exception as e:
+            if status_callback:
+                status_callback(f"Error reading file: {e}")
+            return None
+        current, peak = process_memory()
+        self.metrics["mem_peak_bytes"] = peak
+        self.metrics["mem_steady_bytes"] = current
+        self.metrics["mem_store_bytes"] = head.memory_bytes() if head is not None else 0
+        self.metrics["first_chunk_seconds"] = self._pipeline.stats["first_chunk_seconds"]
+        if status_callback:
+            status_callback(f"Loaded first {len(head) if head is not None else 0} rows "
+                            f"({format_bytes(self.metrics['mem_store_bytes'])}), nạp tiếp trên luồng nền. "
+                            f"Đang tìm cửa sổ Tabmis...")
+        return self._pipeline
+
+    def _focus_and_countdown(self, status_callback=None):
+        """Focus cửa sổ Tabmis và đếm ngược (chỉ lần đầu khi automator còn "lạnh")."""
+        # Tự động focus vào cửa sổ Tabmis
+        if not self.focus_tabmis_window(status_callback):
+            if status_callback:
+                status_callback("Không tìm thấy cửa sổ Tabmis. Dừng chạy.")
+            return False
+        elif not self._warm:
+            if status_callback:
+                status_callback(f"Đã focus vào cửa sổ Tabmis. Bắt đầu sau {self.start_delay} giây...")
 
-    def stop(self):
-        self._stop_requested = True
+            # Give user time to focus Tabmis window (nếu chưa focus được tự động)
+            countdown = int(self.start_delay)
+            for t in range(countdown, 0, -1):
+                if self._stop_requested:
+                    self._record_stop()
+                    if status_callback:
+                        status_callback("Stopped before start.")
+                    return False
+                if status_callback:
+                    status_callback(f"Starting in {t}...")
+                self._sleep_with_cancel(1)
+            self._warm = True
+        return True
 
-    def focus_tabmis_window(self, status_callback=None):
+    def _unit_failed(self, numbers, rows, error, status_callback=None):
+        """Đơn vị vẫn lỗi sau mọi lần thử: ghi mọi dòng của nó vào file dòng lỗi, cập nhật metrics."""
+        self._carry_prev.clear()
+        self._trace_unit("failed")
+        self._log_unit("failed", numbers, error)
+        self._end_watchdog_unit(isinstance(error, WatchdogTimeout), status_callback)
+        finished = self.clock.time()
+        for i, row in zip(numbers, rows):
+            try:
+                self.record_failed_row(i, row, error)
+            except Exception as e:
+                if status_callback:
+                    status_callback(f"Không ghi được file dòng lỗi: {e}")
+            if self.ledger is not None:
+                self.ledger.record(i, "failed", self._unit_started or finished, finished, self._voucher, error)
+        self._complete_queued(numbers, "failed", error, status_callback)
+        self.metrics["rows_failed"] += len(numbers)
+        if status_callback:
+            if self._unit_saved:
+                status_callback(f"Bỏ qua row {_unit_label(numbers)} (lỗi sau khi đã lưu, không thử lại): {error}")
+            else:
+                status_callback(f"Bỏ qua row {_unit_label(numbers)} sau {self.max_retries + 1} lần lỗi: {error}")
+
+    def _end_watchdog_unit(self, skipped, status_callback=None):
+        if self.watchdog is not None:
+            firing = self.watchdog.row_finished(skipped)
+            if firing is not None:
+                self._handle_watchdog(firing, status_callback)
+
+    def _unit_done(self, numbers):
+        self._commit_carry()
+        self._trace_unit("done")
+        self._log_unit("done", numbers)
+        self._end_watchdog_unit(False)
+        if self.ledger is not None:
+            finished = self.clock.time()
+            for i in numbers:
+                self.ledger.record(i, "done", self._unit_started or finished, finished, self._voucher)
+        self._complete_queued(numbers, "done", status_callback=self._status_callback)
+        self.metrics["rows_done"] += len(numbers)
+        if len(numbers) > 1:
+            self.metrics["header_groups"] = self.metrics.get("header_groups", 0) + 1
+            self.metrics["headers_saved"] = self.metrics.get("headers_saved", 0) + len(numbers) - 1
+
+    def _unit_stopped(self, numbers, status_callback=None):
         """
-        Tìm và focus vào cửa sổ Tabmis có title "Các ứng dụng Oracle - Môi trường sản xuất TABMIS 2018".
-        Trả về True nếu thành công, False nếu không tìm thấy.
+        Bị dừng giữa đơn vị: không phải "done" (form có thể đang dở, chứng từ có thể chỉ lưu header).
+        Sổ kết quả ghi "stopped" để lọc !done chạy lại; hàng đợi ghi "failed" để người xem lại
+        trước khi --requeue-failed (máy khác không tự nhập lại một chứng từ có thể đã lưu một phần).
+        """
+        self._carry_prev.clear()
+        reason = f"stopped ({self.cancel_token.reason})"
+        self._trace_unit("stopped")
+        self._log_unit("stopped", numbers, reason)
+        self._end_watchdog_unit(False)
+        if self.ledger is not None:
+            finished = self.clock.time()
+            for i in numbers:
+                self.ledger.record(i, "stopped", self._unit_started or finished, finished, self._voucher, reason)
+        self._complete_queued(numbers, "failed", reason, status_callback)
+        self.metrics["rows_stopped"] = self.metrics.get("rows_stopped", 0) + len(numbers)
+        if status_callback:
+            status_callback(f"Dừng giữa row {_unit_label(numbers)}"
+                            + (": đã lưu ít nhất một lần, kiểm tra chứng từ trên Tabmis." if self._unit_saved else "."))
+
+    def _finish_run(self, status_callback=None):
+        self._flush_ledger(status_callback)
+        self._write_trace(status_callback)
+        pipeline = self._pipeline
+        if pipeline is not None:
+            stats = dict(pipeline.stats)
+            stats["mem_store_bytes"] = max(stats.get("mem_store_bytes", 0), self.metrics.get("mem_store_bytes", 0))
+            self.metrics.update(stats)
+            current, peak = process_memory()
+            self.metrics["mem_peak_bytes"] = peak
+            self.metrics["mem_steady_bytes"] = current
+            if pipeline.error is not None:
+                if status_callback:
+                    status_callback(f"Error reading file: {pipeline.error}")
+                return False
+        self.metrics["elapsed"] = self.clock.time() - self.metrics["started"]
+        if self.governor is not None:
+            self.metrics.update(self.governor.snapshot())
+        if status_callback:
+            mem = (f"Bộ nhớ: peak {format_bytes(self.metrics['mem_peak_bytes'])}, "
+                   f"steady {format_bytes(self.metrics['mem_steady_bytes'])}, "
+                   f"store {format_bytes(self.metrics['mem_store_bytes'])}")
+            if self.failed_rows and not self._preview:
+                status_callback(f"All done. {len(self.failed_rows)} dòng lỗi -> {self.failed_rows_path}. {mem}")
+            elif self.failed_rows:
+                status_callback(f"All done. {len(self.failed_rows)} dòng lỗi. {mem}")
+            else:
+                status_callback(f"All done. {mem}")
+        return True
+
+    def run(self, status_callback=None, preview=False):
+        """
+        Chạy job hiện tại. Trả về True nếu chạy hết các dòng (kể cả khi có dòng lỗi đã ghi
+        vào file dòng lỗi), False nếu không đọc được file, không thấy cửa sổ hoặc bị dừng.
+        engine="asyncio" chạy cùng kế hoạch bằng AsyncRunEngine.
+        preview=True (chạy giả lập): không ghi file dòng lỗi cạnh file dữ liệu (sổ kết quả, trace
+        chỉ ghi khi được yêu cầu rõ qua result_mode/trace_path).
         """
-        if Application is None:
+        self._preview = bool(preview)
+        # status_callback(text) to update UI
+        owned = self.run_log is None and self._run_log_options is not None
+        if owned:
+            self.run_log = RunLog(**self._run_log_options)
+        log = self.run_log
+        if log is None:
+            return self._run_engine(status_callback)
+        log.event("run_start", path=self.csv_path, start_row=self.start_row, end_row=self.end_row,
+                  rows=len(self.rows) if self.rows is not None else None, engine=self.engine,
+                  key_delay=self.key_delay, between_rows_delay=self.between_rows_delay,
+                  step_delays=self.step_delays, row_filter=self.row_filter)
+        ok = False
+        try:
+            ok = self._run_engine(log.status_callback(status_callback))
+            return ok
+        finally:
+            log.event("run_end", ok=ok, **{k: v for k, v in self.metrics.items()
+                                           if not isinstance(v, (list, dict))})
+            if owned:
+                log.close()
+                self.run_log = None
+
+    def _run_engine(self, status_callback=None):
+        try:
+            if self.engine == "asyncio":
+                return AsyncRunEngine(self).run(status_callback)
+            return self._run_rows(status_callback)
+        finally:
+            self._close_pipeline()
+
+    def _run_rows(self, status_callback=None):
+        store = self._prepare_run(status_callback)
+        if store is None:
+            return False
+        if not self._focus_and_countdown(status_callback):
+            return False
+
+        for numbers, rows in self.iter_units(store):
+            if self._stop_requested or (
+                    self.governor is not None
+                    and not self.governor.before_row(self._sleep_with_cancel, status_callback)):
+                self._record_stop()
+                if status_callback:
+                    status_callback(f"Stopped ({self.cancel_token.reason}).")
+                return False
+
+            i = _unit_label(numbers)
+            self._begin_unit(numbers)
             if status_callback:
-                status_callback("pywinauto.Application not available. Cannot focus window.")
+                status_callback(f"Processing row {i}...")
+            error = None
+            for attempt in range(self.max_retries + 1):
+                try:
+                    self.process_group(rows)
+                    error = None
+                    break
+                except Exception as e:
+                    error = e
+                    if self._stop_requested:
+                        break
+                    if status_callback:
+                        status_callback(f"Error on row {i} (lần {attempt + 1}): {e}. Đang khôi phục form...")
+                    try:
+                        self.run_reset_macro(status_callback)
+                    except Exception:
+                        pass
+                    # Đã gửi Ctrl+S: chứng từ có thể đã lưu, chạy lại từ bước đầu sẽ lưu chứng từ thứ hai
+                    if self._unit_saved:
+                        break
+                    # Watchdog yêu cầu bỏ dòng (kể cả trong lúc khôi phục): không thử lại
+                    if self.watchdog is not None and self.watchdog.skipping:
+                        break
+
+            if error is not None:
+                self._unit_failed(numbers, rows, error, status_callback)
+                continue
+            # process_group trả về sớm (không lỗi) khi có lệnh dừng: đơn vị chưa xong
+            if self._stop_requested:
+                self._unit_stopped(numbers, status_callback)
+                continue
+
+            self._unit_done(numbers)
+            if status_callback:
+                status_callback(f"Finished row {i}. Waiting {self.between_rows_delay}s")
+            self._sleep_with_cancel(self.between_rows_delay)
+
+        if isinstance(store, ChunkPipeline) and store.interrupted:
+            self._record_stop()
+            if status_callback:
+                status_callback(f"Stopped ({self.cancel_token.reason}).")
             return False
+        return self._finish_run(status_callback)
 
-        window_title = "Các ứng dụng Oracle - Môi trường sản xuất TABMIS 2018"
-        
+
+# ---------- Asyncio engine ----------
+class AsyncRunEngine:
+    """
+    Engine asyncio cho kế hoạch dòng (ROW_PLAN): chờ, dò con trỏ busy, đẩy status, cập nhật
+    metrics và xử lý dừng đều là coroutine trên MỘT event loop. Các lệnh chặn của OS
+    (clipboard, gửi phím, GetCursorInfo, đọc file, tìm cửa sổ) chạy trong một executor nhỏ.
+    Đây là nền để chồng các việc khác (chuẩn bị clipboard, dò, chuẩn bị dữ liệu) lên thời
+    gian chờ bắt buộc của Tabmis.
+    """
+
+    def __init__(self, automator, max_workers=2, metrics_interval=1.0):
+        self.automator = automator
+        self.max_workers = max_workers
+        self.metrics_interval = float(metrics_interval)
+        self._loop = None
+        self._executor = None
+        self._stop_event = None
+        self._status_queue = None
+
+    def run(self, status_callback=None):
+        """Chạy đồng bộ (từ thread worker của GUI hoặc dòng lệnh)."""
+        return asyncio.run(self.run_async(status_callback))
+
+    async def run_async(self, status_callback=None):
+        self._loop = asyncio.get_running_loop()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="lkb-io")
+        self._stop_event = asyncio.Event()
+        self._status_queue = asyncio.Queue()
+        token = self.automator.cancel_token
+        # Cầu nối token (thread bất kỳ) -> asyncio.Event trên loop này; gỡ khi xong vì token
+        # được dùng lại qua nhiều lần chạy (hot-folder, JobRunner) còn loop này sẽ đóng
+        loop, stop_event = self._loop, self._stop_event
+
+        def wake(reason):
+            loop.call_soon_threadsafe(stop_event.set)
+
+        token.on_cancel(wake)
+        publisher = asyncio.create_task(self._publish_status(status_callback))
+        meter = asyncio.create_task(self._update_metrics())
         try:
-            # Cách 1: Thử connect theo title chính xác
+            return await self._run_rows()
+        finally:
+            token.off_cancel(wake)
+            meter.cancel()
+            await self._status_queue.put(None)
+            await publisher
+            self._executor.shutdown(wait=False)
+
+    # --- helpers ---
+    def status(self, text):
+        """Đẩy status; gọi được cả từ luồng executor (asyncio.Queue không an toàn luồng)."""
+        try:
+            on_loop = asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            on_loop = False
+        if on_loop:
+            self._status_queue.put_nowait(text)
+        else:
             try:
-                app = Application(backend="win32").connect(title=window_title, timeout=2)
-                window = app.window(title=window_title)
-                if window.exists():
-                    window.set_focus()
-                    window.restore()  # Đảm bảo cửa sổ không bị minimize
+                self._loop.call_soon_threadsafe(self._status_queue.put_nowait, text)
+            except RuntimeError:
+                pass    # loop đã đóng (status muộn từ luồng nền)
+
+    async def _publish_status(self, status_callback):
+        """Đẩy status ra UI; chỉ gửi bản mới nhất nếu có nhiều status dồn lại."""
+        while True:
+            text = await self._status_queue.get()
+            if text is None:
+                return
+            while not self._status_queue.empty():
+                nxt = self._status_queue.get_nowait()
+                if nxt is None:
                     if status_callback:
-                        status_callback(f"Đã focus vào cửa sổ Tabmis")
-                    self._sleep_with_cancel(0.5)  # Đợi một chút để cửa sổ focus xong
-                    return True
+                        status_callback(text)
+                    return
+                text = nxt
+            if status_callback:
+                status_callback(text)
+
+    async def _update_metrics(self):
+        m = self.automator.metrics
+        while True:
+            await asyncio.sleep(self.metrics_interval)
+            now = self.automator.clock.time()
+            elapsed = now - m.get("started", now)
+            if elapsed > 0:
+                m["rows_per_hour"] = m.get("rows_done", 0) * 3600.0 / elapsed
+
+    async def offload(self, func, *args):
+        return await self._loop.run_in_executor(self._executor, func, *args)
+
+    def span(self, name, detail=None):
+        """Khoảng trace trên tracer của automator (không làm gì nếu không bật trace)."""
+        tracer = self.automator.tracer
+        return tracer.span(name, detail) if tracer is not None else contextlib.nullcontext()
+
+    async def sleep(self, seconds):
+        """Chờ seconds giây hoặc tới khi bị dừng. Trả về True nếu bị dừng."""
+        if self._stop_event.is_set():
+            return True
+        if seconds > 0:
+            with self.span("sleep", seconds):
+                clock = self.automator.clock
+                if clock.virtual:
+                    # Đồng hồ ảo: chỉ cộng giờ, nhường vòng lặp một lượt
+                    clock.sleep(seconds)
+                    await asyncio.sleep(0)
+                else:
+                    try:
+                        await asyncio.wait_for(self._stop_event.wait(), timeout=seconds)
+                    except asyncio.TimeoutError:
+                        pass
+        return self.automator._stop_requested
+
+    async def wait_ready(self):
+        """Coroutine tương đương wait_while_cursor_busy."""
+        a = self.automator
+        if not a.readiness_probe():
+            return
+        with self.span("busy-wait"):
+            waited = 0.0
+            while not a._stop_requested and await self.offload(a.is_cursor_busy):
+                self.status(f"Đang chờ con trỏ... {int(waited)}s")
+                a.watchdog_check(self.status)
+                await self.sleep(0.1)
+                waited += 0.1
+
+    async def run_step(self, step):
+        kind = step[0]
+        if self.automator.tracer is not None:
+            self.automator.tracer.col = step[1] if kind == "paste" else None
+        detail = (None if kind == "paste" else step[1] if kind == "press"
+                  else " ".join(step[1]) if kind == "keys" else "+".join(step[1]))
+        log = self.automator.run_log
+        started = self.automator.clock.monotonic()
+        outcome = "ok"
+        try:
+            with self.span(kind, detail):
+                await self._run_step(step)
+        except BaseException as e:
+            outcome = type(e).__name__
+            raise
+        finally:
+            if log is not None:
+                log.step(self.automator._current_unit, step, self.automator.clock.monotonic() - started, outcome)
+
+    async def _run_step(self, step):
+        a = self.automator
+        backend = a.backend
+        kind = step[0]
+        delay = a.step_delay(step)
+        if kind == "paste":
+            await self.wait_ready()
+            await self.offload(backend.copy, step[2])
+            if await self.sleep(min(0.1, a.key_delay / 4)):
+                return
+            try:
+                await self.offload(backend.hotkey, ("ctrl",), "v")
             except Exception:
-                pass
-            
-            # Cách 2: Thử tìm bằng Desktop (tìm tất cả cửa sổ)
+                await self.offload(backend.type_text, step[2])
+            await self.sleep(delay)
+        elif kind == "press":
+            await self.wait_ready()
             try:
-                from pywinauto import Desktop
-                desktop = Desktop(backend="win32")
-                windows = desktop.windows()
-                for w in windows:
-                    if w.is_visible() and window_title in w.window_text():
-                        w.set_focus()
-                        w.restore()
-                        if status_callback:
-                            status_callback(f"Đã focus vào cửa sổ Tabmis")
-                        self._sleep_with_cancel(0.5)
-                        return True
+                await self.offload(backend.key, a._normalize_key_name(step[1]))
             except Exception:
                 pass
-            
-            # Cách 3: Tìm bằng từ khóa TABMIS và Oracle (fuzzy match)
+            await self.sleep(delay)
+        elif kind == "keys":
+            await self.wait_ready()
             try:
-                from pywinauto import Desktop
-                desktop = Desktop(backend="win32")
-                windows = desktop.windows()
-                for w in windows:
-                    text = w.window_text()
-                    if w.is_visible() and "TABMIS" in text and ("Oracle" in text or "Môi trường" in text):
-                        w.set_focus()
-                        w.restore()
-                        if status_callback:
-                            status_callback(f"Đã focus vào cửa sổ Tabmis (tìm kiếm mờ)")
-                        self._sleep_with_cancel(0.5)
-                        return True
+                await self.offload(backend.send_group, [("key", a._normalize_key_name(k)) for k in step[1]])
             except Exception:
                 pass
-            
-            if status_callback:
-                status_callback(f"Không tìm thấy cửa sổ Tabmis. Vui lòng mở cửa sổ trước.")
-            return False
-            
-        except Exception as e:
-            if status_callback:
-                status_callback(f"Lỗi khi tìm cửa sổ Tabmis: {e}")
-            return False
+            await self.sleep(delay)
+        elif kind == "hotkey":
+            await self.wait_ready()
+            if step == SAVE_STEP:
+                a._unit_saved = True
+            started = a.clock.time()
+            keys = [a._normalize_key_name(k) for k in step[1]]
+            mods = tuple(k for k in keys if k in MODIFIER_KEYS)
+            for mk in [k for k in keys if k not in MODIFIER_KEYS] or [None]:
+                if a._stop_requested:
+                    return
+                try:
+                    await self.offload(backend.hotkey, mods, mk)
+                except Exception:
+                    pass
+                await self.sleep(0.02)
+            await self.sleep(delay)
+            if step == SAVE_STEP and a.governor is not None and a.readiness_probe():
+                await self.wait_ready()
+                a.governor.observe_save(a.clock.time() - started)
+            if step == SAVE_STEP and a.ledger is not None and not a._voucher:
+                a._voucher = await self.offload(a.capture_voucher)
+        else:
+            raise ValueError(f"Unknown step: {step!r}")
 
-    def _sleep_with_cancel(self, total_seconds):
-        """Ngủ nhưng vẫn kiểm tra cờ dừng để có thể dừng gần như ngay lập tức."""
-        end_time = time.time() + float(total_seconds)
-        while time.time() < end_time:
-            if self._stop_requested:
+    async def run_row(self, row):
+        await self.run_group([row])
+
+    async def run_group(self, rows):
+        a = self.automator
+        wd = a.watchdog
+        a._plan = plan = a.compile_group(rows)
+        for k, step in enumerate(plan):
+            a._step_index = k
+            if a._stop_requested or (a.paused and await self.offload(a.wait_if_paused, self.status)):
                 return
-            # ngủ từng đoạn rất ngắn để phản ứng nhanh
-            time.sleep(0.02)
+            if wd is not None:
+                a.watchdog_check(self.status)
+                wd.step_started(step)
+            await self.run_step(step)
 
-    def is_cursor_busy(self):
-        """
-        Kiểm tra con trỏ chuột có đang là Hourglass / AppStarting hay không.
-        Hiện thực Windows-only (sử dụng Win32 API). Trả về True nếu đang là cursor 'wait' hoặc 'appstarting'.
-        Trên hệ khác trả về False.
-        """
-        if not self.wait_cursor:
+    async def _run_rows(self):
+        a = self.automator
+        store = await self.offload(a._prepare_run, self.status)
+        if store is None:
             return False
-        if platform.system() != "Windows":
-            # Không hỗ trợ trên non-Windows trong phiên bản này
+        if not await self.offload(a._focus_and_countdown, self.status):
             return False
-        try:
-            user32 = ctypes.windll.user32
-
-            class POINT(ctypes.Structure):
-                _fields_ = [("x", ctypes.c_long), ("y", ctypes.c_long)]
-
-            class CURSORINFO(ctypes.Structure):
-                _fields_ = [
-                    ("cbSize", ctypes.c_uint),
-                    ("flags", ctypes.c_uint),
-                    ("hCursor", ctypes.c_void_p),
-                    ("ptScreenPos", POINT),
-                ]
 
-            ci = CURSORINFO()
-            ci.cbSize = ctypes.sizeof(CURSORINFO)
-            res = user32.GetCursorInfo(ctypes.byref(ci))
-            if not res:
+        # Khối kế tiếp có thể chưa nạp xong: lấy đơn vị từ ChunkPipeline trên executor, không chặn loop
+        units = a.iter_units(store)
+        next_unit = functools.partial(next, units, None)
+        while True:
+            unit = await self.offload(next_unit) if isinstance(store, ChunkPipeline) else next_unit()
+            if unit is None:
+                break
+            numbers, rows = unit
+            if a._stop_requested or (
+                    a.governor is not None
+                    and not await self.offload(a.governor.before_row, a._sleep_with_cancel, self.status)):
+                a._record_stop()
+                self.status(f"Stopped ({a.cancel_token.reason}).")
                 return False
-            cur = ci.hCursor
-
-            # IDC_WAIT = 32514, IDC_APPSTARTING = 32650
-            IDC_WAIT = 32514
-            IDC_APPSTARTING = 32650
-            try:
-                wait_h = user32.LoadCursorW(0, IDC_WAIT)
-                appstart_h = user32.LoadCursorW(0, IDC_APPSTARTING)
-            except Exception:
-                # Nếu LoadCursorW không nhận integer (hiếm), fallback False
-                wait_h = None
-                appstart_h = None
+            i = _unit_label(numbers)
+            a._begin_unit(numbers)
+            self.status(f"Processing row {i}...")
+            error = None
+            for attempt in range(a.max_retries + 1):
+                try:
+                    await self.run_group(rows)
+                    error = None
+                    break
+                except Exception as e:
+                    error = e
+                    if a._stop_requested:
+                        break
+                    self.status(f"Error on row {i} (lần {attempt + 1}): {e}. Đang khôi phục form...")
+                    try:
+                        await self.offload(a.run_reset_macro, self.status)
+                    except Exception:
+                        pass
+                    if a._unit_saved or (a.watchdog is not None and a.watchdog.skipping):
+                        break
+            if error is not None:
+                await self.offload(a._unit_failed, numbers, rows, error, self.status)
+                continue
+            if a._stop_requested:
+                await self.offload(a._unit_stopped, numbers, self.status)
+                continue
+            # Ghi sổ kết quả và hàng đợi SQLite là I/O chặn: chạy trên executor
+            await self.offload(a._unit_done, numbers)
+            self.status(f"Finished row {i}. Waiting {a.between_rows_delay}s")
+            await self.sleep(a.between_rows_delay)
 
-            # So sánh handle; nếu trùng với một trong các handle hệ thống, coi là busy
-            if cur and (cur == wait_h or cur == appstart_h):
-                return True
-            return False
-        except Exception:
-            # Nếu có lỗi, không block (tránh treo)
+        if isinstance(store, ChunkPipeline) and store.interrupted:
+            a._record_stop()
+            self.status(f"Stopped ({a.cancel_token.reason}).")
             return False
+        return await self.offload(a._finish_run, self.status)
 
-    def wait_while_cursor_busy(self, status_callback=None):
-        """
-        Nếu tùy chọn chờ được bật thì lặp kiểm tra con trỏ cho tới khi không còn busy.
-        Gọi status_callback(text) để cập nhật UI khi cần.
-        """
-        if not self.wait_cursor:
-            return
-        # Nếu không phải Windows, thông báo 1 lần (không spam)
-        if platform.system() != "Windows":
-            if status_callback:
-                status_callback("Wait-cursor tính năng chỉ hỗ trợ Windows — bỏ qua.")
-            return
-        # Lặp cho đến khi cursor không busy hoặc người dùng dừng
-        waited = 0.0
-        while not self._stop_requested and self.is_cursor_busy():
-            if status_callback:
-                status_callback("Đang chờ con trỏ chuột hết busy...")
-            self._sleep_with_cancel(0.1)
-            waited += 0.1
-            # Sau một khoảng thời gian dài, cập nhật status để người dùng biết
-            if status_callback and (int(waited) % 5 == 0):
-                status_callback(f"Đang chờ con trỏ... {int(waited)}s")
-        if status_callback and not self._stop_requested:
-            status_callback("Con trỏ đã sẵn sàng, tiếp tục...")
 
-    def paste_text(self, text, status_callback=None):
-        if self._stop_requested:
-            return
-        if keyboard is None:
-            if status_callback:
-                status_callback("pywinauto not available. Install via: pip install pywinauto")
-            return
+# ---------- Hot-folder daemon ----------
+class HotFolderDaemon:
+    """
+    Chế độ chạy nền: theo dõi một thư mục, xếp hàng các file CSV/XLSX mới đến và
+    chạy lần lượt bằng MỘT TabmisAutomator "ấm" (giữ cửa sổ Tabmis, cache token phím,
+    không countdown lại). File chạy xong được chuyển sang thư mục done hoặc failed.
+    Lần chạy không nhập được dòng nào (không thấy Tabmis, lỗi đọc file...) là lỗi môi trường,
+    không phải lỗi của file: file ở lại hàng đợi và thử lại sau retry_seconds, tăng gấp đôi
+    mỗi lần lỗi liên tiếp tới max_retry_seconds.
 
-        # Nếu bật tùy chọn chờ con trỏ, đợi trước khi thao tác clipboard/dán
-        self.wait_while_cursor_busy(status_callback=status_callback)
+    order="arrival": theo thời điểm file đến (mtime).
+    order="priority": theo tiền tố ưu tiên trong tên file ("1_abc.csv" trước "5_xyz.csv",
+    file không có tiền tố xếp sau), cùng ưu tiên thì theo thời điểm đến.
+    """
 
-        if text is None:
-            text = ""
-        pyperclip.copy(str(text))
-        self._sleep_with_cancel(min(0.1, self.key_delay / 4))
-        if self._stop_requested:
-            return
-        try:
-            # Ctrl+V
-            keyboard.send_keys("^v")
-        except Exception:
-            # fallback: send characters one by one
-            try:
-                s = str(text)
-                for ch in s:
-                    if self._stop_requested:
-                        return
-                    keyboard.send_keys(ch)
-                    self._sleep_with_cancel(0.005)
-            except Exception:
-                pass
-        self._sleep_with_cancel(self.key_delay)
+    PRIORITY_RE = re.compile(r"^[pP]?(\d+)[_-]")
+    DEFAULT_PRIORITY = 1000
 
-    def _normalize_key_name(self, key):
-        """Chuẩn hóa tên phím đầu vào"""
-        key = str(key).lower().strip()
-        key_map = {
-            'pagedown': 'pagedown',
-            'page down': 'pagedown',
-            'pgdn': 'pagedown',
-            'pageup': 'pageup',
-            'page up': 'pageup',
-            'pgup': 'pageup',
-            'ctrl': 'ctrl',
-            'control': 'ctrl',
-            'alt': 'alt',
-            'shift': 'shift',
-            'win': 'win',
-            'command': 'win',
-            'cmd': 'win',
-            'enter': 'enter',
-            'esc': 'esc',
-            'tab': 'tab',
-            'down': 'down',
-            'up': 'up',
-            'left': 'left',
-            'right': 'right',
-            'space': 'space',
-            'f4': 'f4',
-        }
-        return key_map.get(key, key)
+    def __init__(self, automator, watch_dir, done_dir=None, failed_dir=None,
+                 order="arrival", start_row=2, poll_interval=2.0, settle_seconds=2.0,
+                 retry_seconds=5.0, max_retry_seconds=300.0):
+        if order not in ("arrival", "priority"):
+            raise ValueError("order must be 'arrival' or 'priority'")
+        self.automator = automator
+        self.watch_dir = watch_dir
+        self.done_dir = done_dir or os.path.join(watch_dir, "done")
+        self.failed_dir = failed_dir or os.path.join(watch_dir, "failed")
+        self.order = order
+        self.start_row = start_row
+        self.poll_interval = float(poll_interval)
+        self.settle_seconds = float(settle_seconds)
+        self.retry_seconds = float(retry_seconds)
+        self.max_retry_seconds = float(max_retry_seconds)
+        self._backoff = 0.0     # chờ trước lần thử kế tiếp sau lỗi môi trường (0 = không chờ)
+        self._queue = []        # heap: (sort_key, seq, path)
+        self._queued = set()
+        self._seen = {}         # path -> (size, mtime) ở lần quét trước, để biết file đã copy xong
+        self._seq = 0
 
-    def _token_for_key(self, key):
-        """
-        Trả về token phù hợp cho pywinauto.keyboard.send_keys
-        - letters/digits returned as-is
-        - special keys mapped to {KEY}
-        - page keys and function keys provided with braces
-        """
-        k = key.lower()
-        special = {
-            'enter': '{ENTER}',
-            'esc': '{ESC}',
-            'tab': '{TAB}',
-            'down': '{DOWN}',
-            'up': '{UP}',
-            'left': '{LEFT}',
-            'right': '{RIGHT}',
-            'pagedown': '{PGDN}',
-            'pageup': '{PGUP}',
-            'f1': '{F1}',
-            'f2': '{F2}',
-            'f3': '{F3}',
-            'f4': '{F4}',
-            'f5': '{F5}',
-            'f6': '{F6}',
-            'f7': '{F7}',
-            'f8': '{F8}',
-            'f9': '{F9}',
-            'f10': '{F10}',
-            'f11': '{F11}',
-            'f12': '{F12}',
-            'space': ' ',
-        }
-        return special.get(k, k)
+    def _sort_key(self, name, mtime):
+        if self.order == "priority":
+            m = self.PRIORITY_RE.match(name)
+            prio = int(m.group(1)) if m else self.DEFAULT_PRIORITY
+            return (prio, mtime)
+        return (mtime,)
 
-    def press(self, key, count=1):
-        if keyboard is None:
-            return
-        token = self._token_for_key(self._normalize_key_name(key))
-        for _ in range(count):
-            if self._stop_requested:
-                return
-            if self.wait_cursor:
-                self.wait_while_cursor_busy()
-            try:
-                keyboard.send_keys(token)
-            except Exception:
-                # fallback: try raw
-                try:
-                    keyboard.send_keys(str(token))
-                except Exception:
-                    pass
-            self._sleep_with_cancel(self.key_delay)
+    def scan(self):
+        """Quét thư mục một lần, đưa các file mới (đã ổn định kích thước) vào hàng đợi."""
+        now = time.time()
+        current = {}
+        try:
+            entries = list(os.scandir(self.watch_dir))
+        except FileNotFoundError:
+            return 0
+        added = 0
+        for entry in entries:
+            name = entry.name
+            if not entry.is_file() or name.startswith(("~$", ".")):
+                continue
+            # File do chính chương trình sinh ra (kết quả, dòng lỗi) không phải job mới
+            if name.endswith((RESULT_SUFFIX, "_failed.csv")):
+                continue
+            if os.path.splitext(name)[1].lower() not in DATA_EXTENSIONS:
+                continue
+            path = entry.path
+            st = entry.stat()
+            sig = (st.st_size, st.st_mtime)
+            current[path] = sig
+            if path in self._queued:
+                continue
+            # Chỉ nhận file đã không đổi giữa hai lần quét và đủ "cũ" (đã copy xong)
+            if self._seen.get(path) != sig or now - st.st_mtime < self.settle_seconds:
+                continue
+            self._seq += 1
+            heapq.heappush(self._queue, (self._sort_key(name, st.st_mtime), self._seq, path))
+            self._queued.add(path)
+            added += 1
+        self._seen = current
+        return added
+
+    def _move(self, path, dest_dir):
+        os.makedirs(dest_dir, exist_ok=True)
+        name = os.path.basename(path)
+        dest = os.path.join(dest_dir, name)
+        if os.path.exists(dest):
+            base, ext = os.path.splitext(name)
+            dest = os.path.join(dest_dir, f"{base}_{time.strftime('%Y%m%d_%H%M%S')}{ext}")
+        shutil.move(path, dest)
+        return dest
 
-    def hotkey(self, *keys):
+    def process_file(self, path, status_callback=None):
         """
-        Nhấn tổ hợp phím sử dụng pywinauto send_keys:
-        - Ctrl -> '^', Shift -> '+', Alt -> '!' prefix.
-        Ví dụ:
-            hotkey('ctrl','s') -> '^s'
-            hotkey('shift','pagedown') -> '+{PGDN}'
-            hotkey('alt','c') -> '%c'
+        Chạy một file bằng automator ấm rồi chuyển file sang done/failed. Trả về True nếu done,
+        False nếu failed hoặc bị dừng, None nếu chưa nhập được dòng nào (file để nguyên chỗ cũ).
         """
-        if keyboard is None:
-            return
-        if self._stop_requested:
-            return
+        base = os.path.splitext(os.path.basename(path))[0]
+        self.automator.load_job(
+            path, start_row=self.start_row, end_row=None,
+            failed_rows_path=os.path.join(self.failed_dir, f"{base}_failed.csv"),
+        )
+        os.makedirs(self.failed_dir, exist_ok=True)
+        if status_callback:
+            status_callback(f"[hot-folder] Bắt đầu {os.path.basename(path)}")
+        if self._queue:
+            # Nạp trước file kế tiếp trong hàng đợi trong lúc file này đang được nhập
+            self.automator.prefetch(self._queue[0][2], start_row=self.start_row)
+        # metrics cũ của file trước không được tính là dòng đã nhập của file này
+        self.automator.metrics = {}
+        try:
+            ok = self.automator.run(status_callback=status_callback)
+        except Exception as e:
+            ok = False
+            if status_callback:
+                status_callback(f"[hot-folder] Lỗi khi chạy {path}: {e}")
+        if self.automator._stop_requested:
+            # Dừng giữa chừng: để nguyên file trong thư mục theo dõi để chạy lại sau
+            return False
+        metrics = self.automator.metrics
+        if not ok and not self.automator.failed_rows and not metrics.get("rows_done") \
+                and not metrics.get("rows_failed"):
+            return None
+        done = ok and not self.automator.failed_rows
+        dest_dir = self.done_dir if done else self.failed_dir
+        for sidecar in (default_result_path(path), csv_index_path(path)):
+            if os.path.exists(sidecar):
+                self._move(sidecar, dest_dir)
+        dest = self._move(path, dest_dir)
+        if status_callback:
+            status_callback(f"[hot-folder] {'Xong' if done else 'Lỗi'}: {os.path.basename(path)} -> {dest}")
+        return done
 
-        self.wait_while_cursor_busy()
+    def run_forever(self, status_callback=None):
+        """Vòng lặp chính: quét, chạy file đầu hàng đợi, lặp lại tới khi automator.stop()."""
+        if status_callback:
+            status_callback(f"[hot-folder] Đang theo dõi {self.watch_dir} (order={self.order})")
+        while not self.automator._stop_requested:
+            self.scan()
+            if not self._queue:
+                self.automator._sleep_with_cancel(self.poll_interval)
+                continue
+            item = heapq.heappop(self._queue)
+            path = item[2]
+            self._queued.discard(path)
+            if not os.path.exists(path):
+                continue
+            if self.process_file(path, status_callback) is not None:
+                self._backoff = 0.0
+                continue
+            if self.automator._stop_requested:
+                break
+            # Lỗi môi trường: giữ file ở đầu hàng đợi, chờ rồi thử lại
+            heapq.heappush(self._queue, item)
+            self._queued.add(path)
+            self._backoff = min(self.max_retry_seconds, max(self.retry_seconds, self._backoff * 2))
+            if status_callback:
+                status_callback(f"[hot-folder] Chưa chạy được {os.path.basename(path)}: giữ trong hàng đợi, "
+                                f"thử lại sau {self._backoff:.0f} giây")
+            self.automator._sleep_with_cancel(self._backoff)
+        if status_callback:
+            status_callback("[hot-folder] Đã dừng.")
+
+
+# ---------- Job control API ----------
+JOB_SPEC_OPTIONS = {
+    # khóa trong job spec -> (tham số TabmisAutomator, kiểu)
+    "key_delay": ("key_delay", float),
+    "between_rows_delay": ("between_rows_delay", float),
+    "wait_cursor": ("wait_cursor", bool),
+    "max_retries": ("max_retries", int),
+    "backend": ("key_backend", str),
+    "engine": ("engine", str),
+    "group": ("group_mode", str),
+    "carry_forward": ("carry_forward", bool),
+    "results": ("result_mode", str),
+    "schema": ("column_schema", str),
+    "profile": ("delay_profile", None),
+    "filter": ("row_filter", str),
+    "reader": ("reader", str),
+    "catalogs": ("catalogs", str),
+}
+
+
+def validate_job_spec(spec):
+    """Kiểm tra job spec trước khi xếp hàng; ValueError nếu sai."""
+    path = spec.get("path")
+    if not path or not os.path.isfile(path):
+        raise ValueError(f"Data file not found: {path!r}")
+    if os.path.splitext(path)[1].lower() not in DATA_EXTENSIONS:
+        raise ValueError(f"Unsupported data file: {path!r}")
+    unknown = set(spec) - set(JOB_SPEC_OPTIONS) - {"path", "start_row", "end_row", "rows", "source"}
+    if unknown:
+        raise ValueError(f"Unknown job spec keys: {sorted(unknown)}")
+    int(spec.get("start_row", 2))
+    if spec.get("end_row") is not None:
+        int(spec["end_row"])
+    if spec.get("rows") is not None:
+        [int(n) for n in spec["rows"]]
+    if spec.get("reader") not in (None, "auto") and spec["reader"] not in readers_for(path):
+        raise ValueError(f"Unknown or unavailable reader for {path!r}: {spec['reader']!r}")
+
+
+def automator_from_spec(spec, defaults=None):
+    """
+    TabmisAutomator cho một job spec: {"path", "start_row", "end_row", "rows", "profile", ...}
+    (các khóa khác xem JOB_SPEC_OPTIONS). defaults là tham số mặc định cho TabmisAutomator.
+    """
+    validate_job_spec(spec)
+    options = dict(defaults or {})
+    options.setdefault("key_delay", 0.25)
+    for key, (param, kind) in JOB_SPEC_OPTIONS.items():
+        if spec.get(key) is not None:
+            options[param] = kind(spec[key]) if kind else spec[key]
+    key_delay = options.pop("key_delay")
+    start_row = int(spec.get("start_row", 2))
+    end_row = int(spec["end_row"]) if spec.get("end_row") is not None else None
+    rows = [int(n) for n in spec["rows"]] if spec.get("rows") is not None else None
+    return TabmisAutomator(spec["path"], start_row, end_row, key_delay, rows=rows, **options)
 
-        normalized = [self._normalize_key_name(k) for k in keys]
-        MODIFIERS = {'shift', 'ctrl', 'alt', 'win', 'command'}
 
-        modifiers = [k for k in normalized if k in MODIFIERS]
-        main_keys = [k for k in normalized if k not in MODIFIERS]
+class Job:
+    """Một job trong JobQueue: spec, trạng thái (queued/running/paused/done/failed/stopped/cancelled) và automator."""
 
-        prefix_map = {
-            'ctrl': '^',
-            'shift': '+',
-            'alt': '%',
-            # 'win' is not supported as prefix in send_keys; use {LWIN} if needed
+    def __init__(self, job_id, spec, automator=None):
+        self.id = job_id
+        self.spec = dict(spec)
+        self.automator = automator
+        self.status = "queued"
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.error = None
+        self.last_status = ""
+
+    def to_dict(self):
+        metrics = self.automator.metrics if self.automator is not None else {}
+        return {
+            "id": self.id, "status": self.status, "spec": self.spec,
+            "submitted": self.submitted, "started": self.started, "finished": self.finished,
+            "error": self.error, "last_status": self.last_status,
+            "metrics": {k: v for k, v in metrics.items() if isinstance(v, (int, float, str, bool, type(None)))},
         }
-        prefix = ''.join(prefix_map.get(m, '') for m in modifiers)
 
-        if not main_keys:
-            # No main key — try to send modifiers alone (rare)
-            try:
-                # send a modifier press-release by sending prefix alone (may be ignored)
-                keyboard.send_keys(prefix)
-            except Exception:
-                pass
-            self._sleep_with_cancel(self.key_delay)
-            return
 
-        for mk in main_keys:
-            if self._stop_requested:
-                return
-            token = self._token_for_key(mk)
-            seq = f"{prefix}{token}"
-            try:
-                keyboard.send_keys(seq)
-            except Exception:
-                # fallback: try without braces
-                try:
-                    keyboard.send_keys(f"{prefix}{mk}")
-                except Exception:
-                    pass
-            self._sleep_with_cancel(0.02)
+class JobQueue:
+    """
+    Hàng đợi job trong tiến trình, dùng chung giữa GUI, JobRunner và JobControlServer.
+    Sự kiện tiến độ (submitted/started/status/paused/resumed/finished) được phát tới mọi
+    subscriber (queue.Queue có giới hạn; đầy thì bỏ sự kiện cũ nhất).
+    """
 
-        self._sleep_with_cancel(self.key_delay)
+    def __init__(self):
+        self._jobs = collections.OrderedDict()
+        self._pending = collections.deque()
+        self._cond = threading.Condition()
+        self._ids = itertools.count(1)
+        self._subscribers = []
+        self.closed = False
 
-    def get_cell(self, row, col_1based):
-        idx = col_1based - 1
-        if idx < 0:
-            return ""
-        if idx < len(row):
-            return row[idx]
-        return ""
+    def submit(self, spec, automator=None):
+        with self._cond:
+            job = Job(next(self._ids), spec, automator)
+            self._jobs[job.id] = job
+            self._pending.append(job)
+            self._cond.notify_all()
+        self.publish(job, "submitted")
+        return job
 
-    def process_row(self, row):
-        # Follow the user's specified sequence exactly
-        if self._stop_requested:
-            return
+    def get(self, job_id):
+        return self._jobs.get(job_id)
 
-        self.paste_text(self.get_cell(row, 1))
-        self.press('down')
+    def list(self):
+        return list(self._jobs.values())
 
-        self.paste_text(self.get_cell(row, 2))
-        self.press('tab')
-        self.press('tab')
+    def current(self):
+        return next((j for j in self._jobs.values() if j.status in ("running", "paused")), None)
 
-        self.paste_text(self.get_cell(row, 3))
-        for _ in range(5):
-            self.press('tab')
+    def pending(self):
+        return len(self._pending)
 
-        self.paste_text(self.get_cell(row, 4))
-        self.press('tab')
+    def next_job(self, timeout=None):
+        """Job kế tiếp (chặn tối đa timeout giây); None nếu hết giờ hoặc hàng đợi đã đóng."""
+        with self._cond:
+            if not self._pending and not self.closed:
+                self._cond.wait(timeout)
+            if self.closed or not self._pending:
+                return None
+            return self._pending.popleft()
 
-        self.paste_text(self.get_cell(row, 5))
-        self.press('enter')
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
 
-        self.press('tab')
-        self.press('tab')
+    def stop(self, job_id, reason="api"):
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        with self._cond:
+            if job in self._pending:
+                self._pending.remove(job)
+                job.status = "cancelled"
+                job.finished = time.time()
+        if job.status == "cancelled":
+            self.publish(job, "finished")
+        elif job.automator is not None:
+            job.automator.stop(reason)
+        return job
 
-        self.paste_text(self.get_cell(row, 6))
-        self.press('tab')
+    def pause(self, job_id):
+        job = self._jobs.get(job_id)
+        if job is not None and job.status == "running" and job.automator is not None:
+            job.automator.pause()
+            job.status = "paused"
+            self.publish(job, "paused")
+        return job
 
-        self.paste_text(self.get_cell(row, 7))
-        self.press('tab')
+    def resume(self, job_id):
+        job = self._jobs.get(job_id)
+        if job is not None and (job.status == "paused" or (job.automator is not None and job.automator.paused)):
+            job.status = "running"
+            job.automator.resume()
+            self.publish(job, "resumed")
+        return job
 
-        self.paste_text(self.get_cell(row, 8))
-        self.press('down')
+    def subscribe(self, maxsize=1000):
+        q = queue.Queue(maxsize)
+        with self._cond:
+            self._subscribers.append(q)
+        return q
 
-        self.paste_text(self.get_cell(row, 9))
-        self.press('tab')
-        self.press('tab')
+    def unsubscribe(self, q):
+        with self._cond:
+            if q in self._subscribers:
+                self._subscribers.remove(q)
 
-        self.paste_text(self.get_cell(row, 10))
+    def publish(self, job, event, **data):
+        record = dict(job.to_dict(), event=event, time=time.time(), **data)
+        with self._cond:
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            while True:
+                try:
+                    q.put_nowait(record)
+                    break
+                except queue.Full:
+                    try:
+                        q.get_nowait()
+                    except queue.Empty:
+                        pass
 
-        self.hotkey('ctrl', 's')
-        self.press('enter')
-        self.hotkey('alt', 'c')
 
-        #self.press('down', count=4)
-        self.press('down')
-        self.press('down')
-        self.press('down')
-        self.press('down')
-        self.press('enter')
+class JobRunner:
+    """
+    Thread chạy lần lượt các job của JobQueue. Job không kèm automator được dựng bằng
+    automator_factory(spec). on_start(job)/on_finish(job) chạy trên thread này (GUI gắn nguồn dừng,
+    bật/tắt nút qua đó); on_pause(job) khi job tự tạm dừng lại vì không focus lại được Tabmis.
+    """
 
-        self.paste_text(self.get_cell(row, 11))
-        self.press('tab')
-        self.press('tab')
-        self.press('tab')
+    def __init__(self, jobs, automator_factory=automator_from_spec, on_start=None, on_finish=None,
+                 status_callback=None, on_pause=None):
+        self.jobs = jobs
+        self.automator_factory = automator_factory
+        self.on_start = on_start
+        self.on_finish = on_finish
+        self.on_pause = on_pause
+        self.status_callback = status_callback
+        self._thread = None
 
-        self.paste_text(self.get_cell(row, 12))
-        self.press('tab')
-        self.press('tab')
+    @property
+    def busy(self):
+        return self.jobs.current() is not None
 
-        self.paste_text(self.get_cell(row, 13))
-        self.press('tab')
-        self.press('tab')
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, name="lkb-jobs", daemon=True)
+        self._thread.start()
+        return self
 
-        # Paste col15 then col16 immediately (as specified)
-        self.paste_text(self.get_cell(row, 14))
-        self.paste_text(self.get_cell(row, 15))
-        self.press('tab')
+    def stop(self):
+        self.jobs.close()
+        current = self.jobs.current()
+        if current is not None:
+            self.jobs.stop(current.id, "shutdown")
 
-        self.paste_text(self.get_cell(row, 16))
-        self.hotkey('shift', 'pagedown')
-        self.hotkey('shift', 'pagedown')
-        self.press('tab')
+    def join(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
 
-        self.paste_text(self.get_cell(row, 17))
-        self.press('tab')
-        self.press('tab')
-        self.press('tab')
+    def _loop(self):
+        while not self.jobs.closed:
+            job = self.jobs.next_job(timeout=0.5)
+            if job is not None:
+                self.run_job(job)
 
-        self.paste_text(self.get_cell(row, 18))
-        self.hotkey('ctrl', 's')
-        self.press('f4')
-        self.hotkey('shift', 'pageup')
-        self.press('down')
+    def run_job(self, job):
+        job.started = time.time()
+        try:
+            if job.automator is None:
+                job.automator = self.automator_factory(job.spec)
+        except Exception as e:
+            job.status, job.error, job.finished = "failed", str(e), time.time()
+            self.jobs.publish(job, "finished")
+            return job
+        job.status = "running"
+        self.jobs.publish(job, "started")
 
-    def run(self, status_callback=None):
-        # status_callback(text) to update UI
-        if keyboard is None:
-            if status_callback:
-                status_callback("pywinauto not installed. Please run: pip install pywinauto")
-            return
+        def status(text):
+            job.last_status = text
+            self.jobs.publish(job, "status", text=text)
+            if self.status_callback:
+                self.status_callback(text)
+
+        def repaused():
+            self.jobs.pause(job.id)
+            if self.on_pause:
+                self.on_pause(job)
+
+        job.automator.on_repause = repaused
         try:
-            ext = os.path.splitext(self.csv_path)[1].lower()
-            if ext == ".csv":
-                with open(self.csv_path, newline='', encoding='utf-8') as f:
-                    reader = list(csv.reader(f))
-            elif ext in (".xlsx", ".xls"):
-                # Read all cells (no header) and convert NaN to empty string
-                df = pd.read_excel(self.csv_path, header=None)
-                df = df.where(df.notna(), "")
-                reader = df.astype(str).values.tolist()
+            if self.on_start:
+                self.on_start(job)
+            ok = job.automator.run(status_callback=status)
+            if job.automator.cancel_token.cancelled:
+                job.status = "stopped"
             else:
-                if status_callback:
-                    status_callback(f"Unsupported file type: {ext}. Please use CSV or Excel.")
-                return
-        except FileNotFoundError:
-            if status_callback:
-                status_callback(f"File not found: {self.csv_path}")
-            return
+                job.status = "done" if ok and not job.automator.failed_rows else "failed"
         except Exception as e:
-            if status_callback:
-                status_callback(f"Error reading file: {e}")
-            return
+            job.status, job.error = "failed", str(e)
+        finally:
+            job.finished = time.time()
+            job.automator.on_repause = None
+            try:
+                job.automator.cancel_token.close()
+            except Exception:
+                pass
+            self.jobs.publish(job, "finished")
+            if self.on_finish:
+                self.on_finish(job)
+        return job
 
-        total_rows = len(reader)
-        if status_callback:
-            status_callback(f"Loaded {total_rows} rows. Đang tìm cửa sổ Tabmis...")
 
-        # Tự động focus vào cửa sổ Tabmis
-        if not self.focus_tabmis_window(status_callback):
-            if status_callback:
-                status_callback("Không tìm thấy cửa sổ Tabmis. Dừng chạy.")
-            return
-        else:
-            if status_callback:
-                status_callback(f"Đã focus vào cửa sổ Tabmis. Bắt đầu sau {self.start_delay} giây...")
+def _is_loopback(host):
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
 
-        # Give user time to focus Tabmis window (nếu chưa focus được tự động)
-        countdown = int(self.start_delay)
-        for t in range(countdown, 0, -1):
-            if self._stop_requested:
-                if status_callback:
-                    status_callback("Stopped before start.")
-                return
-            if status_callback:
-                status_callback(f"Starting in {t}...")
-            self._sleep_with_cancel(1)
 
-        for i in range(self.start_row, self.end_row + 1):
-            if self._stop_requested:
-                if status_callback:
-                    status_callback("Stopped by user.")
-                return
+class _JobRequestHandler(BaseHTTPRequestHandler):
+    server_version = "LKBJobAPI/1.0"
 
-            idx = i - 1
-            if idx < 0 or idx >= total_rows:
-                if status_callback:
-                    status_callback(f"Skipping row {i}: not in CSV")
-                continue
+    @property
+    def jobs(self):
+        return self.server.jobs
 
-            row = reader[idx]
-            if status_callback:
-                status_callback(f"Processing row {i}...")
+    def log_message(self, fmt, *args):
+        pass
+
+    def _send_json(self, code, payload):
+        body = json.dumps(payload, ensure_ascii=False, default=str).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _route(self):
+        """(tài nguyên, job_id, hành động) từ đường dẫn /jobs, /jobs/<id>, /jobs/<id>/<action>."""
+        parts = [p for p in urlparse(self.path).path.split("/") if p]
+        resource = parts[0] if parts else ""
+        job_id = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else None
+        action = parts[2] if len(parts) > 2 else None
+        return resource, job_id, action
+
+    def _allowed(self):
+        """
+        Chặn mọi request không đến từ một client cục bộ có token: trang web bất kỳ mở trên máy
+        (CSRF, DNS rebinding) vẫn gửi được request tới 127.0.0.1 nên kiểm tra cả Host, Origin,
+        Content-Type (POST) và token phiên.
+        """
+        if not _is_loopback(self.client_address[0]):
+            return self._deny(403, "localhost only")
+        if self.headers.get("Host", "").lower() not in self.server.allowed_hosts:
+            return self._deny(403, "bad Host header")
+        if self.headers.get("Origin") is not None:
+            return self._deny(403, "cross-origin requests are not allowed")
+        if self.command == "POST":
+            content_type = (self.headers.get("Content-Type") or "").split(";")[0].strip().lower()
+            if content_type != "application/json":
+                return self._deny(415, "Content-Type must be application/json")
+        scheme, _, token = (self.headers.get("Authorization") or "").partition(" ")
+        if scheme.lower() != "bearer" or not hmac.compare_digest(token.strip().encode(), self.server.token.encode()):
+            return self._deny(401, "missing or invalid token")
+        return True
+
+    def _deny(self, code, message):
+        self._send_json(code, {"error": message})
+        return False
+
+    def do_GET(self):
+        if not self._allowed():
+            return
+        resource, job_id, _ = self._route()
+        if resource == "jobs" and job_id is None:
+            self._send_json(200, [j.to_dict() for j in self.jobs.list()])
+        elif resource == "jobs":
+            job = self.jobs.get(job_id)
+            self._send_json(200, job.to_dict()) if job else self._send_json(404, {"error": "no such job"})
+        elif resource == "events":
+            self._stream_events()
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if not self._allowed():
+            return
+        resource, job_id, action = self._route()
+        if resource != "jobs":
+            self._send_json(404, {"error": "not found"})
+            return
+        if job_id is None:
             try:
-                self.process_row(row)
+                length = int(self.headers.get("Content-Length") or 0)
+                spec = json.loads(self.rfile.read(length) or b"{}")
+                if not isinstance(spec, dict):
+                    raise ValueError("job spec must be a JSON object")
+                # Kiểm tra spec ngay để báo lỗi cho người gửi thay vì lỗi muộn trong runner
+                self.server.validate(spec)
             except Exception as e:
-                if status_callback:
-                    status_callback(f"Error on row {i}: {e}")
+                self._send_json(400, {"error": str(e)})
                 return
+            self._send_json(201, self.jobs.submit(spec).to_dict())
+            return
+        handler = {"pause": self.jobs.pause, "resume": self.jobs.resume, "stop": self.jobs.stop}.get(action)
+        if handler is None:
+            self._send_json(404, {"error": "unknown action"})
+            return
+        job = handler(job_id)
+        self._send_json(200, job.to_dict()) if job else self._send_json(404, {"error": "no such job"})
 
-            if status_callback:
-                status_callback(f"Finished row {i}. Waiting {self.between_rows_delay}s")
-            self._sleep_with_cancel(self.between_rows_delay)
+    def _stream_events(self):
+        """NDJSON: mỗi dòng một sự kiện; ?job=<id> để lọc; dòng ping mỗi 15 giây giữ kết nối."""
+        query = parse_qs(urlparse(self.path).query)
+        only = int(query["job"][0]) if "job" in query else None
+        q = self.jobs.subscribe()
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson; charset=utf-8")
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            while not self.server.closing:
+                try:
+                    event = q.get(timeout=self.server.ping_interval)
+                except queue.Empty:
+                    event = {"event": "ping", "time": time.time()}
+                if only is not None and event.get("id") not in (None, only):
+                    continue
+                self.wfile.write(json.dumps(event, ensure_ascii=False, default=str).encode("utf-8") + b"\n")
+                self.wfile.flush()
+                if only is not None and event.get("event") == "finished":
+                    return
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            self.jobs.unsubscribe(q)
 
-        if status_callback:
-            status_callback("All done.")
+
+class JobControlServer(ThreadingHTTPServer):
+    """
+    API điều khiển job chỉ trên localhost (HTTP/JSON):
+      GET  /jobs                   danh sách job
+      POST /jobs                   gửi job {"path", "start_row", "end_row", "rows", "profile", ...}
+      GET  /jobs/<id>              trạng thái + metrics
+      POST /jobs/<id>/pause|resume|stop
+      GET  /events[?job=<id>]      luồng tiến độ NDJSON
+    Mọi request cần "Authorization: Bearer <token>" (token=None: token ngẫu nhiên cho phiên này),
+    Host là 127.0.0.1/localhost:<port>, không có Origin; POST phải là application/json.
+    port=0 chọn cổng trống (xem .port).
+    """
+    daemon_threads = True
+
+    def __init__(self, jobs, host="127.0.0.1", port=8765, validate=None, ping_interval=15.0, token=None):
+        if not _is_loopback(host):
+            raise ValueError("Job API only binds to a loopback address")
+        super().__init__((host, port), _JobRequestHandler)
+        self.token = token or secrets.token_urlsafe(24)
+        self.allowed_hosts = {f"{name}:{self.port}" for name in ("127.0.0.1", "localhost", host)}
+        self.jobs = jobs
+        self.validate = validate or validate_job_spec
+        self.ping_interval = ping_interval
+        self.closing = False
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name="lkb-api", daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self):
+        self.closing = True
+        self.shutdown()
+        self.server_close()
 
 
 # ---------- GUI ----------
 class App:
-    def __init__(self, root):
+    def __init__(self, root, trace_path=None, delay_profile=None, jobs=None, api_defaults=None, run_log=None):
         self.root = root
+        # File trace Chrome (python lkb_auto_pywinauto_v2.py --trace run.json)
+        self.trace_path = trace_path
+        # Tham số RunLog (--log run.jsonl): mỗi lần chạy ghi nhật ký JSON lines
+        self.run_log = run_log
+        # Hồ sơ delay (--delay-profile): điền sẵn Delay_k/Delay_r, delay từng nhóm bước đi kèm mỗi lần chạy
+        self.delay_profile = load_delay_profile(delay_profile)
         root.title("LKB Auto")
         root.resizable(False, False)
 
@@ -596,15 +5653,15 @@ class App:
         tk.Entry(frm, textvariable=self.end_var, width=10, bg="white", fg="black").grid(row=1, column=2, sticky="w")
 
         tk.Label(frm, text="Delay_k(s)", fg=self.text_color, bg=self.primary_color).grid(row=2, column=0, sticky="e")
-        self.delay_var = tk.StringVar(value="0.25")
+        self.delay_var = tk.StringVar(value=str(self.delay_profile.get("key_delay", 0.25)))
         tk.Entry(frm, textvariable=self.delay_var, width=10, bg="white", fg="black").grid(row=2, column=1, sticky="w")
 
         tk.Label(frm, text="Delay_r(s)", fg=self.text_color, bg=self.primary_color).grid(row=2, column=1, sticky="e")
-        self.between_var = tk.StringVar(value="0.25")
+        self.between_var = tk.StringVar(value=str(self.delay_profile.get("between_rows_delay", 0.25)))
         tk.Entry(frm, textvariable=self.between_var, width=10, bg="white", fg="black").grid(row=2, column=2, sticky="w")
 
         # Checkbox: Wait while mouse cursor is hourglass
-        self.wait_cursor_var = tk.BooleanVar(value=True)
+        self.wait_cursor_var = tk.BooleanVar(value=self.delay_profile.get("wait_cursor", True))
         tk.Checkbutton(
             frm,
             text="Chờ Tabmis phản hồi",
@@ -613,10 +5670,79 @@ class App:
             bg=self.primary_color,
             activebackground=self.primary_color,
             selectcolor=self.primary_color
-        ).grid(row=3, column=0, columnspan=3, sticky="w", pady=(6,0))
+        ).grid(row=3, column=0, columnspan=2, sticky="w", pady=(6,0))
+
+        # Số lần thử lại một dòng lỗi (sau khi chạy reset macro Esc, F4)
+        tk.Label(frm, text="Retry", fg=self.text_color, bg=self.primary_color).grid(row=3, column=1, sticky="e", pady=(6,0))
+        self.retry_var = tk.StringVar(value="1")
+        tk.Entry(frm, textvariable=self.retry_var, width=10, bg="white", fg="black").grid(row=3, column=2, sticky="w", pady=(6,0))
+
+        # Checkbox: gõ phím bằng SendInput (gửi cả tổ hợp trong một lô, gõ được Unicode)
+        self.sendinput_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(
+            frm,
+            text="Gõ phím nhanh (SendInput)",
+            variable=self.sendinput_var,
+            fg=self.text_color,
+            bg=self.primary_color,
+            activebackground=self.primary_color,
+            selectcolor=self.primary_color
+        ).grid(row=4, column=0, columnspan=2, sticky="w")
+
+        # Checkbox: các dòng liền nhau trùng header (cột 1-10) nhập chung một chứng từ
+        self.group_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(
+            frm,
+            text="Gom chứng từ",
+            variable=self.group_var,
+            fg=self.text_color,
+            bg=self.primary_color,
+            activebackground=self.primary_color,
+            selectcolor=self.primary_color
+        ).grid(row=4, column=2, columnspan=2, sticky="w")
+
+        # Điều tiết: số dòng tối đa mỗi phút (trống = không giới hạn) và khung giờ chạy
+        tk.Label(frm, text="Dòng/phút", fg=self.text_color, bg=self.primary_color).grid(row=5, column=0, sticky="e")
+        self.rpm_var = tk.StringVar(value="")
+        tk.Entry(frm, textvariable=self.rpm_var, width=10, bg="white", fg="black").grid(row=5, column=1, sticky="w")
+
+        tk.Label(frm, text="Giờ chạy", fg=self.text_color, bg=self.primary_color).grid(row=5, column=1, sticky="e")
+        self.window_var = tk.StringVar(value="")
+        tk.Entry(frm, textvariable=self.window_var, width=12, bg="white", fg="black").grid(row=5, column=2, sticky="w")
+
+        # Checkbox: không dán lại các ô Tabmis giữ giá trị khi trùng dòng trước
+        self.carry_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(
+            frm,
+            text="Bỏ qua ô trùng dòng trước",
+            variable=self.carry_var,
+            fg=self.text_color,
+            bg=self.primary_color,
+            activebackground=self.primary_color,
+            selectcolor=self.primary_color
+        ).grid(row=6, column=0, columnspan=2, sticky="w")
+
+        # Checkbox: ghi kết quả (trạng thái, số chứng từ) vào cột LKB_* của file nguồn
+        # thay vì file <data>_result.csv
+        self.result_source_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(
+            frm,
+            text="Ghi kết quả vào file nguồn",
+            variable=self.result_source_var,
+            fg=self.text_color,
+            bg=self.primary_color,
+            activebackground=self.primary_color,
+            selectcolor=self.primary_color
+        ).grid(row=6, column=2, columnspan=2, sticky="w")
+
+        # Lọc dòng trong khoảng Start_r..End_r, vd. "3=DV01; 5>=1000000; !done" (xem parse_row_filter)
+        tk.Label(frm, text="Lọc dòng", fg=self.text_color, bg=self.primary_color).grid(row=7, column=0, sticky="e")
+        self.filter_var = tk.StringVar(value="")
+        tk.Entry(frm, textvariable=self.filter_var, width=40, bg="white", fg="black").grid(
+            row=7, column=1, columnspan=2, sticky="w")
 
         btn_frame = tk.Frame(frm, pady=8, bg=self.primary_color)
-        btn_frame.grid(row=4, column=0, columnspan=4)
+        btn_frame.grid(row=8, column=0, columnspan=4)
 
         self.ok_btn = tk.Button(
             btn_frame,
@@ -630,6 +5756,18 @@ class App:
         )
         self.ok_btn.pack(side="left", padx=6)
 
+        self.retry_btn = tk.Button(
+            btn_frame,
+            text="Chạy lại lỗi",
+            width=12,
+            command=self.on_retry_failed,
+            bg=self.button_color,
+            fg=self.text_color,
+            activebackground=self.button_active,
+            activeforeground=self.text_color
+        )
+        self.retry_btn.pack(side="left", padx=6)
+
         self.exit_btn = tk.Button(
             btn_frame,
             text="Thoát",
@@ -655,6 +5793,20 @@ class App:
         )
         self.stop_btn.pack(side="left", padx=6)
 
+        # Tạm dừng/tiếp tục ở ranh giới bước (hoặc phím Pause toàn cục khi đang chạy)
+        self.pause_btn = tk.Button(
+            btn_frame,
+            text="Tạm dừng",
+            width=12,
+            command=self.on_pause_toggle,
+            state="disabled",
+            bg=self.button_color,
+            fg=self.text_color,
+            activebackground=self.button_active,
+            activeforeground=self.text_color
+        )
+        self.pause_btn.pack(side="left", padx=6)
+
         self.status_label = tk.Label(
             frm,
             text="Ready. © lanpv@vst.gov.vn",
@@ -663,17 +5815,23 @@ class App:
             fg=self.text_color,
             bg=self.primary_color
         )
-        self.status_label.grid(row=5, column=0, columnspan=4, sticky="w")
+        self.status_label.grid(row=9, column=0, columnspan=4, sticky="w")
 
         # Thêm ngôi sao vàng 5 cánh (cờ Việt Nam) ở góc trên bên phải
         self._add_vietnam_flag_star(root)
 
         self.automator = None
-        self.worker_thread = None
+        # Mọi lần chạy (nút Chạy, Chạy lại lỗi, job gửi qua --serve) đi qua một hàng đợi job;
+        # job từ API dựng automator theo api_defaults (tham số dòng lệnh), không đọc ô nhập của GUI
+        self.jobs = jobs or JobQueue()
+        self.runner = JobRunner(
+            self.jobs, automator_factory=lambda spec: automator_from_spec(spec, api_defaults),
+            on_start=self._on_job_start, on_finish=self._on_job_finish, status_callback=self.set_status,
+            on_pause=self._on_job_pause,
+        ).start()
 
-        # ESC watcher (global) controls
-        self._esc_watcher_thread = None
-        self._esc_watcher_stop_event = None
+        # Nguồn dừng của lần chạy hiện tại (nút Dừng / ESC đi qua cancel token)
+        self._stop_source = None
 
         # Phím tắt: nhấn ESC để dừng ngay lập tức (khi app có focus)
         self.root.bind("<Escape>", self._on_esc_pressed)
@@ -746,15 +5904,60 @@ class App:
         self.root.after(0, _update)
 
     def on_ok(self):
+        self._start_automation()
+
+    def on_retry_failed(self):
+        """Chạy lại các dòng đã ghi trong file dòng lỗi của file dữ liệu hiện tại."""
+        csv_path = self.csv_var.get().strip()
+        if not csv_path:
+            messagebox.showerror("File dữ liệu", "Vui lòng chọn file dữ liệu (CSV hoặc Excel).")
+            return
+        failed_path = default_failed_rows_path(csv_path)
+        try:
+            rows = load_failed_rows(failed_path)
+        except FileNotFoundError:
+            messagebox.showinfo("Chạy lại lỗi", f"Không có file dòng lỗi:\n{failed_path}")
+            return
+        except Exception as e:
+            messagebox.showerror("Chạy lại lỗi", f"Không đọc được file dòng lỗi:\n{e}")
+            return
+        if not rows:
+            messagebox.showinfo("Chạy lại lỗi", "Không có dòng lỗi nào để chạy lại.")
+            return
+        if not messagebox.askyesno("Chạy lại lỗi", f"Chạy lại {len(rows)} dòng lỗi?"):
+            return
+        # Giữ bản cũ làm .bak; lần chạy lại sẽ ghi các dòng còn lỗi vào file mới
+        try:
+            os.replace(failed_path, failed_path + ".bak")
+        except Exception:
+            pass
+        self._start_automation(rows=rows)
+
+    def _start_automation(self, rows=None):
         try:
             start_row = int(self.start_var.get())
             end_row = int(self.end_var.get())
-            if start_row <= 0 or end_row <= 0:
-                raise ValueError("Row numbers must be >= 1")
-            if end_row < start_row:
-                raise ValueError("End row must be >= start row")
+            if rows is None:
+                if start_row <= 0 or end_row <= 0:
+                    raise ValueError("Row numbers must be >= 1")
+                if end_row < start_row:
+                    raise ValueError("End row must be >= start row")
             key_delay = float(self.delay_var.get())
             between = float(self.between_var.get())
+            max_retries = int(self.retry_var.get())
+            if max_retries < 0:
+                raise ValueError("Retry must be >= 0")
+            rpm = float(self.rpm_var.get()) if self.rpm_var.get().strip() else None
+            if rpm is not None and rpm <= 0:
+                raise ValueError("Dòng/phút must be > 0")
+            run_windows = parse_run_windows(self.window_var.get().strip())
+            row_filter = self.filter_var.get().strip() or None
+            if row_filter:
+                try:
+                    parse_row_filter(row_filter)
+                except ValueError:
+                    # Có thể dùng tên cột: kiểm tra lại với dòng 1 của file
+                    parse_row_filter(row_filter, read_header(self.csv_var.get().strip()))
         except Exception as e:
             messagebox.showerror("Invalid input", f"Please check inputs:\n{e}")
             return
@@ -770,12 +5973,14 @@ class App:
                 return
 
         # If pywinauto not available, warn and abort
-        if keyboard is None:
+        key_backend = "sendinput" if self.sendinput_var.get() else "pywinauto"
+        if not make_key_backend(key_backend).available():
             messagebox.showerror("pywinauto not available", "Module 'pywinauto' not found. Please install it via:\n\npip install pywinauto\n\nThis script requires pywinauto (Windows).")
             return
 
         # Disable buttons and start thread
         self.ok_btn.config(state="disabled")
+        self.retry_btn.config(state="disabled")
         self.exit_btn.config(state="disabled")
         self.stop_btn.config(state="normal")
         self.set_status("Preparing...")
@@ -783,99 +5988,446 @@ class App:
         self.automator = TabmisAutomator(
             csv_path, start_row, end_row, key_delay,
             between_rows_delay=between, start_delay=3.0,
-            wait_cursor=self.wait_cursor_var.get()
+            wait_cursor=self.wait_cursor_var.get(),
+            max_retries=max_retries, rows=rows,
+            column_schema=find_schema_file(csv_path),
+            key_backend=key_backend,
+            group_mode="consecutive" if self.group_var.get() else None,
+            carry_forward=self.carry_var.get(),
+            result_mode="source" if self.result_source_var.get() else "sidecar",
+            trace_path=self.trace_path,
+            run_log=self.run_log,
+            delay_profile={"step_delays": self.delay_profile.get("step_delays", {})},
+            row_filter=row_filter,
+            watchdog=Watchdog(),
+            governor=RateGovernor(rpm, save_latency_target=DEFAULT_SAVE_LATENCY_TARGET,
+                                  run_windows=self.window_var.get().strip()) if (rpm or run_windows) else None
         )
-        self.worker_thread = threading.Thread(target=self._run_worker, daemon=True)
-        self.worker_thread.start()
+        self.jobs.submit({"path": csv_path, "start_row": start_row, "end_row": end_row, "rows": rows,
+                          "source": "gui"}, automator=self.automator)
 
-        # Start global ESC watcher so pressing ESC even when Tabmis is focused will stop automation.
-        self._start_esc_watcher()
+    def _start_stop_sources(self):
+        """Gắn các nguồn dừng của GUI vào token của automator: nút Dừng và ESC toàn cục."""
+        token = self.automator.cancel_token
+        self._stop_source = token.add_source(ManualStopSource("gui"))
+        # Global ESC so pressing ESC even when Tabmis is focused will stop automation.
+        # Phím Pause: tạm dừng/tiếp tục (chuyển về thread Tk)
+        token.add_source(EscHotkeySource(on_pause=lambda: self.root.after(0, self.on_pause_toggle)))
+        token.on_cancel(lambda reason: self.set_status(f"Stop requested ({reason})..."))
 
-    def _esc_watcher_loop(self, stop_event):
-        """
-        Windows-only global ESC watcher using GetAsyncKeyState.
-        If ESC pressed, trigger on_stop via root.after to ensure main-thread handling.
-        """
-        if platform.system() != "Windows":
-            return
-        try:
-            user32 = ctypes.windll.user32
-            VK_ESC = 0x1B
-            while not stop_event.is_set():
-                # high-order bit set means key is currently down
-                state = user32.GetAsyncKeyState(VK_ESC)
-                if state & 0x8000:
-                    # Debounce: trigger stop and wait until released
-                    self.root.after(0, self.on_stop)
-                    # wait until released or short sleep to avoid repeated triggers
-                    while (user32.GetAsyncKeyState(VK_ESC) & 0x8000) and not stop_event.is_set():
-                        time.sleep(0.05)
-                    # small cooldown
-                    time.sleep(0.2)
-                    # continue watching until automation finishes or stop_event set
-                time.sleep(0.05)
-        except Exception:
-            # if any error, just exit the watcher silently
-            return
+    def _on_job_start(self, job):
+        """(thread JobRunner) Job bắt đầu: gắn nút Dừng/ESC, khóa các nút chạy."""
+        self.automator = job.automator
+        self._start_stop_sources()
 
-    def _start_esc_watcher(self):
-        # Start watcher only if not already started
-        if self._esc_watcher_thread and self._esc_watcher_thread.is_alive():
-            return
-        self._esc_watcher_stop_event = threading.Event()
-        self._esc_watcher_thread = threading.Thread(
-            target=self._esc_watcher_loop,
-            args=(self._esc_watcher_stop_event,),
-            daemon=True
-        )
-        self._esc_watcher_thread.start()
+        def _start():
+            self.ok_btn.config(state="disabled")
+            self.retry_btn.config(state="disabled")
+            self.exit_btn.config(state="disabled")
+            self.stop_btn.config(state="normal")
+            self.pause_btn.config(state="normal", text="Tạm dừng")
+        self.root.after(0, _start)
 
-    def _stop_esc_watcher(self):
-        if self._esc_watcher_stop_event:
-            self._esc_watcher_stop_event.set()
-        if self._esc_watcher_thread:
-            try:
-                self._esc_watcher_thread.join(timeout=0.5)
-            except Exception:
-                pass
-        self._esc_watcher_thread = None
-        self._esc_watcher_stop_event = None
+    def _on_job_pause(self, job):
+        """(thread JobRunner) Job tự tạm dừng lại (không focus lại được Tabmis): nút về "Tiếp tục"."""
+        self.root.after(0, lambda: self.pause_btn.config(text="Tiếp tục"))
 
-    def _run_worker(self):
-        try:
-            self.automator.run(status_callback=self.set_status)
-        finally:
-            # Ensure ESC watcher is stopped
-            try:
-                self._stop_esc_watcher()
-            except Exception:
-                pass
+    def _on_job_finish(self, job):
+        """(thread JobRunner) Job xong; JobRunner đã gỡ các nguồn dừng (ESC hook...)."""
+        self._stop_source = None
+        if job.spec.get("source") != "gui":
+            self.set_status(f"Job {job.id}: {job.status}")
 
-            # Re-enable buttons when done
-            def _finish():
-                self.ok_btn.config(state="normal")
-                self.exit_btn.config(state="normal")
-                self.stop_btn.config(state="disabled")
+        # Re-enable buttons when done
+        def _finish():
+            if self.jobs.pending():
+                return
+            self.ok_btn.config(state="normal")
+            self.retry_btn.config(state="normal")
+            self.exit_btn.config(state="normal")
+            self.stop_btn.config(state="disabled")
+            self.pause_btn.config(state="disabled", text="Tạm dừng")
+            if job.spec.get("source") == "gui":
                 messagebox.showinfo("Lanpv@vst.gov.vn", "Hoạt động đã kết thúc")
-            self.root.after(0, _finish)
+        self.root.after(0, _finish)
 
     def on_stop(self):
-        if self.automator:
-            self.automator.stop()
-            self.set_status("Stop requested...")
+        if self._stop_source:
+            self._stop_source.fire()
+        elif self.automator:
+            self.automator.stop("gui")
+
+    def on_pause_toggle(self):
+        """Tạm dừng job đang chạy ở bước kế tiếp, hoặc tiếp tục đúng bước đó (focus lại Tabmis)."""
+        job = self.jobs.current()
+        if job is None or job.automator is None:
+            return
+        if job.automator.paused:
+            self.jobs.resume(job.id)
+            self.pause_btn.config(text="Tạm dừng")
+        else:
+            self.jobs.pause(job.id)
+            self.pause_btn.config(text="Tiếp tục")
 
     def on_exit(self):
-        if self.worker_thread and self.worker_thread.is_alive():
+        if self.runner.busy:
             if not messagebox.askyesno("Exit", "Automation is running. Exit anyway?"):
                 return
+        self.runner.stop()
         self.root.quit()
 
 
-def main():
+def _console_status(text):
+    print(f"{time.strftime('%H:%M:%S')} {text}", flush=True)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="LKB Auto - nhập liệu Tabmis tự động.")
+    parser.add_argument("--watch", metavar="DIR",
+                        help="Chế độ hot-folder: theo dõi DIR và chạy lần lượt các file CSV/XLSX mới (không mở GUI).")
+    parser.add_argument("--done", metavar="DIR", help="Thư mục chứa file đã chạy xong (mặc định DIR/done).")
+    parser.add_argument("--failed", metavar="DIR", help="Thư mục chứa file lỗi (mặc định DIR/failed).")
+    parser.add_argument("--order", choices=("arrival", "priority"), default="arrival",
+                        help="Thứ tự xử lý file: theo thời điểm đến hoặc theo tiền tố ưu tiên trong tên file.")
+    parser.add_argument("--start-row", type=int, default=2, help="Dòng bắt đầu của mỗi file (mặc định 2).")
+    parser.add_argument("--delay-k", type=float, default=0.25, help="Delay giữa các phím (giây).")
+    parser.add_argument("--delay-r", type=float, default=0.25, help="Delay giữa các dòng (giây).")
+    parser.add_argument("--no-wait-cursor", action="store_true", help="Không chờ con trỏ chuột hết busy.")
+    parser.add_argument("--retries", type=int, default=1, help="Số lần thử lại một dòng lỗi.")
+    parser.add_argument("--poll", type=float, default=2.0, help="Chu kỳ quét thư mục (giây).")
+    parser.add_argument("--schema", metavar="JSON", help="File schema định dạng cột (xem load_column_schema).")
+    parser.add_argument("--catalogs", metavar="JSON",
+                        help="Spec danh mục tham chiếu để kiểm tra mã trước khi chạy "
+                             "(mặc định <data>.catalogs.json nếu có, xem CatalogValidator).")
+    parser.add_argument("--timeout", type=float, help="Tự dừng sau số giây này.")
+    parser.add_argument("--max-rpm", type=float, help="Số dòng tối đa mỗi phút.")
+    parser.add_argument("--save-latency", type=float,
+                        help="Ngưỡng độ trễ lưu (giây); vượt ngưỡng thì tự giãn nhịp.")
+    parser.add_argument("--window", action="append",
+                        help="Khung giờ được chạy, dạng HH:MM-HH:MM (có thể lặp lại), vd. 18:00-07:00.")
+    parser.add_argument("--group", choices=("consecutive", "sort"),
+                        help="Gom các dòng trùng header (cột 1-10): nhập header một lần cho nhiều dòng chi tiết.")
+    parser.add_argument("--max-group", type=int, help="Số dòng chi tiết tối đa trong một chứng từ khi gom.")
+    parser.add_argument("--carry-forward", action="store_true",
+                        help="Không dán lại các ô carry-forward-safe có giá trị trùng dòng trước.")
+    parser.add_argument("--results", choices=("sidecar", "source"),
+                        help="Ghi kết quả từng dòng (trạng thái, thời gian, số chứng từ): file <data>_result.csv "
+                             "hoặc các cột LKB_* của chính file nguồn.")
+    parser.add_argument("--results-every", type=int, default=50, help="Ghi kết quả theo lô mỗi N dòng.")
+    parser.add_argument("--voucher-pattern", metavar="REGEX",
+                        help=r'Biểu thức đọc số chứng từ (nhóm 1) từ tiêu đề cửa sổ Tabmis sau khi lưu, '
+                             r'vd. "Số CT:\s*(\d+)". Mặc định không đọc.')
+    parser.add_argument("--simulate", metavar="DATA",
+                        help="Chạy file dữ liệu trên form Tabmis giả lập và in báo cáo (tốc độ, ô nhập sai).")
+    parser.add_argument("--end-row", type=int, help="Dòng cuối khi --simulate/--publish (mặc định hết file).")
+    parser.add_argument("--sim-config", metavar="JSON",
+                        help='Cấu hình giả lập: {"latency": {"save": ["lognormal", 1.2, 0.4], ...}, '
+                             '"drop_while_busy": 1.0, "seed": 1}.')
+    parser.add_argument("--virtual", action="store_true",
+                        help="--simulate trên đồng hồ ảo: không ngủ thật, xong trong vài giây với cùng số liệu thời gian.")
+    parser.add_argument("--sweep", metavar="DATA",
+                        help="Tìm Delay_k/Delay_r và delay từng nhóm bước tối ưu cho các dòng của DATA "
+                             "trên mô hình độ trễ, in frontier tốc độ/tỉ lệ lỗi và ghi hồ sơ delay.")
+    parser.add_argument("--latency-from", metavar="TRACE",
+                        help="Lấy mô hình độ trễ từ file trace của một lần chạy thật (--trace).")
+    parser.add_argument("--grid", help="Danh sách key_delay thử đồng nhất, vd. 0.02,0.05,0.1,0.25 (mặc định tìm thích nghi).")
+    parser.add_argument("--trials", type=int, default=10, help="Số lần Monte Carlo cho mỗi điểm.")
+    parser.add_argument("--max-error", type=float, default=0.0, help="Tỉ lệ dòng lỗi tối đa chấp nhận.")
+    parser.add_argument("--margin", type=float, default=0.2, help="Biên an toàn nhân thêm vào delay đề xuất.")
+    parser.add_argument("--profile-out", metavar="JSON", help="File hồ sơ delay ghi ra (mặc định <DATA>.delays.json).")
+    parser.add_argument("--delay-profile", metavar="JSON",
+                        help="Nạp hồ sơ delay (do --sweep ghi ra) cho lần chạy.")
+    parser.add_argument("--serve", type=int, metavar="PORT",
+                        help="Mở API điều khiển job trên 127.0.0.1:PORT (gửi job, theo dõi tiến độ, tạm dừng/tiếp/dừng).")
+    parser.add_argument("--headless", action="store_true",
+                        help="Cùng --serve: chỉ chạy API và hàng đợi job, không mở GUI.")
+    parser.add_argument("--api-token", default=os.environ.get("LKB_API_TOKEN"),
+                        help="Token cho Job API (header Authorization: Bearer ...); mặc định LKB_API_TOKEN "
+                             "hoặc token ngẫu nhiên in ra khi khởi động.")
+    parser.add_argument("--filter", metavar="EXPR",
+                        help='Chỉ chạy các dòng thỏa biểu thức, vd. "3=DV01; 5>=1000000; !done" (xem parse_row_filter).')
+    parser.add_argument("--step-timeout", type=float, default=DEFAULT_STEP_TIMEOUT,
+                        help="Watchdog: hạn giờ mỗi bước (giây, 0 = tắt); quá hạn thì cảnh báo -> khôi phục -> bỏ dòng.")
+    parser.add_argument("--row-timeout", type=float, default=DEFAULT_ROW_TIMEOUT,
+                        help="Watchdog: hạn giờ mỗi dòng (giây, 0 = tắt); quá hạn thì bỏ dòng.")
+    parser.add_argument("--max-skips", type=int, default=3,
+                        help="Watchdog: dừng chạy sau số dòng liên tiếp bị bỏ này.")
+    parser.add_argument("--reader", choices=["auto"] + sorted(DATA_READERS), default="auto",
+                        help="Cách đọc file dữ liệu (mặc định tự chọn theo loại file, kích thước và vùng dòng).")
+    parser.add_argument("--bench", metavar="DATA",
+                        help="Đo tốc độ nạp (dòng/giây) và bộ nhớ đỉnh của từng reader trên DATA rồi thoát.")
+    parser.add_argument("--bench-repeat", type=int, default=3, help="Số lần đo mỗi reader khi --bench (lấy lần nhanh nhất).")
+    parser.add_argument("--queue", metavar="DB",
+                        help="Hàng đợi SQLite dùng chung (thư mục chia sẻ) cho nhiều máy: không kèm --publish/"
+                             "--requeue-failed thì chạy như một máy nhập liệu, thuê từng lô dòng tới khi job hết việc.")
+    parser.add_argument("--publish", metavar="DATA",
+                        help="Cùng --queue: nạp các dòng --start-row..--end-row của DATA (đã định dạng, lọc, "
+                             "kiểm tra danh mục) vào hàng đợi rồi thoát.")
+    parser.add_argument("--requeue-failed", action="store_true",
+                        help="Cùng --queue: đưa các dòng lỗi của job về hàng chờ rồi thoát.")
+    parser.add_argument("--job", help="Tên job trong hàng đợi (mặc định: tên file khi --publish, job mới nhất khi chạy).")
+    parser.add_argument("--batch-rows", type=int, default=DEFAULT_QUEUE_BATCH_ROWS,
+                        help="Số dòng mỗi lô thuê từ hàng đợi.")
+    parser.add_argument("--lease", type=float, default=DEFAULT_QUEUE_LEASE_SECONDS,
+                        help="Hạn thuê một lô (giây); máy giữ lô tự gia hạn, máy tắt/treo thì lô được thuê lại.")
+    parser.add_argument("--chunk-rows", type=int, default=DEFAULT_CHUNK_ROWS,
+                        help="Nạp dữ liệu theo khối số dòng này trên luồng nền trong lúc nhập (0 = nạp hết trước).")
+    parser.add_argument("--log", metavar="JSONL",
+                        help="Ghi nhật ký chạy JSON lines (bước, dòng, trạng thái, watchdog) ra file này.")
+    parser.add_argument("--log-max-bytes", type=int, default=DEFAULT_RUN_LOG_BYTES,
+                        help="Xoay vòng nhật ký khi file vượt số byte này (đoạn cũ nén .gz).")
+    parser.add_argument("--log-backups", type=int, default=DEFAULT_RUN_LOG_BACKUPS,
+                        help="Số đoạn nhật ký cũ giữ lại.")
+    parser.add_argument("--trace", metavar="JSON",
+                        help="Ghi timeline từng thao tác (Chrome trace-event JSON) ra file này khi xong/dừng.")
+    parser.add_argument("--trace-capacity", type=int, default=DEFAULT_TRACE_CAPACITY,
+                        help="Số sự kiện trace tối đa giữ trong bộ đệm vòng.")
+    parser.add_argument("--engine", choices=("thread", "asyncio"), default="thread",
+                        help="Engine chạy kế hoạch dòng: vòng lặp thread (mặc định) hoặc asyncio.")
+    parser.add_argument("--backend", choices=sorted(KEY_BACKENDS), default="pywinauto",
+                        help="Cách gửi phím: pywinauto send_keys hoặc SendInput (ctypes, gõ Unicode).")
+    return parser.parse_args(argv)
+
+
+def run_hot_folder(args):
+    if not make_key_backend(args.backend).available():
+        _console_status("pywinauto not installed. Please run: pip install pywinauto")
+        return 1
+    automator = TabmisAutomator(
+        None, args.start_row, None, args.delay_k,
+        between_rows_delay=args.delay_r, start_delay=3.0,
+        wait_cursor=not args.no_wait_cursor, max_retries=args.retries,
+        column_schema=args.schema, key_backend=args.backend, engine=args.engine,
+        group_mode=args.group, max_group_size=args.max_group, carry_forward=args.carry_forward,
+        result_mode=args.results, result_flush_every=args.results_every, voucher_pattern=args.voucher_pattern,
+        tracer=TraceRecorder(args.trace_capacity) if args.trace else None, trace_path=args.trace,
+        delay_profile=args.delay_profile, row_filter=args.filter, watchdog=watchdog_options(args),
+        run_log=run_log_options(args), chunk_rows=args.chunk_rows, reader=args.reader,
+        catalogs=args.catalogs,
+    )
+    if args.max_rpm or args.save_latency or args.window:
+        automator.governor = RateGovernor(args.max_rpm, save_latency_target=args.save_latency,
+                                          run_windows=args.window)
+    daemon = HotFolderDaemon(
+        automator, args.watch, done_dir=args.done, failed_dir=args.failed,
+        order=args.order, start_row=args.start_row, poll_interval=args.poll,
+    )
+    token = automator.cancel_token
+    token.add_source(SignalStopSource())
+    token.add_source(EscHotkeySource())
+    if args.timeout:
+        token.add_source(TimeoutStopSource(args.timeout))
+    try:
+        daemon.run_forever(status_callback=_console_status)
+    except KeyboardInterrupt:
+        automator.stop("signal")
+    finally:
+        token.close()
+    return 0
+
+
+def run_simulation(args):
+    config = {}
+    if args.sim_config:
+        with open(args.sim_config, encoding="utf-8") as f:
+            config = json.load(f)
+    sim = TabmisSimulator(latency=config.get("latency"), drop_while_busy=config.get("drop_while_busy", 1.0),
+                          seed=config.get("seed"))
+    report = simulate_file(
+        args.simulate, args.start_row, args.end_row, args.delay_k, args.delay_r,
+        simulator=sim, status_callback=_console_status,
+        wait_cursor=not args.no_wait_cursor, max_retries=args.retries, column_schema=args.schema,
+        engine=args.engine, group_mode=args.group, max_group_size=args.max_group,
+        carry_forward=args.carry_forward,
+        tracer=TraceRecorder(args.trace_capacity) if args.trace else None, trace_path=args.trace,
+        delay_profile=args.delay_profile, row_filter=args.filter, watchdog=watchdog_options(args),
+        run_log=run_log_options(args), chunk_rows=args.chunk_rows, reader=args.reader,
+        catalogs=args.catalogs, clock=VirtualClock() if args.virtual else None,
+    )
+    print(json.dumps(report, ensure_ascii=False, indent=2, default=str))
+    return 0 if not report["mis_keyed_fields"] else 2
+
+
+def run_sweep(args):
+    config = {}
+    if args.sim_config:
+        with open(args.sim_config, encoding="utf-8") as f:
+            config = json.load(f)
+    latency = dict(DEFAULT_SIM_LATENCY)
+    latency.update(config.get("latency") or {})
+    if args.latency_from:
+        latency = fit_latency_model(args.latency_from, base=latency)
+    loader = TabmisAutomator(args.sweep, args.start_row, args.end_row, args.delay_k,
+                             column_schema=args.schema, group_mode=args.group, max_group_size=args.max_group,
+                             row_filter=args.filter)
+    store = loader.load_rows(_console_status, preview=True)
+    if store is None or not len(store):
+        _console_status("Không có dòng dữ liệu để thử.")
+        return 1
+    units = [rows for _, rows in loader.iter_units(store)]
+    grid = [float(x) for x in args.grid.split(",")] if args.grid else None
+    base = load_delay_profile(args.delay_profile) or {"key_delay": args.delay_k, "between_rows_delay": args.delay_r}
+    recommended, points, frontier = sweep_delays(
+        units, latency=latency, base_profile=base, wait_cursor=not args.no_wait_cursor,
+        trials=args.trials, max_error=args.max_error, margin=args.margin, grid=grid,
+        carry_forward=args.carry_forward, group_mode=args.group,
+    )
+    print(f"{'giây/dòng':>10} {'dòng/giờ':>9} {'lỗi':>7}  hồ sơ")
+    for p in frontier:
+        print(f"{p['sec_per_row']:>10.3f} {3600.0 / p['sec_per_row']:>9.0f} {p['error_rate']:>7.1%}  "
+              f"{json.dumps(p['profile'], ensure_ascii=False)}")
+    out = args.profile_out or os.path.splitext(args.sweep)[0] + ".delays.json"
+    recommended["frontier"] = [{k: p[k] for k in ("sec_per_row", "error_rate")} for p in frontier]
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(recommended, f, ensure_ascii=False, indent=2)
+    _console_status(f"Đã ghi hồ sơ delay đề xuất: {out} "
+                    f"({recommended['expected']['sec_per_row']}s/dòng, lỗi {recommended['expected']['error_rate']:.1%})")
+    return 0
+
+
+def run_bench(args):
+    """--bench: bảng dòng/giây, thời gian tới khối đầu và bộ nhớ đỉnh của từng reader."""
+    path = args.bench
+    readers = readers_for(path) if args.reader == "auto" else [args.reader]
+    if not readers:
+        _console_status(f"Không có reader cho {path}")
+        return 1
+    for label, chunk_rows in (("nạp hết", BENCH_CHUNK_ROWS), ("theo khối", args.chunk_rows or BENCH_CHUNK_ROWS)):
+        auto = select_reader(path, args.start_row, args.end_row, chunk_rows)
+        print(f"{label} ({chunk_rows} dòng/khối), tự chọn: {auto}")
+        print(f"{'reader':<14} {'dòng':>9} {'giây':>8} {'dòng/giây':>11} {'khối đầu':>9} {'bộ nhớ đỉnh':>12}")
+        for res in benchmark_readers(path, args.start_row, args.end_row, readers, args.bench_repeat, chunk_rows):
+            if "error" in res:
+                print(f"{res['reader']:<14} lỗi: {res['error']}")
+                continue
+            print(f"{res['reader']:<14} {res['rows']:>9} {res['seconds']:>8.3f} {res['rows_per_sec'] or 0:>11.0f} "
+                  f"{res['first_chunk_seconds'] or 0:>9.3f} {format_bytes(res['peak_bytes']):>12}")
+        print()
+    return 0
+
+
+def run_work_queue(args):
+    """--queue DB: nạp job (--publish), đưa dòng lỗi về hàng chờ, hoặc chạy như một máy nhập liệu."""
+    options = {"path": args.queue, "batch_rows": args.batch_rows, "lease_seconds": args.lease}
+    if args.publish:
+        loader = TabmisAutomator(args.publish, args.start_row, args.end_row, args.delay_k, chunk_rows=0,
+                                 column_schema=args.schema, row_filter=args.filter, catalogs=args.catalogs,
+                                 reader=args.reader)
+        store = loader.load_rows(_console_status)
+        if store is None:
+            return 1
+        work_queue = WorkQueue(job=args.job or os.path.basename(args.publish), **options)
+        added = work_queue.publish(store, os.path.abspath(args.publish), loader.header_key)
+        _console_status(f"[queue] {work_queue.job}: thêm {added} dòng, {work_queue.counts()}")
+        return 0
+    work_queue = WorkQueue(job=args.job, **options)
+    if work_queue.job is None:
+        _console_status(f"[queue] {args.queue} chưa có job nào (dùng --publish).")
+        return 1
+    if args.requeue_failed:
+        _console_status(f"[queue] {work_queue.job}: {work_queue.requeue_failed()} dòng lỗi về hàng chờ.")
+        return 0
+    if not make_key_backend(args.backend).available():
+        _console_status("pywinauto not installed. Please run: pip install pywinauto")
+        return 1
+    path = work_queue.job_path() or work_queue.job
+    # Mỗi máy một file dòng lỗi cạnh DB (trạng thái chung nằm trong DB)
+    failed_path = f"{os.path.splitext(args.queue)[0]}_{socket.gethostname()}_failed.csv"
+    automator = TabmisAutomator(
+        path, 1, None, args.delay_k,
+        between_rows_delay=args.delay_r, start_delay=3.0,
+        wait_cursor=not args.no_wait_cursor, max_retries=args.retries, failed_rows_path=failed_path,
+        key_backend=args.backend, engine=args.engine,
+        group_mode=args.group, max_group_size=args.max_group, carry_forward=args.carry_forward,
+        tracer=TraceRecorder(args.trace_capacity) if args.trace else None, trace_path=args.trace,
+        delay_profile=args.delay_profile, watchdog=watchdog_options(args),
+        run_log=run_log_options(args), work_queue=work_queue, voucher_pattern=args.voucher_pattern,
+    )
+    if args.max_rpm or args.save_latency or args.window:
+        automator.governor = RateGovernor(args.max_rpm, save_latency_target=args.save_latency,
+                                          run_windows=args.window)
+    ok = automator.run(_console_status)
+    _console_status(f"[queue] {work_queue.job}: {work_queue.counts()}")
+    return 0 if ok else 1
+
+
+def watchdog_options(args):
+    if not args.step_timeout and not args.row_timeout:
+        return None
+    return {"step_timeout": args.step_timeout, "row_timeout": args.row_timeout,
+            "max_consecutive_skips": args.max_skips}
+
+
+def run_log_options(args):
+    if not args.log:
+        return None
+    return {"path": args.log, "max_bytes": args.log_max_bytes, "backups": args.log_backups}
+
+
+def job_defaults(args):
+    """Tham số TabmisAutomator mặc định cho job gửi qua API, lấy từ dòng lệnh."""
+    return {
+        "key_delay": args.delay_k, "between_rows_delay": args.delay_r, "start_delay": 3.0,
+        "wait_cursor": not args.no_wait_cursor, "max_retries": args.retries,
+        "column_schema": args.schema, "key_backend": args.backend, "engine": args.engine,
+        "group_mode": args.group, "max_group_size": args.max_group, "carry_forward": args.carry_forward,
+        "result_mode": args.results, "result_flush_every": args.results_every,
+        "voucher_pattern": args.voucher_pattern,
+        "delay_profile": args.delay_profile, "row_filter": args.filter,
+        "watchdog": watchdog_options(args), "run_log": run_log_options(args),
+        "chunk_rows": args.chunk_rows, "reader": args.reader, "catalogs": args.catalogs,
+    }
+
+
+def run_job_server(args):
+    """--serve --headless: API + hàng đợi job trên console."""
+    jobs = JobQueue()
+    defaults = job_defaults(args)
+    runner = JobRunner(jobs, automator_factory=lambda spec: automator_from_spec(spec, defaults),
+                       status_callback=_console_status).start()
+    server = JobControlServer(jobs, port=args.serve, token=args.api_token).start()
+    _console_status(f"Job API: http://127.0.0.1:{server.port}/jobs (Authorization: Bearer {server.token})")
+    # Ctrl+C / SIGTERM: dừng job đang chạy và tắt API
+    stop = threading.Event()
+    previous = {sig: signal.signal(sig, lambda *_: stop.set()) for sig in (signal.SIGINT, signal.SIGTERM)}
+    try:
+        while not stop.wait(0.5):
+            pass
+    finally:
+        for sig, handler in previous.items():
+            signal.signal(sig, handler)
+        runner.stop()
+        server.close()
+        runner.join(5)
+    return 0
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.serve and args.headless:
+        return run_job_server(args)
+    if args.bench:
+        return run_bench(args)
+    if args.sweep:
+        return run_sweep(args)
+    if args.simulate:
+        return run_simulation(args)
+    if args.queue:
+        return run_work_queue(args)
+    if args.watch:
+        return run_hot_folder(args)
     root = tk.Tk()
-    app = App(root)
-    root.mainloop()
+    app = App(root, trace_path=args.trace, delay_profile=args.delay_profile,
+              api_defaults=job_defaults(args), run_log=run_log_options(args))
+    server = JobControlServer(app.jobs, port=args.serve, token=args.api_token).start() if args.serve else None
+    if server is not None:
+        _console_status(f"Job API: http://127.0.0.1:{server.port}/jobs (Authorization: Bearer {server.token})")
+    try:
+        root.mainloop()
+    finally:
+        if server is not None:
+            server.close()
 
 
 if __name__ == "__main__":
-    main()
+    raise SystemExit(main())
@@ -0,0 +1,35 @@
+import csv
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import lkb_auto_pywinauto_v2 as lkb  # noqa: E402
+
+# Độ trễ giả lập nhanh để test chạy gọn (cùng dạng --sim-config)
+FAST_LATENCY = {"save": ("uniform", 0.05, 0.1), "screen": ("uniform", 0.02, 0.05),
+                "focus": ("uniform", 0.002, 0.006)}
+
+
+def data_row(voucher, line):
+    """Dòng dữ liệu: header (cột 1-10) theo chứng từ, chi tiết (cột 11-18) theo dòng."""
+    return [f"H{voucher}"] * 10 + [f"d{line}"] * (lkb.USED_COLUMNS - 10)
+
+
+@pytest.fixture
+def write_data(tmp_path):
+    """write_data(rows, name) -> đường dẫn CSV có dòng tiêu đề, dữ liệu từ dòng 2."""
+    def write(rows, name="data.csv"):
+        path = tmp_path / name
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(["h"] * lkb.USED_COLUMNS)
+            writer.writerows(rows)
+        return str(path)
+    return write
+
+
+def make_simulator(**kwargs):
+    return lkb.TabmisSimulator(latency=FAST_LATENCY, seed=kwargs.pop("seed", 1), **kwargs)
@@ -0,0 +1,26 @@
+import threading
+
+import lkb_auto_pywinauto_v2 as lkb
+from conftest import data_row, make_simulator
+
+
+def test_unit_bookkeeping_runs_off_the_loop_and_callbacks_are_removed(write_data):
+    path = write_data([data_row(1, 1), data_row(2, 2)])
+    clock = lkb.VirtualClock()
+    automator = lkb.TabmisAutomator(path, 2, None, 0.05, between_rows_delay=0.1, start_delay=0,
+                                    key_backend=make_simulator(clock=clock.monotonic), wait_cursor=True,
+                                    engine="asyncio", clock=clock)
+    threads = []
+    unit_done = automator._unit_done
+
+    def record(numbers):
+        threads.append(threading.current_thread().name)
+        unit_done(numbers)
+
+    automator._unit_done = record
+    callbacks = len(automator.cancel_token._callbacks)
+    # Automator dùng lại (hot-folder, JobRunner): mỗi lần chạy không để lại callback trên token
+    for _ in range(3):
+        assert automator.run()
+    assert len(automator.cancel_token._callbacks) == callbacks
+    assert len(threads) == 6 and all(name.startswith("lkb-io") for name in threads)
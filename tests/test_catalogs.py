@@ -0,0 +1,61 @@
+import os
+
+import pytest
+
+import lkb_auto_pywinauto_v2 as lkb
+from conftest import data_row, make_simulator
+
+
+@pytest.fixture
+def catalog_data(tmp_path, write_data):
+    """3 chứng từ x 3 dòng; dòng 2 của chứng từ 2 (dòng 6 của file) có mã cột 11 ngoài danh mục."""
+    catalog = tmp_path / "codes.csv"
+    catalog.write_text("ma\n" + "".join(f"D{n}\n" for n in range(1, 10)), encoding="utf-8")
+    rows = [data_row(v, (v - 1) * 3 + k) for v in (1, 2, 3) for k in (1, 2, 3)]
+    rows[4][10] = "X9"
+    return write_data(rows), {"11": str(catalog)}
+
+
+@pytest.mark.parametrize("chunk_rows", [0, 4])
+@pytest.mark.parametrize("engine", ["thread", "asyncio"])
+def test_invalid_row_rejects_whole_voucher(catalog_data, engine, chunk_rows):
+    path, catalogs = catalog_data
+    sim = make_simulator()
+    report = lkb.simulate_file(path, key_delay=0.05, between_rows_delay=0.1, simulator=sim, wait_cursor=True,
+                               group_mode="consecutive", catalogs=catalogs, chunk_rows=chunk_rows,
+                               engine=engine, clock=lkb.VirtualClock())
+    assert report["rows_done"] == 6 and report["mis_keyed_fields"] == 0
+    # Chứng từ 2 không được lưu thiếu dòng: chỉ còn chứng từ 1 và 3, mỗi chứng từ đủ 3 dòng
+    assert [len(v["lines"]) for v in sim.vouchers] == [3, 3]
+    # Giả lập không ghi file dòng lỗi cạnh file dữ liệu
+    assert not os.path.exists(lkb.default_failed_rows_path(path))
+
+
+@pytest.mark.parametrize("chunk_rows", [0, 4])
+def test_rejected_voucher_rows_are_recorded(catalog_data, chunk_rows):
+    path, catalogs = catalog_data
+    automator = lkb.TabmisAutomator(path, 2, None, 0.05, between_rows_delay=0.1, start_delay=0,
+                                    key_backend=make_simulator(), group_mode="consecutive",
+                                    catalogs=catalogs, chunk_rows=chunk_rows, clock=lkb.VirtualClock())
+    assert automator.run()
+    assert sorted(n for n, _ in automator.failed_rows) == [5, 6, 7]
+    reasons = dict(automator.failed_rows)
+    assert "danh mục" in reasons[6] and "dòng 6" in reasons[5] and "dòng 6" in reasons[7]
+    assert os.path.exists(lkb.default_failed_rows_path(path))
+
+
+@pytest.mark.parametrize("group_mode", ["consecutive", "sort"])
+@pytest.mark.parametrize("chunk_rows", [0, 4])
+def test_max_group_size_rejects_only_the_split_voucher(tmp_path, write_data, group_mode, chunk_rows):
+    catalog = tmp_path / "codes.csv"
+    catalog.write_text("ma\n" + "".join(f"D{n}\n" for n in range(1, 10)), encoding="utf-8")
+    # Một header, 6 dòng; max_group_size=2 -> 3 chứng từ. Dòng 5 của file (chứng từ giữa) sai mã
+    rows = [data_row(1, n) for n in range(1, 7)]
+    rows[3][10] = "X9"
+    sim = make_simulator()
+    automator = lkb.TabmisAutomator(write_data(rows), 2, None, 0.05, between_rows_delay=0.1, start_delay=0,
+                                    wait_cursor=True, key_backend=sim, group_mode=group_mode, max_group_size=2,
+                                    catalogs={"11": str(catalog)}, chunk_rows=chunk_rows, clock=lkb.VirtualClock())
+    assert automator.run()
+    assert sorted(n for n, _ in automator.failed_rows) == [4, 5]
+    assert [len(v["lines"]) for v in sim.vouchers] == [2, 2]
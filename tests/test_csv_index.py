@@ -0,0 +1,33 @@
+import io
+
+import pytest
+
+from conftest import lkb
+
+ROWS = (
+    b'h1,h2,h3\r\n'
+    b'1,"a ""b"" c",x\r\n'
+    b'2,"""q""",""\r\n'
+    b'3,"nhi\xe1\xbb\x81u\ndong ""x""",y\r\n'
+    b'4,plain,z'
+)
+
+
+@pytest.mark.parametrize("block_size", [4, 7, 1 << 20])
+def test_scan_accepts_doubled_quotes(block_size):
+    starts = lkb._scan_record_starts(io.BytesIO(ROWS), block_size)
+    assert starts is not None
+    assert starts.tolist() == lkb._exact_record_starts(io.BytesIO(ROWS)).tolist()
+
+
+def test_scan_rejects_quote_inside_unquoted_cell():
+    assert lkb._scan_record_starts(io.BytesIO(b'a,b"c",d\n1,2,3\n')) is None
+
+
+def test_indexed_reader_reads_doubled_quotes(tmp_path):
+    path = tmp_path / "data.csv"
+    path.write_bytes(ROWS)
+    lkb.build_csv_index(str(path))
+    found, df = lkb.IndexedCsvReader().read_rows(str(path), [2, 3, 4])
+    assert found == [2, 3, 4]
+    assert df[2].tolist() == ['a "b" c', '"q"', 'nhiều\ndong "x"']
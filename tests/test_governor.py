@@ -0,0 +1,32 @@
+import pytest
+
+import lkb_auto_pywinauto_v2 as lkb
+from conftest import data_row, make_simulator
+
+
+def test_parse_run_windows():
+    assert lkb.parse_run_windows("18:00-07:00") == [(1080, 420)]
+    assert lkb.parse_run_windows("12:00-13:30, 18:00-24:00") == [(720, 810), (1080, 1440)]
+    for spec in ("25:99-07:00", "18:00-07:60", "24:00-01:00", "18-07", "18:00"):
+        with pytest.raises(ValueError):
+            lkb.parse_run_windows(spec)
+
+
+@pytest.mark.parametrize("engine", ["thread", "asyncio"])
+def test_save_latency_needs_readiness_probe(write_data, engine):
+    path = write_data([data_row(1, 1), data_row(2, 2)])
+    for wait_cursor, observed in ((False, False), (True, True)):
+        governor = lkb.RateGovernor(save_latency_target=5.0)
+        lkb.simulate_file(path, key_delay=0.05, between_rows_delay=0.1, simulator=make_simulator(),
+                          wait_cursor=wait_cursor, governor=governor, engine=engine, clock=lkb.VirtualClock())
+        assert (governor.save_latency is not None) == observed
+
+
+def test_save_latency_backs_off_multiplicatively_and_recovers_linearly():
+    governor = lkb.RateGovernor(save_latency_target=5.0, ewma_alpha=1.0)
+    delays = []
+    for latency in (9, 9, 9, 9, 1, 1, 1):
+        governor.observe_save(latency)
+        delays.append(governor.extra_delay)
+    assert delays == [0.5, 1.0, 2.0, 4.0, 3.5, 3.0, 2.5]
+    assert governor.backoffs == 4
@@ -0,0 +1,54 @@
+import os
+
+import lkb_auto_pywinauto_v2 as lkb
+from conftest import FAST_LATENCY, data_row
+
+
+class ClosedTabmisSimulator(lkb.TabmisSimulator):
+    """Tabmis chưa mở trong closed_for lần focus đầu; sau đó chạy bình thường."""
+
+    def __init__(self, closed_for, **kwargs):
+        super().__init__(**kwargs)
+        self.closed_for = closed_for
+        self.focus_calls = 0
+
+    def focus_window(self):
+        self.focus_calls += 1
+        return None if self.focus_calls <= self.closed_for else super().focus_window()
+
+
+def _daemon(tmp_path, write_data, closed_for):
+    watch = tmp_path / "watch"
+    watch.mkdir()
+    path = write_data([data_row(1, 1), data_row(2, 2)], name="watch/data.csv")
+    clock = lkb.VirtualClock()
+    sim = ClosedTabmisSimulator(closed_for, latency=FAST_LATENCY, seed=1, clock=clock.monotonic)
+    automator = lkb.TabmisAutomator(None, 2, None, 0.05, between_rows_delay=0.1, start_delay=0,
+                                    key_backend=sim, wait_cursor=True, clock=clock)
+    return lkb.HotFolderDaemon(automator, str(watch), settle_seconds=0), path, sim
+
+
+def test_file_stays_queued_while_tabmis_is_missing(tmp_path, write_data):
+    daemon, path, sim = _daemon(tmp_path, write_data, closed_for=1)
+    assert daemon.process_file(path) is None
+    assert os.path.exists(path) and not os.path.exists(daemon.failed_dir + "/data.csv")
+    assert daemon.process_file(path) is True
+    assert os.path.exists(os.path.join(daemon.done_dir, "data.csv")) and len(sim.vouchers) == 2
+
+
+def test_daemon_backs_off_until_tabmis_is_back(tmp_path, write_data):
+    daemon, path, sim = _daemon(tmp_path, write_data, closed_for=3)
+    messages = []
+
+    def status(text):
+        messages.append(text)
+        if "Xong" in text or "Lỗi" in text:
+            daemon.automator.stop("test")
+
+    daemon.scan()
+    daemon.scan()
+    daemon.run_forever(status)
+    assert os.path.exists(os.path.join(daemon.done_dir, "data.csv"))
+    assert not os.path.exists(daemon.failed_dir) or not os.listdir(daemon.failed_dir)
+    waits = [m for m in messages if "thử lại sau" in m]
+    assert [m.rsplit("sau ", 1)[1] for m in waits] == ["5 giây", "10 giây", "20 giây"]
@@ -0,0 +1,169 @@
+import http.client
+import json
+import time
+
+import pytest
+
+import lkb_auto_pywinauto_v2 as lkb
+from conftest import FAST_LATENCY, data_row, make_simulator
+
+TOKEN = "test-token"
+
+
+@pytest.fixture
+def api():
+    """JobQueue + JobRunner (TabmisSimulator, đồng hồ ảo) + JobControlServer trên cổng trống."""
+    sims = []
+
+    def factory(spec):
+        clock = lkb.VirtualClock()
+        sims.append(make_simulator(clock=clock.monotonic))
+        defaults = {"key_backend": sims[-1], "clock": clock, "start_delay": 0,
+                    "wait_cursor": True, "key_delay": 0.05, "between_rows_delay": 0.1}
+        return lkb.automator_from_spec(spec, defaults)
+
+    jobs = lkb.JobQueue()
+    runner = lkb.JobRunner(jobs, automator_factory=factory).start()
+    server = lkb.JobControlServer(jobs, port=0, token=TOKEN).start()
+    yield jobs, server, sims
+    server.close()
+    runner.stop()
+    runner.join(5)
+
+
+def request(server, method, path, body=None, headers=None, token=TOKEN):
+    conn = http.client.HTTPConnection("127.0.0.1", server.port, timeout=5)
+    hdrs = {"Content-Type": "application/json"} if method == "POST" else {}
+    if token:
+        hdrs["Authorization"] = f"Bearer {token}"
+    hdrs.update(headers or {})
+    hdrs = {k: v for k, v in hdrs.items() if v is not None}
+    conn.request(method, path, json.dumps(body) if body is not None else None, hdrs)
+    resp = conn.getresponse()
+    payload = json.loads(resp.read() or b"null")
+    conn.close()
+    return resp.status, payload
+
+
+def wait_status(jobs, job_id, statuses, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = jobs.get(job_id)
+        if job is not None and job.status in statuses:
+            return job
+        time.sleep(0.02)
+    raise AssertionError(f"job {job_id} not in {statuses}: {jobs.get(job_id).status}")
+
+
+def test_job_runs_end_to_end(api, write_data):
+    jobs, server, sims = api
+    path = write_data([data_row(1, 1), data_row(1, 2), data_row(2, 3)])
+    status, job = request(server, "POST", "/jobs", {"path": path, "group": "consecutive"})
+    assert status == 201 and job["status"] == "queued"
+    done = wait_status(jobs, job["id"], ("done", "failed", "stopped"))
+    assert done.status == "done"
+    assert len(sims[0].vouchers) == 2 and sims[0].verify([[data_row(1, 1), data_row(1, 2)], [data_row(2, 3)]]) == []
+    status, listed = request(server, "GET", "/jobs")
+    assert status == 200 and [j["status"] for j in listed] == ["done"]
+    status, detail = request(server, "GET", f"/jobs/{job['id']}")
+    assert status == 200 and detail["metrics"]["rows_done"] == 3
+
+
+def test_invalid_spec_is_rejected(api, tmp_path):
+    jobs, server, _ = api
+    status, payload = request(server, "POST", "/jobs", {"path": str(tmp_path / "missing.csv")})
+    assert status == 400 and "not found" in payload["error"]
+    assert jobs.list() == []
+
+
+@pytest.mark.parametrize("headers, token, code", [
+    ({}, None, 401),
+    ({}, "wrong", 401),
+    ({"Origin": "http://evil.example"}, TOKEN, 403),
+    ({"Host": "evil.example"}, TOKEN, 403),
+    ({"Content-Type": "text/plain"}, TOKEN, 415),
+    ({"Content-Type": None}, TOKEN, 415),
+])
+def test_untrusted_requests_are_refused(api, write_data, headers, token, code):
+    jobs, server, _ = api
+    path = write_data([data_row(1, 1)])
+    status, _ = request(server, "POST", "/jobs", {"path": path}, headers, token)
+    assert status == code
+    assert jobs.list() == []
+    job = jobs.submit({"path": path})
+    status, _ = request(server, "POST", f"/jobs/{job.id}/stop", {}, headers, token)
+    assert status == code
+    if "Content-Type" not in headers:
+        assert request(server, "GET", "/jobs", headers=headers, token=token)[0] == code
+
+
+def test_queue_stop_pause_resume(write_data):
+    jobs = lkb.JobQueue()
+    path = write_data([data_row(1, 1)])
+    first, second = jobs.submit({"path": path}), jobs.submit({"path": path})
+    events = jobs.subscribe()
+    assert jobs.stop(second.id).status == "cancelled"
+    assert jobs.pending() == 1 and jobs.next_job(0).id == first.id
+    # Job đang chạy: pause/resume đi tới automator
+    first.automator = lkb.TabmisAutomator(path, 2, None, 0)
+    first.status = "running"
+    jobs.pause(first.id)
+    assert first.status == "paused" and first.automator.paused
+    jobs.resume(first.id)
+    assert first.status == "running" and not first.automator.paused
+    assert [events.get_nowait()["event"] for _ in range(3)] == ["finished", "paused", "resumed"]
+
+
+class FocusLostSimulator(lkb.TabmisSimulator):
+    """Lần lưu đầu tạm dừng job; focus_window thất bại khi window_gone (Tabmis đã bị đóng)."""
+
+    def __init__(self, on_save, **kwargs):
+        super().__init__(**kwargs)
+        self.on_save = on_save
+        self.window_gone = False
+
+    def focus_window(self):
+        return None if self.window_gone else super().focus_window()
+
+    def hotkey(self, modifiers, key):
+        if key == "s" and self.on_save is not None:
+            self.on_save, on_save = None, self.on_save
+            on_save()
+        super().hotkey(modifiers, key)
+
+
+def test_failed_refocus_reports_job_paused(write_data):
+    jobs = lkb.JobQueue()
+    events = jobs.subscribe()
+    paused_jobs = []
+    clock = lkb.VirtualClock()
+    path = write_data([data_row(1, 1), data_row(2, 2)])
+
+    def pause_and_close_tabmis():
+        sim.window_gone = True
+        jobs.pause(jobs.current().id)
+
+    sim = FocusLostSimulator(pause_and_close_tabmis, latency=FAST_LATENCY, seed=1, clock=clock.monotonic)
+    automator = lkb.TabmisAutomator(path, 2, None, 0.05, between_rows_delay=0.1, start_delay=0,
+                                    key_backend=sim, clock=clock)
+    runner = lkb.JobRunner(jobs, on_pause=paused_jobs.append).start()
+    try:
+        job = jobs.submit({"path": path}, automator)
+        wait_status(jobs, job.id, ("paused",))
+        jobs.resume(job.id)
+        # Không focus lại được: job quay về paused, có sự kiện "paused" cho API và on_pause cho GUI
+        deadline = time.monotonic() + 10
+        while not paused_jobs and time.monotonic() < deadline:
+            time.sleep(0.02)
+        assert paused_jobs == [job] and job.status == "paused" and automator.paused
+        sim.window_gone = False
+        jobs.resume(job.id)
+        assert wait_status(jobs, job.id, ("done", "failed", "stopped")).status == "done"
+    finally:
+        runner.stop()
+        runner.join(5)
+    seen = []
+    while not events.empty():
+        seen.append(events.get_nowait()["event"])
+    seen = [e for e in seen if e != "status"]
+    assert seen == ["submitted", "started", "paused", "resumed", "paused", "resumed", "finished"]
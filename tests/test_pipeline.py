@@ -0,0 +1,62 @@
+import threading
+import time
+
+import lkb_auto_pywinauto_v2 as lkb
+from conftest import data_row
+
+
+def _store(n):
+    table = lkb.pd.DataFrame([data_row(n, n)], columns=list(range(1, lkb.USED_COLUMNS + 1)), dtype=object)
+    return lkb.RowStore.from_frame(table, [n])
+
+
+class CountingQueue(lkb.queue.Queue):
+    calls = 0
+
+    def get(self, *args, **kwargs):
+        CountingQueue.calls += 1
+        return super().get(*args, **kwargs)
+
+    def put(self, *args, **kwargs):
+        CountingQueue.calls += 1
+        return super().put(*args, **kwargs)
+
+
+def test_idle_pipeline_blocks_and_wakes_on_cancel(monkeypatch):
+    monkeypatch.setattr(lkb.queue, "Queue", CountingQueue)
+    CountingQueue.calls = 0
+    release = threading.Event()
+
+    def source(stats):
+        release.wait(5)
+        yield _store(2)
+
+    token = lkb.CancelToken()
+    pipeline = lkb.ChunkPipeline(source, cancel_token=token)
+    result = []
+    consumer = threading.Thread(target=lambda: result.append(pipeline.first()))
+    consumer.start()
+    time.sleep(0.5)
+    # Chờ khối đầu: một lần get chặn hẳn, không thức dậy định kỳ
+    assert CountingQueue.calls == 1
+    token.cancel("test")
+    consumer.join(1)
+    assert not consumer.is_alive() and result == [None] and pipeline.interrupted
+    release.set()
+    pipeline.close()
+    assert token._callbacks == []
+
+
+def test_close_releases_blocked_producer():
+    def source(stats):
+        n = 2
+        while True:
+            yield _store(n)
+            n += 1
+
+    pipeline = lkb.ChunkPipeline(source, depth=1)
+    assert pipeline.first().row_numbers == (2,)
+    time.sleep(0.1)
+    pipeline.close()
+    pipeline._thread.join(1)
+    assert not pipeline._thread.is_alive()
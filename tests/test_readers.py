@@ -0,0 +1,54 @@
+import datetime
+
+import pandas as pd
+import pytest
+
+from conftest import lkb
+
+openpyxl = pytest.importorskip("openpyxl")
+
+
+def _read_all(name, path):
+    frames = [df for _, df in lkb.make_reader(name, path).iter_chunks(path, 2, None, 2)]
+    return lkb.format_table(pd.concat(frames), lkb.load_column_schema(None)).values.tolist()
+
+
+def test_excel_readers_return_identical_values(tmp_path):
+    path = str(tmp_path / "data.xlsx")
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.append(["h"] * lkb.USED_COLUMNS)
+    ws.append(["0012", 12, 1.5, datetime.datetime(2024, 3, 1), True, None, "abc", "007", 1000000, "x"] + ["d"] * 8)
+    ws.append(["0013", 13.0, "t", datetime.datetime(2024, 3, 2), False, 5, None, "008", 2.25, None] + ["e"] * 8)
+    ws.append(["0014", None, 3, None, None, None, "z", 9, 3, ""] + [None] * 8)
+    wb.save(path)
+
+    readers = lkb.readers_for(path)
+    assert "openpyxl" in readers and "pandas-excel" in readers
+    expected = _read_all("openpyxl", path)
+    assert expected[0][:5] == ["0012", "12", "1.5", "01/03/2024", "True"]
+    for name in readers:
+        assert _read_all(name, path) == expected, name
+
+
+def test_select_reader_reads_bulk_csv_with_csv_reader(tmp_path, monkeypatch):
+    path = tmp_path / "big.csv"
+    path.write_text("h\n" + "a,b\n" * 10)
+    # Như file 64 MB: nạp cả file một lần không dùng pandas, cũng không dựng index
+    monkeypatch.setattr(lkb.os.path, "getsize", lambda p: 64 * 1024 * 1024)
+    assert lkb.select_reader(str(path)) == "csv"
+    assert lkb.select_reader(str(path), 2, 400_000, lkb.BENCH_CHUNK_ROWS) == "csv-index"
+
+
+def test_bench_reader_excludes_import_peak(tmp_path):
+    path = str(tmp_path / "small.xlsx")
+    wb = openpyxl.Workbook()
+    for n in range(11):
+        wb.active.append([f"v{n}"] * lkb.USED_COLUMNS)
+    wb.save(path)
+    # Tiến trình mới như benchmark_readers: đỉnh lúc import openpyxl không tính vào reader
+    ctx = lkb.multiprocessing.get_context("spawn")
+    with lkb.concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+        res = pool.submit(lkb.bench_reader, "openpyxl", path).result()
+    assert res["rows"] == 10
+    assert res["peak_bytes"] < 2 * 1024 * 1024
@@ -0,0 +1,47 @@
+import lkb_auto_pywinauto_v2 as lkb
+from conftest import FAST_LATENCY, data_row
+
+
+class FailingSimulator(lkb.TabmisSimulator):
+    """Lần dò con trỏ đầu tiên sau saves_before lần Ctrl+S ném lỗi (một lần)."""
+
+    def __init__(self, saves_before, **kwargs):
+        super().__init__(latency=FAST_LATENCY, seed=1, **kwargs)
+        self.saves_before = saves_before
+        self.failed = False
+
+    def cursor_busy(self):
+        if not self.failed and self.stats["saves"] >= self.saves_before:
+            self.failed = True
+            raise RuntimeError("form not responding")
+        return super().cursor_busy()
+
+
+def _simulate(path, sim, **options):
+    return lkb.simulate_file(path, key_delay=0.05, between_rows_delay=0.1, simulator=sim,
+                             wait_cursor=True, max_retries=2, clock=lkb.VirtualClock(), **options)
+
+
+def _header_saves(sim):
+    return sim.stats["saves"] - len(sim.vouchers)
+
+
+def test_failure_after_save_is_not_retried(write_data):
+    path = write_data([data_row(1, 1), data_row(2, 2)])
+    for engine in ("thread", "asyncio"):
+        sim = FailingSimulator(saves_before=1)
+        report = _simulate(path, sim, engine=engine)
+        assert sim.failed
+        assert report["rows_failed"] == 1 and report["rows_done"] == 1
+        # Header dòng 2 chỉ được lưu một lần: không có lần lưu thứ hai từ bước đầu
+        assert _header_saves(sim) == 2
+
+
+def test_failure_before_save_is_retried(write_data):
+    path = write_data([data_row(1, 1), data_row(2, 2)])
+    for engine in ("thread", "asyncio"):
+        sim = FailingSimulator(saves_before=0)
+        report = _simulate(path, sim, engine=engine)
+        assert sim.failed
+        assert report["rows_failed"] == 0 and report["rows_done"] == 2
+        assert report["mis_keyed_fields"] == 0
@@ -0,0 +1,132 @@
+import csv
+import os
+import threading
+
+import pytest
+
+import lkb_auto_pywinauto_v2 as lkb
+from conftest import FAST_LATENCY, data_row
+
+
+class StoppingSimulator(lkb.TabmisSimulator):
+    """Gọi token.cancel() ở phím thứ stop_at (giữa đơn vị đầu tiên)."""
+
+    def __init__(self, token, stop_at):
+        super().__init__(latency=FAST_LATENCY, seed=1)
+        self.token = token
+        self.stop_at = stop_at
+
+    def key(self, key):
+        super().key(key)
+        if self.stats["keys"] >= self.stop_at:
+            self.token.cancel("user")
+
+
+def _results(path):
+    with open(lkb.default_result_path(path), encoding="utf-8") as f:
+        return {row["row"]: row for row in csv.DictReader(f)}
+
+
+@pytest.mark.parametrize("engine", ["thread", "asyncio"])
+def test_stop_mid_unit_is_not_recorded_as_done(write_data, engine):
+    path = write_data([data_row(1, 1), data_row(2, 2)])
+    token = lkb.CancelToken()
+    sim = StoppingSimulator(token, stop_at=5)
+    report = lkb.simulate_file(path, key_delay=0.05, between_rows_delay=0.1, simulator=sim, wait_cursor=True,
+                               result_mode="sidecar", cancel_token=token, engine=engine, clock=lkb.VirtualClock())
+    assert report["rows_done"] == 0 and not sim.vouchers
+    results = _results(path)
+    assert results["2"]["LKB_status"] == "stopped"
+    assert "3" not in results
+
+
+def test_voucher_number_needs_an_explicit_pattern(write_data):
+    path = write_data([data_row(1, 1)])
+    assert lkb.TabmisAutomator(path, 2, None, 0).voucher_re is None
+    lkb.simulate_file(path, key_delay=0.05, between_rows_delay=0.1, simulator=lkb.TabmisSimulator(FAST_LATENCY),
+                      wait_cursor=True, result_mode="sidecar", voucher_pattern=r"simulator - (\d+)",
+                      clock=lkb.VirtualClock())
+    assert _results(path)["2"]["LKB_voucher"] == "00000001"
+
+
+def _open_paths():
+    fds = "/proc/self/fd"
+    paths = set()
+    for fd in os.listdir(fds):
+        try:
+            paths.add(os.path.realpath(os.readlink(os.path.join(fds, fd))))
+        except OSError:
+            pass
+    return paths
+
+
+@pytest.mark.skipif(not os.path.isdir("/proc/self/fd"), reason="needs /proc")
+def test_source_write_back_does_not_race_the_reader(write_data, monkeypatch):
+    path = write_data([data_row(k // 3, k) for k in range(40)])
+    seen = []
+    write = lkb.ResultLedger._write_csv_source
+    append = lkb.ResultLedger._append_sidecar
+    with open(path, encoding="utf-8") as f:
+        original = f.read()
+    journal = []
+
+    def checked(self):
+        # Windows không cho os.replace đè lên file đang mở: reader phải đóng file trước
+        seen.append(os.path.realpath(path) in _open_paths())
+        return write(self)
+
+    def journaled(self, records):
+        # Trong lúc chạy chỉ nối nhật ký trên luồng ghi nền, file nguồn chưa bị ghi lại
+        with open(path, encoding="utf-8") as f:
+            journal.append((threading.current_thread().name, len(records), f.read() == original))
+        return append(self, records)
+
+    monkeypatch.setattr(lkb.ResultLedger, "_write_csv_source", checked)
+    monkeypatch.setattr(lkb.ResultLedger, "_append_sidecar", journaled)
+    report = lkb.simulate_file(path, key_delay=0.05, between_rows_delay=0.1,
+                               simulator=lkb.TabmisSimulator(FAST_LATENCY), wait_cursor=True,
+                               result_mode="source", result_flush_every=5, chunk_rows=10, clock=lkb.VirtualClock())
+    assert report["rows_done"] == 40
+    assert seen == [False]
+    assert journal == [("lkb-ledger", 5, True)] * 8
+    with open(path, encoding="utf-8") as f:
+        rows = list(csv.DictReader(f))
+    assert [r["LKB_status"] for r in rows] == ["done"] * 40
+    # Đã gộp vào file nguồn: nhật ký của lần chạy không còn
+    assert not os.path.exists(lkb.default_result_path(path))
+
+
+def test_row_status_tolerates_ragged_source(tmp_path):
+    path = tmp_path / "data.csv"
+    header = [f"c{k}" for k in range(1, lkb.USED_COLUMNS + 1)] + ["LKB_status"]
+    # Sửa tay: dòng thừa cột, dòng trống (vẫn là một dòng khi đánh số), dòng thiếu cột
+    lines = [header, data_row(1, 1) + ["done"], data_row(2, 2) + ["failed", "ghi chú tay"], [],
+             data_row(3, 3) + ["done"], data_row(4, 4)[:3]]
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        csv.writer(f).writerows(lines)
+    assert lkb.load_row_status(str(path)) == {2: "done", 3: "failed", 5: "done"}
+
+
+def test_source_mode_refuses_xlsx_that_openpyxl_would_damage(tmp_path):
+    openpyxl = pytest.importorskip("openpyxl")
+    from openpyxl.chart import BarChart, Reference
+    path = str(tmp_path / "data.xlsx")
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    for n in range(1, 4):
+        ws.append([n, n * 10])
+    chart = BarChart()
+    chart.add_data(Reference(ws, min_col=2, min_row=1, max_row=3))
+    ws.add_chart(chart, "D2")
+    wb.save(path)
+    with open(path, "rb") as f:
+        original = f.read()
+
+    ledger = lkb.ResultLedger(path, "source", flush_every=2)
+    assert ledger.mode == "sidecar" and "biểu đồ" in str(ledger.last_error)
+    for n in (2, 3, 4):
+        ledger.record(n, "done", 0, 0)
+    assert ledger.close()
+    with open(path, "rb") as f:
+        assert f.read() == original
+    assert sorted(_results(path)) == ["2", "3", "4"]
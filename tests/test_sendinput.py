@@ -0,0 +1,88 @@
+import pytest
+
+import lkb_auto_pywinauto_v2 as lkb
+from conftest import data_row
+
+
+def _events(inputs):
+    """(vk, scan, flags) của từng INPUT."""
+    return [(i.u.ki.wVk, i.u.ki.wScan, i.u.ki.dwFlags) for i in inputs]
+
+
+class StubSend:
+    def __init__(self, short=0):
+        self.calls = []
+        self.short = short
+
+    def __call__(self, count, inputs, size):
+        assert size == lkb.ctypes.sizeof(lkb.INPUT)
+        self.calls.append(_events(inputs[:count]))
+        return count - self.short
+
+
+class ClipboardSendInput(lkb.SendInputBackend):
+    """SendInput với clipboard trong bộ nhớ (không cần pyperclip)."""
+
+    def copy(self, text):
+        self.clipboard = text
+
+
+def test_build_inputs_keys_and_hotkeys():
+    backend = lkb.SendInputBackend(send_func=StubSend())
+    up, ext = lkb.KEYEVENTF_KEYUP, lkb.KEYEVENTF_EXTENDEDKEY
+    assert _events(backend.build_inputs([("key", "tab")])) == [(0x09, 0, 0), (0x09, 0, up)]
+    assert _events(backend.build_inputs([("key", "down")])) == [(0x28, 0, ext), (0x28, 0, ext | up)]
+    assert _events(backend.build_inputs([("hotkey", ("ctrl",), "s")])) == [
+        (0x11, 0, 0), (ord("S"), 0, 0), (ord("S"), 0, up), (0x11, 0, up)]
+    assert _events(backend.build_inputs([("hotkey", ("shift",), "pageup")])) == [
+        (0x10, 0, 0), (0x21, 0, ext), (0x21, 0, ext | up), (0x10, 0, up)]
+
+
+def test_hotkey_without_virtual_key_is_rejected():
+    send = StubSend()
+    backend = lkb.SendInputBackend(send_func=send)
+    # Ctrl+"ệ" sẽ thành text Unicode khi đang giữ Ctrl: không phải phím tắt
+    for action in (("hotkey", ("ctrl",), "ệ"), ("hotkey", ("hyper",), "s")):
+        with pytest.raises(ValueError):
+            backend.send_group([("key", "tab"), action])
+    assert send.calls == []
+
+
+def test_build_inputs_unicode_text():
+    backend = lkb.SendInputBackend(send_func=StubSend())
+    uni, up = lkb.KEYEVENTF_UNICODE, lkb.KEYEVENTF_KEYUP
+    text = "Việt+^%~{}()"
+    events = _events(backend.build_inputs([("text", text)]))
+    assert events == [e for ch in text for e in ((0, ord(ch), uni), (0, ord(ch), uni | up))]
+    # Ký tự ngoài BMP: cặp surrogate; xuống dòng gõ Enter
+    events = _events(backend.build_inputs([("text", "😀\r\n")]))
+    assert [e[1] for e in events[:4]] == [0xD83D, 0xD83D, 0xDE00, 0xDE00]
+    assert events[4:] == [(0x0D, 0, 0), (0x0D, 0, up)]
+
+
+def test_send_group_is_one_call():
+    send = StubSend()
+    backend = lkb.SendInputBackend(send_func=send)
+    assert backend.send_group([("key", "tab"), ("key", "tab"), ("text", "ab")]) == 8
+    assert len(send.calls) == 1 and len(send.calls[0]) == 8
+    with pytest.raises(OSError):
+        lkb.SendInputBackend(send_func=StubSend(short=1)).send_group([("key", "tab")])
+
+
+def test_plan_key_runs_are_sent_as_groups():
+    send = StubSend()
+    automator = lkb.TabmisAutomator(None, 2, None, 0, key_backend=ClipboardSendInput(send_func=send),
+                                    clock=lkb.VirtualClock())
+    row = data_row(1, 1)
+    plan = automator.compile_group([row])
+    assert any(step[0] == "keys" for step in plan)
+    assert all(not (a[0] in ("press", "keys") and len(a) == 2 and b[0] == "press" and len(b) == 2)
+               for a, b in zip(plan, plan[1:]))
+    automator.process_group([row])
+    # Một lần SendInput cho mỗi bước của kế hoạch đã gộp (paste = một Ctrl+V)
+    assert len(send.calls) == len(plan)
+    # Mỗi lô gửi đúng dãy phím của các bước press đã gộp, theo thứ tự của ROW_PLAN
+    sent = [vk for step, call in zip(plan, send.calls) if step[0] in ("press", "keys")
+            for vk, _, _ in call[::2]]
+    expected = [lkb.VIRTUAL_KEYS[step[1]] for step in lkb.ROW_PLAN if step[0] == "press"]
+    assert sent == expected
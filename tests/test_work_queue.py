@@ -0,0 +1,94 @@
+import sqlite3
+import threading
+
+import lkb_auto_pywinauto_v2 as lkb
+from conftest import FAST_LATENCY, data_row, make_simulator
+
+# 8 chứng từ x 3 dòng (dòng 2..25); lô 2 dòng luôn cắt giữa chứng từ nếu không thuê theo nhóm.
+# Đủ nhiều để máy thứ hai còn việc dù máy đầu đã thuê trước vài lô (ChunkPipeline nạp trước)
+VOUCHERS = [[data_row(v, (v - 1) * 3 + k) for k in (1, 2, 3)] for v in range(1, 9)]
+
+
+def _store(groups=VOUCHERS):
+    rows = [row for voucher in groups for row in voucher]
+    table = lkb.pd.DataFrame(rows, columns=list(range(1, lkb.USED_COLUMNS + 1)), dtype=object)
+    return lkb.RowStore.from_frame(table, range(2, 2 + len(rows)))
+
+
+def _publish(path, group_key=True):
+    queue = lkb.WorkQueue(str(path), job="job", batch_rows=2)
+    automator = lkb.TabmisAutomator(None, 1, None, 0, key_backend=make_simulator())
+    queue.publish(_store(), "data.csv", automator.header_key if group_key else None)
+    return queue
+
+
+def test_lease_extends_batch_to_end_of_group(tmp_path):
+    _publish(tmp_path / "q.db")
+    a = lkb.WorkQueue(str(tmp_path / "q.db"), job="job", worker="a", batch_rows=2)
+    b = lkb.WorkQueue(str(tmp_path / "q.db"), job="job", worker="b", batch_rows=2)
+    assert [r for r, _ in a.lease()] == [2, 3, 4]
+    assert [r for r, _ in b.lease()] == [5, 6, 7]
+    a.release()
+    b.release()
+
+
+def test_lease_without_group_key_keeps_batch_size(tmp_path):
+    queue = _publish(tmp_path / "q.db", group_key=False)
+    assert [r for r, _ in queue.lease()] == [2, 3]
+    queue.release()
+
+
+def test_queue_created_before_groups_still_leases(tmp_path):
+    path = str(tmp_path / "old.db")
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE jobs (job TEXT PRIMARY KEY, path TEXT, created REAL)")
+    db.execute("CREATE TABLE rows (job TEXT, row INTEGER, cells TEXT, state TEXT DEFAULT 'pending', "
+               "worker TEXT, lease_until REAL, attempts INTEGER DEFAULT 0, reason TEXT, voucher TEXT, "
+               "updated REAL, PRIMARY KEY (job, row))")
+    db.execute("INSERT INTO jobs VALUES ('job', 'data.csv', 0)")
+    db.executemany("INSERT INTO rows (job, row, cells) VALUES ('job', ?, '[\"a\"]')", [(2,), (3,), (4,)])
+    db.commit()
+    db.close()
+    queue = lkb.WorkQueue(path, batch_rows=2)
+    assert [r for r, _ in queue.lease()] == [2, 3]
+    queue.release()
+
+
+class BarrierSimulator(lkb.TabmisSimulator):
+    """Lần lưu đầu của mỗi máy chờ máy kia: cả hai máy đều đã thuê lô trước khi nhập tiếp."""
+
+    def __init__(self, barrier, **kwargs):
+        super().__init__(**kwargs)
+        self.barrier = barrier
+
+    def hotkey(self, modifiers, key):
+        if key == "s" and self.barrier is not None:
+            self.barrier.wait(10)
+            self.barrier = None
+        super().hotkey(modifiers, key)
+
+
+def test_workers_never_split_a_voucher(tmp_path):
+    path = str(tmp_path / "q.db")
+    _publish(path)
+    sims, automators = [], []
+    barrier = threading.Barrier(2)
+    for worker in ("a", "b"):
+        sim = BarrierSimulator(barrier, latency=FAST_LATENCY, seed=1)
+        clock = lkb.VirtualClock()
+        sim.clock = clock.monotonic
+        queue = lkb.WorkQueue(path, job="job", worker=worker, batch_rows=2, poll_seconds=0.05)
+        sims.append(sim)
+        automators.append(lkb.TabmisAutomator(
+            "data.csv", 1, None, 0.05, between_rows_delay=0.1, start_delay=0, wait_cursor=True,
+            failed_rows_path=str(tmp_path / f"{worker}_failed.csv"), key_backend=sim,
+            group_mode="consecutive", work_queue=queue, clock=clock))
+    threads = [threading.Thread(target=a.run) for a in automators]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(60)
+    assert automators[0].work_queue.counts() == {"done": 24}
+    assert all(s.vouchers for s in sims)
+    saved = [v for s in sims for v in s.vouchers]
+    assert sorted(len(v["lines"]) for v in saved) == [3] * 8